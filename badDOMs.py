@@ -5,44 +5,58 @@
 #
 
 from __future__ import print_function
-from builtins import range
-from nicknames import *
-from runConfig import *
-
-if (len(sys.argv) != 2):
-    print("Usage: %s <runconfig.xml>" % sys.argv[0])
-    sys.exit(0)
-
-rc = RunConfig(sys.argv[1], oldFormat=False)
-nicks = nicknames()
-
-goodList = []
-for dc in rc.getDOMConfigs():
-    for mbid in dc.getDOMs():
-        # Get the HV setting
-        hv = int(dc.getDOMSetting(mbid, 'pmtHighVoltage'))
-        if (hv > 0):
-            goodList.append(nicks.getDOMPosition(mbid))
-
-omkeyString = "bad_doms = [ "
-
-# List of complete deployed DOMs
-nBad = 0
-for string in range(1,87):
-    for dom in range(1,64):
-        if (dom > 60) and (string > 81):
-            continue
-        pos = [string, dom]
-        if pos not in goodList:
-            nBad = nBad+1
-            omkeyString += " icetray.OMKey(%d,%d)," % (pos[0], pos[1])
-            if (nBad % 3 == 0):
-                omkeyString += "\n"
-
-# Remove trailing comma, close brackets
-omkeyString = omkeyString[:-1]
-omkeyString += " ]"
-
-print("Found %d bad DOMs" % nBad)
-print(omkeyString)
-
+import sys
+
+from nicknames import nicknames
+from geometry import Geometry
+from runConfig import RunConfig
+
+def getBadDOMs(rc, nicks, geometry=None):
+    """
+    Return the positions of all deployed DOMs that are not in the
+    run configuration or have their high voltage off.
+    """
+    if geometry is None:
+        geometry = Geometry(nicks)
+    goodList = []
+    for dc in rc.getDOMConfigs():
+        for mbid in dc.getDOMs():
+            # Get the HV setting
+            hv = int(dc.getDOMSetting(mbid, 'pmtHighVoltage'))
+            pos = nicks.getDOMPosition(mbid)
+            if (hv > 0) and (pos is not None):
+                goodList.append(pos)
+
+    return [list(pos) for pos in geometry.getMissingPositions(goodList)]
+
+def formatBadDOMs(badList):
+    """Format a list of DOM positions as a list of icetray OMKeys"""
+    omkeyString = "bad_doms = [ "
+
+    nBad = 0
+    for pos in badList:
+        nBad = nBad+1
+        omkeyString += " icetray.OMKey(%d,%d)," % (pos[0], pos[1])
+        if (nBad % 3 == 0):
+            omkeyString += "\n"
+
+    # Remove trailing comma, close brackets
+    omkeyString = omkeyString[:-1]
+    omkeyString += " ]"
+    return omkeyString
+
+def main():
+    if (len(sys.argv) != 2):
+        print("Usage: %s <runconfig.xml>" % sys.argv[0])
+        sys.exit(0)
+
+    rc = RunConfig(sys.argv[1], readOnly=True, settings=['pmtHighVoltage'],
+                   snapshot=True)
+    nicks = nicknames()
+
+    badList = getBadDOMs(rc, nicks)
+    print("Found %d bad DOMs" % len(badList))
+    print(formatBadDOMs(badList))
+
+if __name__ == "__main__":
+    main()
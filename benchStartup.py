@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+#
+# benchStartup.py
+#
+# Import time of the command-line tools, as measured by
+# python -X importtime, with the slowest modules each one pulls in.
+# Heavy dependencies (lxml, multiprocessing, sqlite3, the archive
+# modules) should only be imported when they are used.
+#
+
+from __future__ import print_function
+from builtins import str
+from builtins import range
+import sys
+import getopt
+import os
+import subprocess
+
+# Modules of the command-line tools
+ENTRY_POINTS = ["updateCalibration", "removeDOMs", "badDOMs", "setDOMSettings",
+                "validateConfig", "compareCalibration", "scanCalibration",
+                "calHistory", "configIndex", "configServer", "runPipeline",
+                "materializeConfig", "geometry", "nicknames"]
+
+# Number of imports timed for each module (the fastest is reported)
+N_RUNS = 5
+
+# Number of slowest direct imports listed for each module
+N_SLOWEST = 3
+
+def usage():
+    """ Print program usage """
+    print("Usage: %s [-h] [-n runs] [-l ms] [module...]" % (sys.argv[0]))
+    print("    -h       print this help message")
+    print("    -n runs  time each import this many times (default %d)" % N_RUNS)
+    print("    -l ms    exit with status 1 if any import takes longer")
+    print("Modules default to the command-line tools:")
+    print("    %s" % " ".join(ENTRY_POINTS))
+
+def getImportTimes(module):
+    """
+    Import a module in a new interpreter, returning the cumulative
+    import time in microseconds of the module and of each module it
+    imports directly, from the -X importtime report.  Raises
+    RuntimeError if the import fails or isn't in the report.
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    p = subprocess.Popen([sys.executable, "-X", "importtime", "-c", "import " + module],
+                         cwd=directory, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    (out, err) = p.communicate()
+    if p.returncode != 0:
+        raise RuntimeError("couldn't import %s: %s" % \
+                           (module, err.decode("utf-8").strip().split("\n")[-1]))
+    children = []
+    for line in err.decode("utf-8").split("\n"):
+        if not line.startswith("import time:") or ("|" not in line):
+            continue
+        (selfTime, cumulative, name) = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        # Nesting is shown by two spaces per level, and a module is
+        # reported after the modules it imports
+        depth = (len(name) - len(name.lstrip()) - 1)//2
+        if depth == 0:
+            if name.strip() == module:
+                return (int(cumulative), children)
+            children = []
+        elif depth == 1:
+            children.append((int(cumulative), name.strip()))
+    raise RuntimeError("no import time reported for %s: %s" % \
+                       (module, err.decode("utf-8").strip()))
+
+def main():
+    """
+    Report the import time of the command-line tools.
+    """
+    #---------------------------------------------------
+    # Parse command-line options
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hn:l:", ["help", "runs=", "limit="])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage()
+        sys.exit(2)
+
+    nRuns = N_RUNS
+    limit = None
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-n", "--runs"):
+            nRuns = int(a)
+        elif o in ("-l", "--limit"):
+            limit = float(a)
+        else:
+            assert False, "unhandled option"
+
+    if sys.version_info < (3, 7):
+        print("ERROR: python -X importtime needs Python 3.7 or later")
+        sys.exit(-1)
+
+    modules = args or ENTRY_POINTS
+    print("%-20s %9s  %s" % ("module", "ms", "slowest imports (ms)"))
+    slow = []
+    for module in modules:
+        best = None
+        for i in range(nRuns):
+            try:
+                (total, children) = getImportTimes(module)
+            except RuntimeError as err:
+                print("ERROR:", str(err))
+                sys.exit(-1)
+            if (best is None) or (total < best[0]):
+                best = (total, children)
+        (total, children) = best
+        slowest = sorted(children, reverse=True)[:N_SLOWEST]
+        print("%-20s %9.1f  %s" % (module, total/1000.,
+                                   ", ".join(["%s %.1f" % (name, t/1000.)
+                                              for (t, name) in slowest])))
+        if (limit is not None) and (total/1000. > limit):
+            slow.append(module)
+
+    if slow:
+        print("Imports slower than %g ms: %s" % (limit, " ".join(slow)))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
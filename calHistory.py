@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+#
+# calHistory.py
+#
+# Local SQLite store of the per-DOM results of calibration updates,
+# indexed by mainboard ID and run time, with queries for the history
+# of a single DOM and for DOMs whose HV has drifted.
+#
+
+from __future__ import print_function
+from builtins import str
+from builtins import object
+import sys
+import getopt
+import math
+import time
+import sqlite3
+
+from nicknames import nicknames
+
+# Default history file
+HISTORY_FILE = "calhistory.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS updates (
+    run_time REAL NOT NULL,
+    config TEXT,
+    version INTEGER,
+    test INTEGER NOT NULL,
+    mbid TEXT NOT NULL,
+    string INTEGER,
+    position INTEGER,
+    category TEXT,
+    hv_old INTEGER,
+    hv_new INTEGER,
+    gain_old REAL,
+    gain_new REAL,
+    spe_disc_old INTEGER,
+    spe_disc_new INTEGER,
+    mpe_disc_new INTEGER,
+    spe_thresh_pe_old REAL,
+    spe_thresh_pe_new REAL,
+    atwd0_bias_old INTEGER,
+    atwd0_bias_new INTEGER,
+    atwd1_bias_old INTEGER,
+    atwd1_bias_new INTEGER,
+    warnings TEXT
+);
+CREATE INDEX IF NOT EXISTS updates_mbid ON updates (mbid, run_time);
+CREATE INDEX IF NOT EXISTS updates_run ON updates (run_time, version);
+"""
+
+COLUMNS = ["run_time", "config", "version", "test", "mbid", "string",
+           "position", "category", "hv_old", "hv_new", "gain_old",
+           "gain_new", "spe_disc_old", "spe_disc_new", "mpe_disc_new",
+           "spe_thresh_pe_old", "spe_thresh_pe_new", "atwd0_bias_old",
+           "atwd0_bias_new", "atwd1_bias_old", "atwd1_bias_new", "warnings"]
+
+def usage():
+    """ Print program usage """
+    print("Usage: %s [-ha] [-f history_file] dom" % (sys.argv[0]))
+    print("       %s [-ha] [-f history_file] -d volts [-u updates]" % (sys.argv[0]))
+    print("    -h       print this help message")
+    print("    -a       include test (-t) runs of updateCalibration")
+    print("    -f file  history file (default %s)" % HISTORY_FILE)
+    print("    -d volts list DOMs whose HV changed by more than this")
+    print("    -u N     ... over their last N updates (default 5)")
+    print("   dom       can be specified by position, MBID, or name")
+
+class CalibrationHistory(object):
+    """SQLite store of per-DOM calibration update records"""
+
+    def __init__(self, filename=HISTORY_FILE):
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def addRun(self, records, config=None, version=None, test=False,
+               runTime=None):
+        """
+        Append the records of one updateCalibration run (as kept by
+        CalibrationUpdater) for all DOMs with calibration results.
+        """
+        if runTime is None:
+            runTime = time.time()
+        rows = []
+        for r in records:
+            if not r["calibrated"]:
+                continue
+            pos = r["position"] or [None, None]
+            rows.append((runTime, config, version, int(test), r["mbid"],
+                         pos[0], pos[1], r["category"],
+                         r["hvOld"], r["hvNew"], r["gainOld"], r["gainNew"],
+                         r["speDiscOld"], r["speDiscNew"], r["mpeDiscNew"],
+                         r["speThreshPEOld"], r["speThreshPENew"],
+                         r["atwdBiasOld"][0], r["atwdBiasNew"][0],
+                         r["atwdBiasOld"][1], r["atwdBiasNew"][1],
+                         "\n".join([w.rstrip() for w in r["warnings"]])))
+        with self.db:
+            self.db.executemany("INSERT INTO updates (%s) VALUES (%s)" % \
+                                (", ".join(COLUMNS), ", ".join(["?"]*len(COLUMNS))),
+                                rows)
+        return len(rows)
+
+    def getDOMHistory(self, mbid, includeTest=False):
+        """All records for a DOM, oldest first"""
+        sql = "SELECT * FROM updates WHERE mbid = ?"
+        if not includeTest:
+            sql += " AND test = 0"
+        sql += " ORDER BY run_time"
+        return self.db.execute(sql, (mbid,)).fetchall()
+
+    def getHVDrift(self, minDrift, nUpdates, includeTest=False):
+        """
+        DOMs whose HV setting changed by more than minDrift volts
+        between the old setting of the earliest and the new setting of
+        the latest of their last nUpdates records.  Returns a list of
+        (mbid, drift in volts, number of updates), largest drift first.
+        """
+        where = ""
+        if not includeTest:
+            where = "WHERE test = 0"
+        sql = """
+            SELECT mbid, hv_old, hv_new FROM (
+                SELECT mbid, hv_old, hv_new, run_time,
+                       ROW_NUMBER() OVER (PARTITION BY mbid
+                                          ORDER BY run_time DESC) AS n
+                FROM updates %s)
+            WHERE n <= ? ORDER BY mbid, run_time""" % where
+        first = {}
+        last = {}
+        count = {}
+        for row in self.db.execute(sql, (nUpdates,)):
+            mbid = row["mbid"]
+            if mbid not in first:
+                first[mbid] = row["hv_old"]
+                count[mbid] = 0
+            last[mbid] = row["hv_new"]
+            count[mbid] += 1
+        drifts = []
+        for mbid in first:
+            drift = (last[mbid]-first[mbid])/2.
+            if abs(drift) > minDrift:
+                drifts.append((mbid, drift, count[mbid]))
+        drifts.sort(key=lambda d: -abs(d[1]))
+        return drifts
+
+def main():
+    """
+    Query the per-DOM history of calibration updates.
+    """
+    #---------------------------------------------------
+    # Parse command-line options
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "haf:d:u:",
+                     ["help", "all", "file=", "drift=", "updates="])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage()
+        sys.exit(2)
+
+    includeTest = False
+    historyFile = HISTORY_FILE
+    minDrift = None
+    nUpdates = 5
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-a", "--all"):
+            includeTest = True
+        elif o in ("-f", "--file"):
+            historyFile = a
+        elif o in ("-d", "--drift"):
+            minDrift = float(a)
+        elif o in ("-u", "--updates"):
+            nUpdates = int(a)
+        else:
+            assert False, "unhandled option"
+
+    if ((minDrift is None) and (len(args) != 1)) or \
+       ((minDrift is not None) and (len(args) != 0)):
+        usage()
+        sys.exit(2)
+
+    nicks = nicknames()
+    history = CalibrationHistory(historyFile)
+
+    if minDrift is not None:
+        drifts = history.getHVDrift(minDrift, nUpdates, includeTest=includeTest)
+        print("%d DOMs with HV drift over %.1f V in their last %d updates" % \
+              (len(drifts), minDrift, nUpdates))
+        for (mbid, drift, n) in drifts:
+            pos = nicks.getDOMPosition(mbid)
+            print("%s %s %-20s %+7.1f V over %d updates" % \
+                  (mbid, pos and "%02d-%02d" % (pos[0], pos[1]),
+                   nicks.getDOMName(mbid), drift, n))
+    else:
+        mbid = nicks.findMBID(args[0])
+        if mbid is None:
+            print("ERROR: unknown DOM", args[0], file=sys.stderr)
+            sys.exit(-1)
+        rows = history.getDOMHistory(mbid, includeTest=includeTest)
+        print(mbid, nicks.getDOMPosition(mbid), nicks.getDOMName(mbid), \
+              "-", len(rows), "updates")
+        print("%-19s %-24s %4s %9s %13s %9s %11s %11s" % \
+              ("time", "config", "test", "HV", "log10(gain)", "SPE disc",
+               "thresh(PE)", "ATWD bias"))
+        for row in rows:
+            thresh = "-"
+            if row["spe_thresh_pe_new"] is not None:
+                thresh = "%.3f" % row["spe_thresh_pe_new"]
+            gain = "-"
+            if (row["gain_new"] is not None) and (row["gain_new"] > 0):
+                gain = "%.2f" % math.log10(row["gain_new"])
+            print("%-19s %-24s %4s %4d>%4d %13s %4d>%4d %11s %5d,%5d" % \
+                  (time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(row["run_time"])),
+                   "%s-V%s" % (row["config"], row["version"]),
+                   row["test"] and "yes" or "no",
+                   row["hv_old"], row["hv_new"], gain,
+                   row["spe_disc_old"], row["spe_disc_new"], thresh,
+                   row["atwd0_bias_new"], row["atwd1_bias_new"]))
+            for w in (row["warnings"] or "").splitlines():
+                if w:
+                    print("    WARNING:", w)
+    history.close()
+
+if __name__ == "__main__":
+    main()
@@ -10,13 +10,16 @@ from builtins import str
 from builtins import range
 from builtins import object
 import sys
-import getopt
 import os
 import glob
 import re
 import math
+import fnmatch
+import time
+import threading
+from io import BytesIO
 
-from lxml import etree
+# lxml and the archive modules are imported only when results are read
 
 DEFAULT_MPE_SETTING = 560
 DEFAULT_SPE_SETTING = 560
@@ -30,16 +33,154 @@ DAC_BIAS_VOLTAGE = 7
 #--------------------------------------------------------------------------------
 E_CHARGE = 1.60217646e-19
 
+ARCHIVE_SUFFIXES = (".tar", ".tar.gz", ".tgz", ".zip")
+
+# Bytes read from the start of a DOMCal result for the index header
+HEADER_BYTES = 512
+DOMCAL_DATE_FORMAT = "%m-%d-%Y %H:%M:%S"
+
+# Policies for choosing between several results for a DOM: vetted
+# results (in the calibration directory itself) first, then the newest;
+# or the newest, wherever it is
+POLICY_VETTED = "vetted"
+POLICY_NEWEST = "newest"
+POLICIES = (POLICY_VETTED, POLICY_NEWEST)
+
+HEADER_RE = dict([(k, re.compile(v)) for (k, v) in [
+    ("version", r'<domcal\s+version="([^"]*)"'),
+    ("date", r"<date>\s*([^<]*?)\s*</date>"),
+    ("time", r"<time>\s*([^<]*?)\s*</time>"),
+    ("domid", r"<domid>\s*([^<]*?)\s*</domid>"),
+    ("temperature", r"<temperature[^>]*>\s*([^<]*?)\s*</temperature>")]])
+
+def isCalibrationArchive(path):
+    """True if the path is a tar or zip archive of DOMCal results"""
+    return os.path.isfile(path) and path.endswith(ARCHIVE_SUFFIXES)
+
+def hasGlobMagic(pattern):
+    return re.search(r"[*?[]", pattern) is not None
+
+def splitMemberName(name):
+    """Split an archive member name into its directory (empty at the
+    top level) and base name"""
+    if "/" not in name:
+        return ("", name)
+    return tuple(name.rsplit("/", 1))
+
+class CalibrationArchive(object):
+    """
+    Index of the members of a .tar, .tar.gz or .zip archive of DOMCal
+    results, so that they can be read without unpacking the archive.
+    Member names are relative to the archive's top directory, if all
+    members share one.  Compressed tarballs are decompressed once into
+    a single temporary file to allow random access to members.
+    Members can be read from several threads.
+    """
+    def __init__(self, path):
+        import gzip
+        import shutil
+        import tarfile
+        import tempfile
+        import zipfile
+
+        self.path = path
+        self.members = {}
+        self.lock = threading.Lock()
+        if path.endswith(".zip"):
+            self.zip = zipfile.ZipFile(path)
+            self.tar = None
+            for info in self.zip.infolist():
+                if not info.filename.endswith("/"):
+                    self.members[info.filename] = info
+        else:
+            self.zip = None
+            if path.endswith(".tar"):
+                self.tar = tarfile.open(path, "r:")
+            else:
+                self.tmp = tempfile.TemporaryFile()
+                gz = gzip.open(path, "rb")
+                shutil.copyfileobj(gz, self.tmp)
+                gz.close()
+                self.tmp.seek(0)
+                self.tar = tarfile.open(fileobj=self.tmp, mode="r:")
+            for info in self.tar.getmembers():
+                if info.isfile():
+                    self.members[info.name] = info
+
+        # Strip a common top directory
+        tops = set([name.split("/", 1)[0] for name in self.members])
+        if (len(tops) == 1) and all(["/" in name for name in self.members]):
+            self.members = dict([(name.split("/", 1)[1], info)
+                                 for (name, info) in self.members.items()])
+
+        # Member names by directory, for glob()
+        self.directories = {}
+        for name in self.members:
+            self.directories.setdefault(splitMemberName(name)[0], []).append(name)
+
+    def glob(self, pattern):
+        """Member names matching a glob pattern; as for glob.glob,
+        wildcards do not match across directories"""
+        if not hasGlobMagic(pattern):
+            return [pattern] if pattern in self.members else []
+        (dirPattern, basePattern) = splitMemberName(pattern)
+        if hasGlobMagic(dirPattern):
+            depth = dirPattern.count("/")
+            dirs = [d for d in self.directories
+                    if d and (d.count("/") == depth) and fnmatch.fnmatchcase(d, dirPattern)]
+        else:
+            dirs = [dirPattern]
+        return [name for d in dirs for name in self.directories.get(d, [])
+                if fnmatch.fnmatchcase(splitMemberName(name)[1], basePattern)]
+
+    def open(self, name):
+        """Open a member for reading"""
+        info = self.members[name]
+        # Read the whole member at once, since threads share the
+        # archive's file offset
+        with self.lock:
+            if self.zip is not None:
+                f = self.zip.open(info)
+            else:
+                f = self.tar.extractfile(info)
+            data = f.read()
+            f.close()
+        return BytesIO(data)
+
+# Archives are indexed once per process; forked processes must not
+# share the open archive, since they would share its file offset
+archiveCache = {}
+archiveCacheLock = threading.Lock()
+
+def openCalibrationArchive(path):
+    key = (os.path.abspath(path), os.getpid())
+    with archiveCacheLock:
+        if key not in archiveCache:
+            archiveCache[key] = CalibrationArchive(path)
+        return archiveCache[key]
+
 class CalibrationResults(object):
     """Object collecting DOMCal XML calibration results"""
 
     # FIX ME better finding
-    def __init__(self, directory, filter="*/domcal*.xml"):
+    def __init__(self, directory, filter="*/domcal*.xml", diagnostics=None):
+        from lxml import etree
+
         self.path = directory
         self.cal = {}
+        # Fit parameters already pulled out of the results
+        self.fits = {}
+        # Problems with the results are printed unless collected here
+        self.diagnostics = diagnostics
         
-        # Look for all the calibration results in the directory
-        calList = glob.glob(self.path+"/"+filter)
+        # Look for all the calibration results in the directory,
+        # or in the archive of results
+        archive = None
+        if isCalibrationArchive(directory):
+            archive = openCalibrationArchive(directory)
+            calList = archive.glob(filter)
+        else:
+            calList = glob.glob(self.path+"/"+filter)
         if not calList:
             # print >> sys.stderr, "No calibration results found in",directory
             return
@@ -54,7 +195,12 @@ class CalibrationResults(object):
 
             try:
                 parser = etree.XMLParser(remove_comments=False, remove_pis=False)
-                tree = etree.parse(filename, parser=parser)                
+                if archive is not None:
+                    f = archive.open(filename)
+                    tree = etree.parse(f, parser=parser)
+                    f.close()
+                else:
+                    tree = etree.parse(filename, parser=parser)                
             except:
                 print("WARNING: error parsing file",filename,", skipping",
                       file=sys.stderr)
@@ -82,6 +228,14 @@ class CalibrationResults(object):
                         str += repr(gchild.tag)+repr(gchild.attrib)+repr(gchild.text)+"\n"
         return str
 
+    def problem(self, mbid, category, *lines):
+        """Report a problem with the calibration results for a DOM"""
+        if self.diagnostics is not None:
+            self.diagnostics.add(mbid, category, "; ".join(lines))
+        else:
+            for line in lines:
+                print(line, file=sys.stderr)
+
     def exists(self, mbid):
         return (self.cal is not None) and (mbid in self.cal)
     
@@ -90,7 +244,8 @@ class CalibrationResults(object):
             return 0.
         hvGainCal = self.getFitCal(mbid, 'hvGainCal')
         if hvGainCal is None:
-            print("Missing HV/gain calibration for MBID",mbid, file=sys.stderr)
+            self.problem(mbid, "missing HV/gain calibration",
+                         "Missing HV/gain calibration for MBID %s" % mbid)
             return -1
         (b, m) = hvGainCal
         return math.pow(10., m*math.log10(hv) + b)
@@ -103,7 +258,8 @@ class CalibrationResults(object):
             filters = [['id', str(atwd)], ['channel', str(ch)], ['bin', str(bin)]]
             atwdCal = self.getFitCal(mbid, 'atwd', filters=filters)
             if atwdCal is None:
-                print("Missing ATWD calibration for MBID",mbid, file=sys.stderr)
+                self.problem(mbid, "missing ATWD calibration",
+                             "Missing ATWD calibration for MBID %s" % mbid)
                 return DEFAULT_BASELINE
             (b, m) = atwdCal            
             baseline += (vBias-b)/m
@@ -115,7 +271,8 @@ class CalibrationResults(object):
             return 0
         hvGainCal = self.getFitCal(mbid, 'hvGainCal')
         if hvGainCal is None:
-            print("Missing HV/gain calibration for MBID",mbid, file=sys.stderr)
+            self.problem(mbid, "missing HV/gain calibration",
+                         "Missing HV/gain calibration for MBID %s" % mbid)
             return DEFAULT_HV_SETTING
         (b, m) = hvGainCal
         hv = math.pow(10., (math.log10(gain) - b) / m)
@@ -127,21 +284,24 @@ class CalibrationResults(object):
         # Non-HV discriminator calibration is fallback
         speDiscCal = self.getFitCal(mbid, 'discriminator', filters=[['id', 'spe']])
         if speDiscCal is None:
-            print("No valid discriminator calibration found!", file=sys.stderr)
+            self.problem(mbid, "missing discriminator calibration",
+                         "No valid discriminator calibration found!")
             return DEFAULT_SPE_SETTING            
         else:
             (b, m) = speDiscCal
         # Use PMT discriminator calibration if it exists and is OK
         pmtDiscCal = self.getFitCal(mbid, 'pmtDiscCal')
         if pmtDiscCal is None:
-            print("Missing PMT discriminator setting for MBID",mbid, file=sys.stderr)
-            print("WARNING: falling back to pulser discriminator calibration", file=sys.stderr)
+            self.problem(mbid, "PMT discriminator fallback",
+                         "Missing PMT discriminator setting for MBID %s" % mbid,
+                         "WARNING: falling back to pulser discriminator calibration")
         else:
             (b1, m1) = pmtDiscCal
             # DOMCal 7.6.0 had a bug that resulted in garbage here if the HV was off
             if math.isnan(b1) or math.isnan(m1) or (b1 > 0) or (m1 < 0):
-                print("Bad PMT discriminator setting for MBID",mbid, file=sys.stderr)
-                print("WARNING: falling back to pulser discriminator calibration", file=sys.stderr)
+                self.problem(mbid, "PMT discriminator fallback",
+                             "Bad PMT discriminator setting for MBID %s" % mbid,
+                             "WARNING: falling back to pulser discriminator calibration")
             else:
                 (b, m) = (b1, m1)
         return int(((gain * speFrac * E_CHARGE * 1e12 - b) / m) + 0.5)
@@ -152,43 +312,58 @@ class CalibrationResults(object):
             return 0
         pmtDiscCal = self.getFitCal(mbid, 'pmtDiscCal')
         if pmtDiscCal is None:
-            print("Missing PMT discriminator setting for MBID",mbid, file=sys.stderr)
+            self.problem(mbid, "missing PMT discriminator calibration",
+                         "Missing PMT discriminator setting for MBID %s" % mbid)
             return DEFAULT_SPE_SETTING
         (b, m) = pmtDiscCal
         # DOMCal 7.6.0 had a bug that resulted in garbage here if the HV was off
         if math.isnan(b) or math.isnan(m) or (b > 0) or (m < 0):            
-            print("Bad PMT discriminator setting for MBID",mbid, file=sys.stderr)
+            self.problem(mbid, "bad PMT discriminator calibration",
+                         "Bad PMT discriminator setting for MBID %s" % mbid)
             return DEFAULT_SPE_SETTING
         return (m * speDisc + b) / (gain * E_CHARGE * 1e12)
     
     def getATWDFreqSetting(self, mbid, atwd, freq):
         freqCal = self.getFitCal(mbid, 'atwdfreq', [['atwd', str(atwd)]])
         if freqCal is None:
-            print("Bad ATWD frequency calibration for MBID",mbid,"chip",atwd, file=sys.stderr)
+            self.problem(mbid, "bad ATWD frequency calibration",
+                         "Bad ATWD frequency calibration for MBID %s chip %s" % (mbid, atwd))
             return DEFAULT_FREQ_SETTING
         (c0, c1, c2) = freqCal
         try:
             bias = int((-c1 + math.sqrt(c1*c1 - 4*(c0-freq)*c2))/(2*c2) + 0.5)
         except ValueError:
-            print("Bad ATWD frequency calibration for MBID",mbid,"chip",atwd, file=sys.stderr)
+            self.problem(mbid, "bad ATWD frequency calibration",
+                         "Bad ATWD frequency calibration for MBID %s chip %s" % (mbid, atwd))
             return DEFAULT_FREQ_SETTING
         return bias
 
     def getATWDFreq(self, mbid, atwd, bias):
         freqCal = self.getFitCal(mbid, 'atwdfreq', [['atwd', str(atwd)]])
         if freqCal is None:
-            print("Bad ATWD frequency calibration for MBID",mbid,"chip",atwd, file=sys.stderr)
+            self.problem(mbid, "bad ATWD frequency calibration",
+                         "Bad ATWD frequency calibration for MBID %s chip %s" % (mbid, atwd))
             return None
         (c0, c1, c2) = freqCal
         try:
             freq_mhz = c2*bias*bias + c1*bias + c0
         except ValueError:
-            print("Bad ATWD frequency calibration for MBID",mbid,"chip",atwd, file=sys.stderr)
+            self.problem(mbid, "bad ATWD frequency calibration",
+                         "Bad ATWD frequency calibration for MBID %s chip %s" % (mbid, atwd))
             return None
         return freq_mhz
 
     # FIX ME this is awful; clean it up
     def getFitCal(self, mbid, name, filters=None):
+        key = (mbid, name, filters and tuple([tuple(f) for f in filters]))
+        if key not in self.fits:
+            self.fits[key] = self.findFitCal(mbid, name, filters)
+        fitParams = self.fits[key]
+        if fitParams is not None:
+            fitParams = list(fitParams)
+        return fitParams
+
+    def findFitCal(self, mbid, name, filters=None):
         fit = None
         fitParams = None
         passFilt = False
@@ -256,6 +431,149 @@ class CalibrationResults(object):
                 delta_t = float(d.text)
         return delta_t
 
+def readCalibrationHeader(f):
+    """
+    Extract the DOMCal version, date, time, DOM ID and temperature from
+    the start of a DOMCal result file, without parsing the file.  The
+    date and time are combined into a timestamp tuple (None if absent
+    or not understood).
+    """
+    data = f.read(HEADER_BYTES)
+    if not isinstance(data, str):
+        data = data.decode("utf-8", "replace")
+    header = {}
+    for key in HEADER_RE:
+        m = HEADER_RE[key].search(data)
+        header[key] = m and m.group(1)
+    header["timestamp"] = None
+    if header["date"] and header["time"]:
+        try:
+            header["timestamp"] = tuple(time.strptime(
+                "%s %s" % (header["date"], header["time"]), DOMCAL_DATE_FORMAT)[:6])
+        except ValueError:
+            pass
+    return header
+
+# Headers of DOMCal results already read, by path (for archives, the
+# archive path joined to the member name), with the (mtime, size) of
+# the file they were read from, so that an index only reads the
+# headers of new or changed results
+headerCache = {}
+headerCacheLock = threading.Lock()
+
+# Header of a result that couldn't be read, which sorts last
+EMPTY_HEADER = dict([(k, None) for k in HEADER_RE] + [("timestamp", None)])
+
+class CalibrationIndex(object):
+    """
+    Index of the DOMCal results in a calibration directory or archive,
+    choosing one result for each DOM under a policy (see POLICIES) when
+    there are several, from the headers of the result files.  Headers
+    are only read for DOMs with several results, and only again if the
+    file has changed since it was last read.
+    """
+    def __init__(self, directory, policy=POLICY_VETTED):
+        if policy not in POLICIES:
+            raise ValueError("unknown calibration policy %s" % policy)
+        self.directory = directory
+        self.policy = policy
+        # mbid -> list of entries, with the relative file name and
+        # whether the result is vetted, and the header once read
+        self.entries = {}
+
+        self.archive = None
+        if isCalibrationArchive(directory):
+            self.archive = openCalibrationArchive(directory)
+        for filter in ("domcal_*.xml", "*/domcal_*.xml"):
+            if self.archive is not None:
+                calList = self.archive.glob(filter)
+            else:
+                calList = [os.path.relpath(f, directory) for f in
+                           glob.glob(os.path.join(directory, filter))]
+            for name in calList:
+                m = re.match(r".*domcal_([0-9a-f]+)\.xml", name)
+                if m:
+                    self.entries.setdefault(m.group(1), []).append(
+                        {"name": name, "vetted": ("/" not in name)})
+
+    def readHeader(self, entry):
+        """Add the header of a result to its entry"""
+        if "timestamp" in entry:
+            return
+        path = os.path.join(os.path.abspath(self.directory), entry["name"])
+        try:
+            if self.archive is not None:
+                st = os.stat(self.directory)
+            else:
+                st = os.stat(path)
+            stats = (st.st_mtime, st.st_size)
+            with headerCacheLock:
+                cached = headerCache.get(path)
+            if (cached is None) or (cached[0] != stats):
+                if self.archive is not None:
+                    f = self.archive.open(entry["name"])
+                else:
+                    f = open(path, "rb")
+                cached = (stats, readCalibrationHeader(f))
+                f.close()
+                with headerCacheLock:
+                    headerCache[path] = cached
+            entry.update(cached[1])
+        except (IOError, OSError):
+            entry.update(EMPTY_HEADER)
+
+    def getEntries(self, mbid):
+        """Entries of the results for a DOM, with their headers"""
+        entries = self.entries.get(mbid, [])
+        for entry in entries:
+            self.readHeader(entry)
+        return entries
+
+    def getCandidates(self, mbid):
+        """Entries of the results for a DOM, most preferred first"""
+        if len(self.entries.get(mbid, [])) < 2:
+            return list(self.entries.get(mbid, []))
+        def newest(h):
+            # Results without a usable date sort before all others
+            return (h["timestamp"] is not None, h["timestamp"] or ())
+        if self.policy == POLICY_NEWEST:
+            key = lambda h: (newest(h), h["vetted"], h["name"])
+        else:
+            key = lambda h: (h["vetted"], newest(h), h["name"])
+        return sorted(self.getEntries(mbid), key=key, reverse=True)
+
+    def choose(self, mbid):
+        """Entry of the preferred result for a DOM, or None"""
+        if self.policy == POLICY_VETTED:
+            # There is at most one vetted result for a DOM
+            for entry in self.entries.get(mbid, []):
+                if entry["vetted"]:
+                    return entry
+        candidates = self.getCandidates(mbid)
+        return candidates and candidates[0] or None
+
+    def getFile(self, mbid):
+        """Relative name of the preferred result for a DOM, or None"""
+        entry = self.choose(mbid)
+        return entry and entry["name"]
+
+    def getFiles(self):
+        """Map mainboard IDs to the paths of their preferred results"""
+        return dict([(mbid, os.path.join(self.directory, self.getFile(mbid)))
+                     for mbid in self.entries])
+
+def findCalibrationFiles(directory, policy=POLICY_VETTED):
+    """
+    Map mainboard IDs to DOMCal result files in a calibration directory
+    or archive.  By default vetted results in the directory itself take
+    precedence over those in a subdirectory, and otherwise the newest
+    result is chosen (see CalibrationIndex).  For archives the file
+    names are the member names joined to the archive path.  Only the
+    headers of new or changed results for DOMs with several results
+    are read, so this is cheap to call repeatedly.
+    """
+    return CalibrationIndex(directory, policy).getFiles()
+
 # FIX ME turn into tests
 if __name__ == "__main__":
     TESTDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ic86/test")
@@ -0,0 +1,702 @@
+#!/usr/bin/env python
+#
+# checkEquivalence.py
+#
+# Run updateCalibration by its reference code path and by each of the
+# faster paths on the same inputs, and check that they write the same
+# configuration files and calupdate.txt values as the original code,
+# saved as golden outputs in ic86/golden.  The inputs are the DOMCal
+# results in ic86/test and a synthetic set for the whole detector, or
+# for some of its strings or a given run configuration and calibration
+# directory, which have no golden outputs and are checked against the
+# reference path instead, including the per-DOM results.  The elapsed
+# time and speedup of each path are reported along with any
+# differences.
+#
+
+from __future__ import print_function
+from builtins import str
+from builtins import range
+import sys
+import getopt
+import os
+import re
+import glob
+import json
+import time
+import random
+import shlex
+import shutil
+import filecmp
+import tempfile
+import subprocess
+from collections import OrderedDict
+
+from runConfig import RunConfig, parseIntList
+from nicknames import nicknames
+from geometry import Geometry, N_STRINGS, N_INICE_POSITIONS
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+UPDATE_SCRIPT = os.path.join(DIRECTORY, "updateCalibration.py")
+MATERIALIZE_SCRIPT = os.path.join(DIRECTORY, "materializeConfig.py")
+FIXTURE_DIR = os.path.join(DIRECTORY, "ic86/test")
+
+# Files written by the original code for each input, by input name,
+# without extra options (see -g)
+GOLDEN_DIR = os.path.join(DIRECTORY, "ic86/golden")
+
+# Name and version of the configurations written by each path
+NEW_NAME = "sps-equiv"
+NEW_DOMCFG_NAME = "equiv"
+NEW_VERSION = 2
+
+# Per-DOM results and setting changes written by each path
+RECORD_FILE = "records.ndjson"
+OUTPUT_FILE = "calupdate.txt"
+
+# Number of shards run in parallel by the sharded path
+N_SHARDS = 4
+
+# Synthetic inputs: seed, and fractions of DOMs without results, with
+# bad PMT discriminator calibrations (so the pulser discriminator
+# calibration is used), and with a second, newer result in a
+# subdirectory (so the result policy matters)
+SEED = 1
+MISSING_FRACTION = 0.02
+BAD_PMTDISC_FRACTION = 0.05
+DUPLICATE_FRACTION = 0.05
+DUPLICATE_DIR = "unvetted"
+
+# Relative changes of the fixture calibrations in the synthetic results
+PERTURBATIONS = [("<hvGainCal>", "slope", 0.005),
+                 ("<pmtDiscCal", "slope", 0.03),
+                 ('<discriminator id="spe">', "slope", 0.03),
+                 ('<atwdfreq atwd="0">', "c0", 0.05),
+                 ('<atwdfreq atwd="1">', "c0", 0.05)]
+
+# Number of DOMs or files with differences listed for each path
+N_LISTED = 10
+
+def usage():
+    """ Print program usage """
+    print("Usage: %s [-hfk] [-p path,...] [-s strings] [-r runs] [-n N]" % (sys.argv[0]), \
+          "[-x options] [-w work_dir] [-g script] [run_config.xml calibration_dir]")
+    print("    -h       print this help message")
+    print("    -f       only check the ic86/test fixtures, not the synthetic results")
+    print("    -k       keep the temporary work directory with the inputs and outputs")
+    print("    -p list  paths to check besides the reference path (default all)")
+    print("    -s list  strings of the synthetic results (default 1-%d)" % N_STRINGS)
+    print("    -r runs  time each path this many times (the fastest is reported)")
+    print("    -n N     list at most N differences for each path (default %d)" % N_LISTED)
+    print("    -x opts  more updateCalibration options for every path (e.g. '-i -r 5000')")
+    print("    -w dir   work directory, which is kept (default a temporary directory)")
+    print("    -g file  first save the outputs of this updateCalibration.py, from a")
+    print("             checkout of the original code, as the golden outputs")
+    print("Given a run configuration and calibration directory, only they are checked.")
+    print("Outputs are compared with the golden outputs in %s, except with -s" % GOLDEN_DIR)
+    print("or -x or a given configuration, when they are compared with the reference path.")
+    print("Paths:")
+    for (name, description, stages) in PATHS:
+        print("    %-10s %s" % (name, description))
+    print("Exits with status 1 if any path differs.")
+
+#-----------------------------------------------------
+# Code paths: each gives the stages of script runs (updateCalibration
+# unless another script is given first), where the runs of a stage are
+# made in parallel
+
+def getOutputOptions():
+    return ["-s", "-v", str(NEW_VERSION), "-n", NEW_NAME, "-c", NEW_DOMCFG_NAME,
+            "-o", RECORD_FILE]
+
+def getGoldenOptions():
+    # The original code doesn't write per-DOM results
+    return ["-s", "-v", str(NEW_VERSION), "-n", NEW_NAME, "-c", NEW_DOMCFG_NAME]
+
+def referenceStages(case, cfgFile, options):
+    return [[["-p", "0"] + options + getOutputOptions() + [cfgFile, case["calDir"]]]]
+
+def prefetchStages(case, cfgFile, options):
+    return [[options + getOutputOptions() + [cfgFile, case["calDir"]]]]
+
+def archiveStages(case, cfgFile, options):
+    return [[options + getOutputOptions() + [cfgFile, getArchive(case)]]]
+
+def shardedStages(case, cfgFile, options):
+    hubs = case["hubs"]
+    size = (len(hubs) + N_SHARDS - 1)//N_SHARDS
+    groups = [hubs[i:i+size] for i in range(0, len(hubs), size)]
+    shardFiles = ["shard%d.json" % i for i in range(len(groups))]
+    shards = [options + ["--hubs", ",".join(group), "--shard", shardFile,
+                         cfgFile, case["calDir"]]
+              for (group, shardFile) in zip(groups, shardFiles)]
+    return [shards, [["--merge"] + getOutputOptions() + [cfgFile] + shardFiles]]
+
+def deltaStages(case, cfgFile, options):
+    newFile = os.path.join(os.path.dirname(cfgFile), "%s-V%d.xml" % (NEW_NAME, NEW_VERSION))
+    return [[["-D"] + options + getOutputOptions() + [cfgFile, case["calDir"]]],
+            [[MATERIALIZE_SCRIPT, newFile]]]
+
+PATHS = [
+    ("reference", "read each DOM's results when it is updated (-p 0)", referenceStages),
+    ("prefetch",  "read results ahead in threads (default -p)",         prefetchStages),
+    ("archive",   "read results from a .tar.gz archive",                archiveStages),
+    ("sharded",   "%d shards of the hubs in parallel, then --merge" % N_SHARDS,
+     shardedStages),
+    ("delta",     "store setting deltas (-D), then write them out with materializeConfig",
+     deltaStages),
+    ]
+
+def getArchive(case):
+    """A .tar.gz archive of the calibration results of an input, made once"""
+    import tarfile
+    archive = os.path.join(case["dir"], "calibration.tar.gz")
+    if not os.path.exists(archive):
+        tar = tarfile.open(archive, "w:gz")
+        tar.add(case["calDir"], arcname="calibration")
+        tar.close()
+    return archive
+
+def runStages(stages, runDir, script=UPDATE_SCRIPT):
+    """Run the stages of a path, returning the elapsed time"""
+    start = time.time()
+    for (i, stage) in enumerate(stages):
+        procs = []
+        for (j, args) in enumerate(stage):
+            if args[0] != MATERIALIZE_SCRIPT:
+                args = [script] + args
+            log = open(os.path.join(runDir, "run-%d-%d.log" % (i, j)), "w")
+            procs.append((subprocess.Popen([sys.executable] + args,
+                                           cwd=runDir, stdout=log,
+                                           stderr=subprocess.STDOUT), log, args[0]))
+        for (proc, log, script) in procs:
+            proc.wait()
+            log.close()
+            if proc.returncode != 0:
+                lines = open(log.name).read().strip().split("\n")
+                raise RuntimeError("%s exited with status %d: %s" % \
+                                   (os.path.basename(script), proc.returncode, lines[-1]))
+    return time.time() - start
+
+def runPath(case, path, options, nRuns):
+    """
+    Run a path on an input, each time on a fresh copy of the
+    configuration, returning the fastest elapsed time and the output
+    directory of the last run.
+    """
+    (name, description, getStages) = path
+    outDir = os.path.join(case["dir"], name)
+    best = None
+    for i in range(nRuns):
+        if os.path.exists(outDir):
+            shutil.rmtree(outDir)
+        cfgDir = os.path.join(outDir, "cfg")
+        shutil.copytree(case["cfgDir"], cfgDir)
+        runDir = os.path.join(outDir, "run")
+        os.makedirs(runDir)
+        cfgFile = os.path.join(cfgDir, case["cfgFile"])
+        elapsed = runStages(getStages(case, cfgFile, options), runDir)
+        if (best is None) or (elapsed < best):
+            best = elapsed
+    return (best, outDir)
+
+#-----------------------------------------------------
+# Golden outputs
+
+def getGoldenArchive(case):
+    return os.path.join(GOLDEN_DIR, "%s.tar.gz" % case["name"])
+
+def writeGolden(case, script):
+    """
+    Run an updateCalibration script, such as one from a checkout of the
+    original code, on an input, and save the files it writes as the
+    golden outputs of the input.
+    """
+    import gzip
+    import tarfile
+    outDir = os.path.join(case["dir"], "original")
+    cfgDir = os.path.join(outDir, "cfg")
+    shutil.copytree(case["cfgDir"], cfgDir)
+    runDir = os.path.join(outDir, "run")
+    os.makedirs(runDir)
+    runStages([[getGoldenOptions() + [os.path.join(cfgDir, case["cfgFile"]),
+                                      case["calDir"]]]], runDir, script)
+
+    # Without times or owners, so that the same outputs give the same archive
+    def clean(info):
+        info.mtime = 0
+        (info.uid, info.gid, info.uname, info.gname) = (0, 0, "", "")
+        return info
+    if not os.path.isdir(GOLDEN_DIR):
+        os.makedirs(GOLDEN_DIR)
+    gz = gzip.GzipFile(getGoldenArchive(case), "wb", mtime=0)
+    tar = tarfile.open(fileobj=gz, mode="w")
+    for f in sorted(listFiles(cfgDir) - listFiles(case["cfgDir"])):
+        tar.add(os.path.join(cfgDir, f), arcname=os.path.join("cfg", f), filter=clean)
+    tar.add(os.path.join(runDir, OUTPUT_FILE), arcname=os.path.join("run", OUTPUT_FILE),
+            filter=clean)
+    tar.close()
+    gz.close()
+
+def getGolden(case):
+    """
+    An output directory with the configuration files of an input and
+    its golden outputs, or None if it has none.
+    """
+    import tarfile
+    archive = getGoldenArchive(case)
+    if not (case["golden"] and os.path.exists(archive)):
+        return None
+    goldenDir = os.path.join(case["dir"], "golden")
+    if not os.path.exists(goldenDir):
+        shutil.copytree(case["cfgDir"], os.path.join(goldenDir, "cfg"))
+        tar = tarfile.open(archive)
+        tar.extractall(goldenDir)
+        tar.close()
+    return goldenDir
+
+#-----------------------------------------------------
+# Inputs
+
+def getHub(string, dompos):
+    """Hub of a DOM in the generated configurations"""
+    if dompos <= N_INICE_POSITIONS:
+        return string
+    # Eight IceTop stations per hub
+    return 200 + (string-1)//8 + 1
+
+def getHubName(hub):
+    if hub >= 200:
+        return "%02dt" % (hub-200)
+    return "%02di" % hub
+
+def writeConfig(cfgDir, doms, nicks, rng):
+    """
+    Write a run configuration for a list of (mbid, string, position),
+    with a DOM configuration for each hub, returning the name of the
+    top-level file and the hubs.
+    """
+    hubDOMs = {}
+    for (mbid, string, dompos) in doms:
+        hubDOMs.setdefault(getHub(string, dompos), []).append((dompos, mbid))
+    os.makedirs(os.path.join(cfgDir, RunConfig.DOMPATH))
+    os.makedirs(os.path.join(cfgDir, RunConfig.TRIGPATH))
+
+    top = ['<?xml version="1.0" encoding="UTF-8"?>', '<runConfig>',
+           '  <%s>trigger</%s>' % (RunConfig.TRIGTAG, RunConfig.TRIGTAG)]
+    for hub in sorted(hubDOMs):
+        domName = "sps-%s-test-1" % getHubName(hub)
+        top.append('  <%s hubId="%d" %s="%s"/>' % \
+                   (RunConfig.STRINGHUB, hub, RunConfig.DOMATTRIB, domName))
+        lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+                 '<domConfigList configId="%s">' % domName]
+        for (dompos, mbid) in sorted(hubDOMs[hub]):
+            baselines = "".join(['<averagePedestal atwd="%s" ch="%d">%d</averagePedestal>' % \
+                                 (atwd, ch, 128 + rng.randint(-3, 3))
+                                 for atwd in "AB" for ch in range(3)])
+            lines.append('  <!-- %s -->' % nicks.getDOMName(mbid))
+            lines.append(('  <domConfig mbid="%s" name="%s"><format><deltaCompressed/></format>' +
+                          '<atwd0TriggerBias>%d</atwd0TriggerBias>' +
+                          '<atwd1TriggerBias>%d</atwd1TriggerBias>' +
+                          '<pmtHighVoltage>%d</pmtHighVoltage>' +
+                          '<speTriggerDiscriminator>%d</speTriggerDiscriminator>' +
+                          '<mpeTriggerDiscriminator>%d</mpeTriggerDiscriminator>' +
+                          '<pulserMode>%s</pulserMode><pulserRate>%d</pulserRate>' +
+                          '<pedestalSettings>%s</pedestalSettings></domConfig>') % \
+                         (mbid, nicks.getDOMName(mbid), 820 + rng.randint(0, 20),
+                          815 + rng.randint(0, 20), 2600 + rng.randint(-40, 40),
+                          565 + rng.randint(-8, 8), 665,
+                          (rng.random() < 0.95) and "beacon" or "none", 5, baselines))
+        lines.append('</domConfigList>')
+        f = open(os.path.join(cfgDir, RunConfig.DOMPATH, domName + ".xml"), "w")
+        f.write("\n".join(lines) + "\n")
+        f.close()
+    top.append('</runConfig>')
+
+    cfgFile = "sps-test.xml"
+    f = open(os.path.join(cfgDir, cfgFile), "w")
+    f.write("\n".join(top) + "\n")
+    f.close()
+    f = open(os.path.join(cfgDir, RunConfig.TRIGPATH, "trigger.xml"), "w")
+    f.write('<?xml version="1.0" encoding="UTF-8"?>\n<activeTriggers/>\n')
+    f.close()
+    return (cfgFile, [str(h) for h in sorted(hubDOMs)])
+
+def getFixtures():
+    """The ic86/test DOMCal results, by mainboard ID"""
+    fixtures = OrderedDict()
+    for filename in sorted(glob.glob(os.path.join(FIXTURE_DIR, "domcal_*.xml"))):
+        mbid = os.path.basename(filename)[len("domcal_"):-len(".xml")]
+        fixtures[mbid] = open(filename).read()
+    return fixtures
+
+def perturb(text, rng):
+    """Scale the fitted parameters in PERTURBATIONS of a DOMCal result"""
+    for (section, param, fraction) in PERTURBATIONS:
+        pattern = re.compile(r'(%s.*?<param name="%s">)([^<]*)(</param>)' % \
+                             (re.escape(section), param), re.DOTALL)
+        match = pattern.search(text)
+        if match is None:
+            continue
+        value = float(match.group(2)) * (1 + rng.uniform(-fraction, fraction))
+        text = text[:match.start(2)] + "%g" % value + text[match.end(2):]
+    return text
+
+def writeCalibrations(calDir, doms, fixtures, rng):
+    """Write synthetic DOMCal results, made from the fixtures, for the
+    DOMs; returns the number of DOMs with results"""
+    os.makedirs(os.path.join(calDir, DUPLICATE_DIR))
+    templates = list(fixtures.items())
+    nWritten = 0
+    for (mbid, string, dompos) in doms:
+        if rng.random() < MISSING_FRACTION:
+            continue
+        (templateMBID, template) = rng.choice(templates)
+        text = perturb(template.replace(templateMBID, mbid), rng)
+        if rng.random() < BAD_PMTDISC_FRACTION:
+            text = re.sub(r'(<pmtDiscCal.*?<param name="slope">)[^<]*', r'\1nan',
+                          text, count=1, flags=re.DOTALL)
+        f = open(os.path.join(calDir, "domcal_%s.xml" % mbid), "w")
+        f.write(text)
+        f.close()
+        nWritten += 1
+        if rng.random() < DUPLICATE_FRACTION:
+            text = re.sub(r'<date>[^<]*</date>', '<date>1-1-2030</date>',
+                          perturb(text, rng), count=1)
+            f = open(os.path.join(calDir, DUPLICATE_DIR, "domcal_%s.xml" % mbid), "w")
+            f.write(text)
+            f.close()
+    return nWritten
+
+def makeFixtureInput(workDir, nicks):
+    """The ic86/test results, with a configuration of their DOMs"""
+    rng = random.Random(SEED)
+    caseDir = os.path.join(workDir, "fixtures")
+    doms = []
+    for mbid in getFixtures():
+        pos = nicks.getDOMPosition(mbid)
+        if pos is not None:
+            doms.append((mbid, pos[0], pos[1]))
+    (cfgFile, hubs) = writeConfig(os.path.join(caseDir, "input"), doms, nicks, rng)
+    return {"name": "fixtures", "dir": caseDir, "cfgDir": os.path.join(caseDir, "input"),
+            "cfgFile": cfgFile, "calDir": FIXTURE_DIR, "hubs": hubs, "golden": True,
+            "description": "%d DOMs, results in %s" % (len(doms), FIXTURE_DIR)}
+
+def makeSyntheticInput(workDir, nicks, strings):
+    """Synthetic results and configuration for the DOMs on some strings"""
+    rng = random.Random(SEED)
+    caseDir = os.path.join(workDir, "synthetic")
+    geometry = Geometry(nicks)
+    doms = [(geometry.getMBID(string, dompos), string, dompos)
+            for (string, dompos) in geometry.getDeployedPositions()
+            if (string in strings) and (geometry.getMBID(string, dompos) is not None)]
+    (cfgFile, hubs) = writeConfig(os.path.join(caseDir, "input"), doms, nicks, rng)
+    calDir = os.path.join(caseDir, "calibration")
+    nResults = writeCalibrations(calDir, doms, getFixtures(), rng)
+    # The golden outputs are for the whole detector
+    golden = (set(strings) == set(range(1, N_STRINGS+1)))
+    return {"name": "synthetic", "dir": caseDir, "cfgDir": os.path.join(caseDir, "input"),
+            "cfgFile": cfgFile, "calDir": calDir, "hubs": hubs, "golden": golden,
+            "description": "%d DOMs, %d with results" % (len(doms), nResults)}
+
+def makeGivenInput(workDir, cfgName, calDir):
+    """A copy of the files of a run configuration, and its results"""
+    caseDir = os.path.join(workDir, "given")
+    cfgDir = os.path.join(caseDir, "input")
+    srcDir = os.path.dirname(os.path.abspath(cfgName))
+    rc = RunConfig(cfgName, readOnly=True, settings=[])
+    hubs = rc.getHubs()
+    for filename in rc.getFiles():
+        dest = os.path.join(cfgDir, os.path.relpath(os.path.abspath(filename), srcDir))
+        if not os.path.isdir(os.path.dirname(dest)):
+            os.makedirs(os.path.dirname(dest))
+        shutil.copy2(filename, dest)
+    return {"name": os.path.basename(cfgName), "dir": caseDir, "cfgDir": cfgDir,
+            "cfgFile": os.path.basename(cfgName), "calDir": os.path.abspath(calDir),
+            "hubs": sorted(hubs, key=int), "golden": False,
+            "description": "%d hubs, results in %s" % (len(hubs), calDir)}
+
+#-----------------------------------------------------
+# Comparison of the outputs of two paths
+
+def listFiles(directory):
+    """Files in a configuration directory, except for stored deltas"""
+    files = []
+    for (dirpath, dirnames, filenames) in os.walk(directory):
+        if RunConfig.DELTAPATH in dirnames:
+            dirnames.remove(RunConfig.DELTAPATH)
+        files.extend([os.path.relpath(os.path.join(dirpath, f), directory)
+                      for f in filenames])
+    return set(files)
+
+def compareFiles(refDir, candDir):
+    """Configuration and output files that are missing, extra or differ"""
+    problems = []
+    refFiles = listFiles(os.path.join(refDir, "cfg"))
+    candFiles = listFiles(os.path.join(candDir, "cfg"))
+    # The golden outputs have no per-DOM results
+    paths = [os.path.join("cfg", f) for f in sorted(refFiles | candFiles)] + \
+            [os.path.join("run", f) for f in (OUTPUT_FILE, RECORD_FILE)
+             if (f != RECORD_FILE) or os.path.exists(os.path.join(refDir, "run", f))]
+    for path in paths:
+        (ref, cand) = (os.path.join(refDir, path), os.path.join(candDir, path))
+        if not os.path.exists(cand):
+            if os.path.exists(ref):
+                problems.append("%s not written" % path)
+        elif not os.path.exists(ref):
+            problems.append("%s not written by the reference path" % path)
+        elif not filecmp.cmp(ref, cand, shallow=False):
+            problems.append("%s differs" % path)
+    return problems
+
+def readRecords(filename):
+    records = OrderedDict()
+    if os.path.exists(filename):
+        for line in open(filename):
+            record = json.loads(line)
+            records[record["mbid"]] = record
+    return records
+
+def compareDOMs(refDir, candDir):
+    """
+    Differences in the written settings and baselines and in the
+    per-DOM results of each DOM, as a dictionary of lists of
+    descriptions by mainboard ID.
+    """
+    problems = OrderedDict()
+    def add(mbid, problem):
+        problems.setdefault(mbid, []).append(problem)
+
+    newFile = os.path.join("cfg", "%s-V%d.xml" % (NEW_NAME, NEW_VERSION))
+    (ref, cand) = (os.path.join(refDir, newFile), os.path.join(candDir, newFile))
+    if os.path.exists(ref) and os.path.exists(cand):
+        (refRC, candRC) = (RunConfig(ref, readOnly=True), RunConfig(cand, readOnly=True))
+        diff = refRC.compare(candRC)
+        for mbid in diff["removed"]:
+            add(mbid, "not in written configuration")
+        for mbid in diff["added"]:
+            add(mbid, "not in reference configuration")
+        for (mbid, changed) in diff["changed"].items():
+            for setting in sorted(changed):
+                add(mbid, "%s %s != %s" % (setting, changed[setting][0], changed[setting][1]))
+        for mbid in refRC.getDOMs():
+            candCfg = candRC.getDOMConfig(mbid)
+            if candCfg is None:
+                continue
+            (bl, candBl) = (refRC.getDOMConfig(mbid).getDOMBaselines(mbid),
+                            candCfg.getDOMBaselines(mbid))
+            if bl != candBl:
+                add(mbid, "baselines %s != %s" % (bl, candBl))
+
+    if not os.path.exists(os.path.join(refDir, "run", RECORD_FILE)):
+        return problems
+    refRecords = readRecords(os.path.join(refDir, "run", RECORD_FILE))
+    candRecords = readRecords(os.path.join(candDir, "run", RECORD_FILE))
+    for mbid in refRecords:
+        if mbid not in candRecords:
+            add(mbid, "no result record")
+            continue
+        (record, candRecord) = (refRecords[mbid], candRecords[mbid])
+        for key in sorted(set(record) | set(candRecord)):
+            if record.get(key) != candRecord.get(key):
+                add(mbid, "result %s %s != %s" % (key, record.get(key), candRecord.get(key)))
+    for mbid in candRecords:
+        if mbid not in refRecords:
+            add(mbid, "result record not made by the reference path")
+    return problems
+
+def compareOutputs(refDir, candDir):
+    """Differences in the lists of setting changes in calupdate.txt"""
+    problems = []
+    (ref, cand) = (os.path.join(refDir, "run", OUTPUT_FILE),
+                   os.path.join(candDir, "run", OUTPUT_FILE))
+    if not (os.path.exists(ref) and os.path.exists(cand)):
+        return problems
+    (values, candValues) = (json.load(open(ref)), json.load(open(cand)))
+    for key in sorted(set(values) | set(candValues)):
+        (v, cv) = (values.get(key), candValues.get(key))
+        if v == cv:
+            continue
+        if (v is None) or (cv is None) or (len(v) != len(cv)):
+            problems.append("%s %s: %s values != %s" % \
+                            (OUTPUT_FILE, key, v and len(v), cv and len(cv)))
+            continue
+        differ = [i for i in range(len(v)) if v[i] != cv[i]]
+        problems.append("%s %s: %d of %d values differ, first %r != %r" % \
+                        (OUTPUT_FILE, key, len(differ), len(v), v[differ[0]],
+                         cv[differ[0]]))
+    return problems
+
+#-----------------------------------------------------
+
+def reportPath(name, elapsed, refTime, refDir, outDir, maxListed, nicks):
+    """Print the time and differences of a path's outputs from the
+    expected outputs; returns True if they differ"""
+    fileProblems = compareFiles(refDir, outDir)
+    domProblems = compareDOMs(refDir, outDir)
+    outputProblems = compareOutputs(refDir, outDir)
+    if fileProblems or domProblems or outputProblems:
+        summary = "%d files, %d DOMs" % (len(fileProblems), len(domProblems))
+    else:
+        summary = "none"
+    print("  %-10s %9.2f %8.2f  %s" % (name, elapsed, refTime/elapsed, summary))
+    for problem in (fileProblems + outputProblems)[:maxListed]:
+        print("        %s" % problem)
+    for mbid in list(domProblems.keys())[:maxListed]:
+        pos = nicks.getDOMPosition(mbid)
+        print("        %s %s %s: %s" % \
+              (mbid, pos and "%02d-%02d" % (pos[0], pos[1]) or "-",
+               nicks.getDOMName(mbid), "; ".join(domProblems[mbid])))
+    return summary != "none"
+
+def checkInput(case, paths, options, nRuns, maxListed, nicks):
+    """Run the reference and candidate paths on an input and report the
+    differences from the golden outputs, or from the reference path if
+    there are none; returns the number of paths that differ"""
+    goldenDir = getGolden(case)
+    print("%s: %s" % (case["name"], case["description"]))
+    if goldenDir is not None:
+        print("  compared with %s" % os.path.relpath(getGoldenArchive(case), DIRECTORY))
+    else:
+        print("  no golden outputs, compared with the reference path")
+    print("  %-10s %9s %8s  %s" % ("path", "seconds", "speedup", "differences"))
+    nDiffer = 0
+    try:
+        (refTime, refDir) = runPath(case, PATHS[0], options, nRuns)
+    except RuntimeError as err:
+        print("ERROR: reference path failed on %s: %s" % (case["name"], str(err)))
+        sys.exit(-1)
+    if goldenDir is not None:
+        if reportPath(PATHS[0][0], refTime, refTime, goldenDir, refDir, maxListed, nicks):
+            nDiffer += 1
+        refDir = goldenDir
+    else:
+        print("  %-10s %9.2f %8.2f" % (PATHS[0][0], refTime, 1.))
+    for path in paths:
+        try:
+            (elapsed, outDir) = runPath(case, path, options, nRuns)
+        except RuntimeError as err:
+            print("  %-10s %9s %8s  failed: %s" % (path[0], "-", "-", str(err)))
+            nDiffer += 1
+            continue
+        if reportPath(path[0], elapsed, refTime, refDir, outDir, maxListed, nicks):
+            nDiffer += 1
+    return nDiffer
+
+def main():
+    """
+    Check that the code paths of updateCalibration write the same
+    configuration and results as the original code.
+    """
+    #---------------------------------------------------
+    # Parse command-line options
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hfkp:s:r:n:x:w:g:",
+                                   ["help", "fixtures", "keep", "paths=", "strings=",
+                                    "runs=", "number=", "options=", "work=", "golden="])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage()
+        sys.exit(2)
+
+    fixturesOnly = False
+    keep = False
+    pathNames = None
+    strings = list(range(1, N_STRINGS+1))
+    nRuns = 1
+    maxListed = N_LISTED
+    options = []
+    workDir = None
+    goldenScript = None
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-f", "--fixtures"):
+            fixturesOnly = True
+        elif o in ("-k", "--keep"):
+            keep = True
+        elif o in ("-p", "--paths"):
+            pathNames = [p.strip() for p in a.split(",") if p.strip()]
+        elif o in ("-s", "--strings"):
+            strings = parseIntList(a)
+        elif o in ("-r", "--runs"):
+            nRuns = int(a)
+        elif o in ("-n", "--number"):
+            maxListed = int(a)
+        elif o in ("-x", "--options"):
+            options = shlex.split(a)
+        elif o in ("-w", "--work"):
+            workDir = a
+        elif o in ("-g", "--golden"):
+            goldenScript = os.path.abspath(a)
+        else:
+            assert False, "unhandled option"
+
+    if len(args) not in (0, 2):
+        usage()
+        sys.exit(2)
+
+    paths = PATHS[1:]
+    if pathNames is not None:
+        names = [p[0] for p in paths]
+        for name in pathNames:
+            if name not in names:
+                print("ERROR: unknown path %s (known: %s)" % (name, ", ".join(names)))
+                sys.exit(-1)
+        paths = [p for p in paths if p[0] in pathNames]
+
+    if workDir is None:
+        workDir = tempfile.mkdtemp(prefix="checkEquivalence-")
+    elif os.path.exists(workDir) and os.listdir(workDir):
+        print("ERROR: work directory %s is not empty" % workDir)
+        sys.exit(-1)
+    else:
+        keep = True
+
+    nicks = nicknames()
+    if args:
+        (cfgName, calDir) = args
+        if not os.path.exists(calDir):
+            print("ERROR: calibration results %s not found" % calDir)
+            sys.exit(-1)
+        try:
+            inputs = [makeGivenInput(workDir, cfgName, calDir)]
+        except IOError:
+            print("ERROR: couldn't read configuration file %s, exiting." % cfgName)
+            sys.exit(-1)
+    else:
+        inputs = [makeFixtureInput(workDir, nicks)]
+        if not fixturesOnly:
+            inputs.append(makeSyntheticInput(workDir, nicks, set(strings)))
+
+    # The golden outputs are written without extra options
+    for case in inputs:
+        case["golden"] = case["golden"] and not options
+    if goldenScript is not None:
+        for case in inputs:
+            if not case["golden"]:
+                print("ERROR: no golden outputs are kept for %s with these options" % \
+                      case["name"])
+                sys.exit(-1)
+            try:
+                writeGolden(case, goldenScript)
+            except RuntimeError as err:
+                print("ERROR: couldn't write the golden outputs of %s: %s" % \
+                      (case["name"], str(err)))
+                sys.exit(-1)
+            print("Wrote %s" % getGoldenArchive(case))
+
+    nDiffer = 0
+    for case in inputs:
+        nDiffer += checkInput(case, paths, options, nRuns, maxListed, nicks)
+
+    if keep:
+        print("Inputs and outputs kept in %s" % workDir)
+    else:
+        shutil.rmtree(workDir)
+    if nDiffer:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+#
+# compareCalibration.py
+#
+# Compare two sets of DOMCal results at the settings of a run
+# configuration: gain at the configured HV, SPE threshold in PE at the
+# configured discriminator and ATWD sampling speed at the configured
+# trigger bias, with per-category drift statistics and the DOMs that
+# changed most.
+#
+
+from __future__ import print_function
+from builtins import str
+from builtins import range
+import sys
+import getopt
+import math
+
+from calibration import E_CHARGE, POLICIES, POLICY_VETTED
+from runConfig import RunConfig
+from nicknames import nicknames
+from geometry import Geometry
+from runningStats import RunningStats
+from updateCalibration import prefetchCalibrations, PREFETCH_DEPTH, \
+    WARN_MAX_GAIN_DIFF_PCT, WARN_SPE_DISC_CHANGE_PE, WARN_ATWD_FREQ_CHANGE_MHZ
+
+# Default number of DOMs listed with the largest drifts
+N_OUTLIERS = 20
+
+# Drifts compared: (name, column, tolerance used to rank DOMs,
+# histogram range and bins for the statistics)
+DRIFTS = [
+    ("gain drift (%)",          "gainDiffPct",  WARN_MAX_GAIN_DIFF_PCT,    -50., 50., 20),
+    ("SPE thresh. drift (PE)",  "threshDiff",   WARN_SPE_DISC_CHANGE_PE,   -0.2, 0.2, 20),
+    ("ATWD0 freq. drift (MHz)", "freq0Diff",    WARN_ATWD_FREQ_CHANGE_MHZ, -5.,  5.,  20),
+    ("ATWD1 freq. drift (MHz)", "freq1Diff",    WARN_ATWD_FREQ_CHANGE_MHZ, -5.,  5.,  20),
+    ]
+
+def usage():
+    """ Print program usage """
+    print("Usage: %s [-h] [-o report_file] [-n N] [-p depth]" % (sys.argv[0]), \
+          "[--policy vetted|newest] run_config.xml calibration_dir_a calibration_dir_b")
+    print("    -h       print this help message")
+    print("    -o file  write the comparison for every DOM to a file")
+    print("    -n N     list the N DOMs with the largest drifts (default %d)" % N_OUTLIERS)
+    print("    -p N     read calibration results for up to N DOMs ahead (default %d)" \
+          % PREFETCH_DEPTH)
+    print("    --policy p     choose between several results for a DOM (see updateCalibration.py)")
+    print("Drifts are from calibration_dir_a to calibration_dir_b, at the settings")
+    print("in run_config.xml.  DOMs are ranked by their largest drift relative to")
+    print("the updateCalibration.py warning limits.")
+
+def getFits(cal, mbid):
+    """The fit parameters used in the comparison, None where missing
+    or unusable"""
+    hvGain = cal.getFitCal(mbid, 'hvGainCal')
+    pmtDisc = cal.getFitCal(mbid, 'pmtDiscCal')
+    # DOMCal 7.6.0 had a bug that resulted in garbage here if the HV was off
+    if (pmtDisc is not None) and \
+       (math.isnan(pmtDisc[0]) or math.isnan(pmtDisc[1]) or
+        (pmtDisc[0] > 0) or (pmtDisc[1] < 0)):
+        pmtDisc = None
+    freq = []
+    for atwd in range(2):
+        f = cal.getFitCal(mbid, 'atwdfreq', [['atwd', str(atwd)]])
+        if (f is not None) and (None in f):
+            f = None
+        freq.append(f)
+    return {"hvGain": hvGain, "pmtDisc": pmtDisc, "freq": freq}
+
+def loadFits(calDir, mbids, policy=POLICY_VETTED, prefetch=PREFETCH_DEPTH):
+    """Fit parameters for each DOM with results in a calibration
+    directory; the parsed results themselves are not kept"""
+    fits = {}
+    for (mbid, cal) in prefetchCalibrations(calDir, mbids, depth=prefetch,
+                                            policy=policy):
+        if cal is not None:
+            fits[mbid] = getFits(cal, mbid)
+    return fits
+
+def getColumns(fits, hv, disc, bias):
+    """
+    Gain, SPE threshold and ATWD sampling speeds for lists of fits
+    and settings, computed column by column (None where unavailable).
+    hv is in volts; bias is a list of (ATWD0, ATWD1) trigger biases.
+    """
+    gain = [math.pow(10., f["hvGain"][1]*math.log10(v) + f["hvGain"][0])
+            if (f["hvGain"] is not None) and (v > 0) else None
+            for (f, v) in zip(fits, hv)]
+    thresh = [(f["pmtDisc"][1]*d + f["pmtDisc"][0])/(g*E_CHARGE*1e12)
+              if (f["pmtDisc"] is not None) and g else None
+              for (f, d, g) in zip(fits, disc, gain)]
+    columns = {"gain": gain, "thresh": thresh}
+    for atwd in range(2):
+        columns["freq%d" % atwd] = [
+            f["freq"][atwd][2]*b[atwd]*b[atwd] + f["freq"][atwd][1]*b[atwd] +
+            f["freq"][atwd][0] if f["freq"][atwd] is not None else None
+            for (f, b) in zip(fits, bias)]
+    return columns
+
+def diffColumns(a, b, relative=False):
+    """Differences (or relative differences in %) of two columns"""
+    if relative:
+        return [(y-x)/x*100. if (x is not None) and (y is not None) and x else None
+                for (x, y) in zip(a, b)]
+    return [y-x if (x is not None) and (y is not None) else None
+            for (x, y) in zip(a, b)]
+
+def getDriftScore(row):
+    """Largest drift of a DOM relative to the tolerance of each quantity"""
+    scores = [abs(row[column])/tolerance for (name, column, tolerance) in
+              [d[:3] for d in DRIFTS] if row[column] is not None]
+    if not scores:
+        return 0.
+    return max(scores)
+
+def formatValue(value, fmt):
+    if value is None:
+        return "-"
+    return fmt % value
+
+def formatRow(row, nicks):
+    pos = nicks.getDOMPosition(row["mbid"])
+    return "%-12s %-6s %-20s %-6s %11s %11s %8s %7s %7s %8s %8s %8s %6s" % \
+        (row["mbid"], pos and "%02d-%02d" % (pos[0], pos[1]) or "-",
+         nicks.getDOMName(row["mbid"]), row["category"],
+         formatValue(row["gainA"], "%.4g"), formatValue(row["gainB"], "%.4g"),
+         formatValue(row["gainDiffPct"], "%+.2f"),
+         formatValue(row["threshA"], "%.3f"), formatValue(row["threshB"], "%.3f"),
+         formatValue(row["threshDiff"], "%+.3f"),
+         formatValue(row["freq0Diff"], "%+.2f"), formatValue(row["freq1Diff"], "%+.2f"),
+         "%.2f" % row["score"])
+
+ROW_HEADER = "%-12s %-6s %-20s %-6s %11s %11s %8s %7s %7s %8s %8s %8s %6s" % \
+    ("mbid", "pos", "name", "cat", "gain A", "gain B", "gain %", "thr A",
+     "thr B", "thr PE", "ATWD0", "ATWD1", "score")
+
+def main():
+    """
+    Compare two sets of DOMCal results at the settings of a run
+    configuration.
+    """
+    #---------------------------------------------------
+    # Parse command-line options
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "ho:n:p:",
+                     ["help", "output=", "outliers=", "prefetch=", "policy="])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage()
+        sys.exit(2)
+
+    reportFile = None
+    nOutliers = N_OUTLIERS
+    prefetch = PREFETCH_DEPTH
+    policy = POLICY_VETTED
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-o", "--output"):
+            reportFile = a
+        elif o in ("-n", "--outliers"):
+            nOutliers = int(a)
+        elif o in ("-p", "--prefetch"):
+            prefetch = int(a)
+        elif o == "--policy":
+            if a not in POLICIES:
+                print("ERROR: unknown calibration policy", a)
+                sys.exit(2)
+            policy = a
+        else:
+            assert False, "unhandled option"
+
+    if len(args) != 3:
+        usage()
+        sys.exit(2)
+
+    (cfgName, calDirA, calDirB) = args
+    try:
+        rc = RunConfig(cfgName, readOnly=True, snapshot=True,
+                       settings=['pmtHighVoltage', 'speTriggerDiscriminator',
+                                 'atwd0TriggerBias', 'atwd1TriggerBias'])
+    except IOError:
+        print("ERROR: couldn't read configuration file %s, exiting." % cfgName)
+        sys.exit(-1)
+
+    nicks = nicknames()
+    geometry = Geometry(nicks)
+
+    mbids = rc.getDOMs()
+    fitsA = loadFits(calDirA, mbids, policy, prefetch)
+    fitsB = loadFits(calDirB, mbids, policy, prefetch)
+    both = [mbid for mbid in mbids if (mbid in fitsA) and (mbid in fitsB)]
+    print("%d DOMs in %s: %d with results in both sets, %d only in %s, %d only in %s" % \
+          (len(mbids), cfgName, len(both),
+           len([m for m in fitsA if m not in fitsB]), calDirA,
+           len([m for m in fitsB if m not in fitsA]), calDirB))
+
+    # Configured settings, as columns
+    settings = [rc.getDOMConfig(mbid).getDOMSettings(mbid) for mbid in both]
+    hv = [int(s['pmtHighVoltage'])/2. for s in settings]
+    disc = [int(s['speTriggerDiscriminator']) for s in settings]
+    bias = [(int(s['atwd0TriggerBias']), int(s['atwd1TriggerBias'])) for s in settings]
+
+    colA = getColumns([fitsA[mbid] for mbid in both], hv, disc, bias)
+    colB = getColumns([fitsB[mbid] for mbid in both], hv, disc, bias)
+    columns = {"mbid": both,
+               "category": [(geometry.getCategory(m) or ("-",))[0] for m in both],
+               "gainA": colA["gain"], "gainB": colB["gain"],
+               "gainDiffPct": diffColumns(colA["gain"], colB["gain"], relative=True),
+               "threshA": colA["thresh"], "threshB": colB["thresh"],
+               "threshDiff": diffColumns(colA["thresh"], colB["thresh"]),
+               "freq0Diff": diffColumns(colA["freq0"], colB["freq0"]),
+               "freq1Diff": diffColumns(colA["freq1"], colB["freq1"])}
+    rows = [dict([(k, columns[k][i]) for k in columns]) for i in range(len(both))]
+    for row in rows:
+        row["score"] = getDriftScore(row)
+
+    # Per-category drift statistics
+    stats = {}
+    for row in rows:
+        for drift in DRIFTS:
+            (name, column) = drift[:2]
+            if row[column] is None:
+                continue
+            key = (name, row["category"])
+            if key not in stats:
+                stats[key] = RunningStats(*drift[3:])
+            stats[key].add(row[column])
+    print("%-25s %-7s %5s %9s %9s %9s %9s %9s" % \
+          ("drift", "DOMs", "n", "mean", "std dev", "min", "median", "max"))
+    for (name, column) in [d[:2] for d in DRIFTS]:
+        for key in sorted([k for k in stats if k[0] == name]):
+            s = stats[key]
+            print("%-25s %-7s %5d %9.3f %9.3f %9.3f %9.3f %9.3f" % \
+                  (name, key[1], s.n, s.mean, s.getStdDev(), s.min,
+                   s.getQuantile(0.5), s.max))
+
+    ranked = sorted(rows, key=lambda r: -r["score"])
+    if nOutliers > 0:
+        print("-"*60)
+        print("%d DOMs with the largest drifts:" % min(nOutliers, len(ranked)))
+        print(ROW_HEADER)
+        for row in ranked[:nOutliers]:
+            print(formatRow(row, nicks))
+
+    if reportFile is not None:
+        f = open(reportFile, "w")
+        f.write("# %s\n" % ROW_HEADER)
+        for row in rows:
+            f.write("  %s\n" % formatRow(row, nicks))
+        f.close()
+        print("Wrote comparison for", len(rows), "DOMs to", reportFile)
+
+if __name__ == "__main__":
+    main()
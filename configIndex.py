@@ -0,0 +1,425 @@
+#!/usr/bin/env python
+#
+# configIndex.py
+#
+# Persistent index of the DOMs in every run configuration and DOM
+# configuration (hub) file of a configuration directory, with their
+# main settings, updated incrementally as files change.  Versions
+# stored as setting deltas (see materializeConfig.py) are indexed too.
+#
+
+from __future__ import print_function
+from builtins import str
+from builtins import object
+import sys
+import getopt
+import os
+import re
+import hashlib
+import pickle
+
+from runConfig import ReadOnlyDOMConfig, RunConfig, RunConfigException, SNAPSHOT_DIR, \
+    getDeltaFile, getHubEntry, isDeltaVersion, readDelta
+from nicknames import nicknames
+
+INDEX_VERSION = 2
+
+# Stats of versions stored as deltas, and of the DOM configurations
+# they change, start with this tag
+DELTA_TAG = "delta"
+
+# DOM settings kept in the index
+INDEX_SETTINGS = ['pmtHighVoltage', 'speTriggerDiscriminator', 'mpeTriggerDiscriminator',
+                  'atwd0TriggerBias', 'atwd1TriggerBias', 'pulserMode', 'pulserRate']
+
+def usage():
+    """ Print program usage """
+    print("Usage: %s [-hNa] [-f index_file] config_dir [command [args]]" % (sys.argv[0]))
+    print("    -h       print this help message")
+    print("    -N       don't check for changed files before answering")
+    print("    -a       list every configuration in a history, not just changes")
+    print("    -f file  index file (default in %s)" % SNAPSHOT_DIR)
+    print("Commands (dom can be specified by position, MBID, or name):")
+    print("    update                   update the index (the default)")
+    print("    configs dom              run configurations containing a DOM")
+    print("    excluded dom             run configurations not containing a DOM")
+    print("    history dom [setting]    changes of a setting (default pmtHighVoltage)")
+    print("                             over the run configurations")
+    print("Run configurations are ordered by name, with numbers (e.g. versions)")
+    print("compared numerically.  Versions stored as setting deltas are included.")
+
+def naturalKey(name):
+    """Sort key comparing the numbers in a name numerically"""
+    return [(int(t), "") if t.isdigit() else (-1, t) for t in re.split(r"(\d+)", name)]
+
+def getStat(filename):
+    st = os.stat(filename)
+    return (st.st_mtime, st.st_size)
+
+def isDeltaStat(stat):
+    return stat[0] == DELTA_TAG
+
+def readHubEntries(filename):
+    """
+    Return the (hub, DOM config name) entries of a run configuration,
+    following the parents of a version stored as deltas, without
+    reading any DOM configurations
+    """
+    from lxml import etree
+    if not isDeltaVersion(filename):
+        return [entry for entry in [getHubEntry(child)
+                                    for child in etree.parse(filename).getroot()]
+                if entry is not None]
+    (parent, hubDeltas) = readDelta(getDeltaFile(filename))
+    return [(hub, hubDeltas[hub][0] if hub in hubDeltas else domName)
+            for (hub, domName) in readHubEntries(os.path.join(os.path.dirname(filename),
+                                                              parent))]
+
+class ConfigIndex(object):
+    """
+    Run configurations and DOM configuration files of a configuration
+    directory, indexed by DOM, and saved between uses.  Only files that
+    are new or have changed since the last update are parsed.
+
+    A version stored as deltas is indexed with the DOM configurations
+    it changes, which exist only in its delta file, until it is written
+    out in full.
+    """
+    def __init__(self, configDir, indexFile=None):
+        self.configDir = os.path.abspath(configDir)
+        if indexFile is None:
+            digest = hashlib.md5(self.configDir.encode("utf-8")).hexdigest()
+            indexFile = os.path.join(SNAPSHOT_DIR, "index-%s.pickle" % digest[:12])
+        self.indexFile = indexFile
+        # DOM config name -> ((mtime, size), {mbid: settings}), with
+        # the settings as a tuple in the order of INDEX_SETTINGS; for
+        # DOM configurations changed by a version stored as deltas,
+        # the stat is (DELTA_TAG, run config name)
+        self.hubFiles = {}
+        # Run config name -> ((mtime, size), [(hub, DOM config name), ...]);
+        # for versions stored as deltas, the stat is (DELTA_TAG, mtime,
+        # size) of the delta file
+        self.runConfigs = {}
+        # mbid -> set of DOM config names; DOM config name -> set of
+        # (run config name, hub)
+        self.doms = {}
+        self.users = {}
+        # One copy of each distinct value, so that the index is
+        # smaller and faster to load (see share)
+        self.shared = None
+        self.load()
+
+    def load(self):
+        """Load the saved index, if it is for this directory"""
+        try:
+            f = open(self.indexFile, "rb")
+            try:
+                index = pickle.load(f)
+            finally:
+                f.close()
+        except Exception:
+            return False
+        if (not isinstance(index, dict)) or \
+           (index.get("version") != INDEX_VERSION) or \
+           (index.get("configDir") != self.configDir):
+            return False
+        (self.hubFiles, self.runConfigs) = (index["hubFiles"], index["runConfigs"])
+        (self.doms, self.users) = (index["doms"], index["users"])
+        return True
+
+    def save(self):
+        """Save the index; write and rename, so that readers never see
+        a partial file"""
+        import tempfile
+        index = {"version": INDEX_VERSION, "configDir": self.configDir,
+                 "hubFiles": self.hubFiles, "runConfigs": self.runConfigs,
+                 "doms": self.doms, "users": self.users}
+        indexDir = os.path.dirname(os.path.abspath(self.indexFile))
+        if not os.path.isdir(indexDir):
+            os.makedirs(indexDir)
+        (fd, tmpName) = tempfile.mkstemp(dir=indexDir)
+        f = os.fdopen(fd, "wb")
+        pickle.dump(index, f, pickle.HIGHEST_PROTOCOL)
+        f.close()
+        os.rename(tmpName, self.indexFile)
+
+    def listFiles(self, directory):
+        """Configuration names and (mtime, size) of the XML files in a
+        directory"""
+        files = {}
+        if not os.path.isdir(directory):
+            return files
+        for filename in os.listdir(directory):
+            if filename.endswith(".xml"):
+                path = os.path.join(directory, filename)
+                if os.path.isfile(path):
+                    files[filename[:-4]] = getStat(path)
+        return files
+
+    def listDeltaVersions(self):
+        """Configuration names and stats of the versions stored only as
+        deltas"""
+        files = {}
+        deltaDir = os.path.join(self.configDir, RunConfig.DELTAPATH)
+        for (name, stat) in self.listFiles(deltaDir).items():
+            if isDeltaVersion(os.path.join(self.configDir, name + ".xml")):
+                files[name] = (DELTA_TAG,) + stat
+        return files
+
+    def removeHubFile(self, domName):
+        (stat, doms) = self.hubFiles.pop(domName)
+        for mbid in doms:
+            self.doms[mbid].discard(domName)
+            if not self.doms[mbid]:
+                del self.doms[mbid]
+
+    def share(self, value):
+        """The copy of a value (string or settings tuple) already in the
+        index, if any"""
+        if self.shared is None:
+            self.shared = {}
+            for (stat, doms) in self.hubFiles.values():
+                for (mbid, settings) in doms.items():
+                    self.shared.setdefault(mbid, mbid)
+                    self.shared.setdefault(settings, settings)
+                    for v in settings:
+                        self.shared.setdefault(v, v)
+        return self.shared.setdefault(value, value)
+
+    def addHubFile(self, domName, stat):
+        from lxml import etree
+        filename = os.path.join(self.configDir, RunConfig.DOMPATH, domName + ".xml")
+        try:
+            domCfg = ReadOnlyDOMConfig(filename, INDEX_SETTINGS)
+            doms = dict([(self.share(mbid),
+                          self.share(tuple([self.share(settings.get(s))
+                                            for s in INDEX_SETTINGS])))
+                         for (mbid, settings) in domCfg.doms.items()])
+        except etree.XMLSyntaxError as err:
+            print("WARNING: couldn't parse %s: %s" % (filename, err))
+            doms = {}
+        self.hubFiles[domName] = (stat, doms)
+        for mbid in doms:
+            self.doms.setdefault(mbid, set()).add(domName)
+
+    def removeRunConfig(self, cfgName):
+        (stat, entries) = self.runConfigs.pop(cfgName)
+        for (hub, domName) in entries:
+            self.users[domName].discard((cfgName, hub))
+            if not self.users[domName]:
+                del self.users[domName]
+        if isDeltaStat(stat):
+            for domName in [name for (name, (hubStat, doms)) in self.hubFiles.items()
+                            if hubStat == (DELTA_TAG, cfgName)]:
+                self.removeHubFile(domName)
+
+    def addDeltaVersion(self, cfgName, stat):
+        """Index a version stored as deltas, with the DOM configurations
+        it changes that don't exist as files"""
+        from lxml import etree
+        filename = os.path.join(self.configDir, cfgName + ".xml")
+        entries = []
+        try:
+            (parent, hubDeltas) = readDelta(getDeltaFile(filename))
+            changed = [hub for hub in hubDeltas if hubDeltas[hub][0] not in self.hubFiles]
+            entries = readHubEntries(filename)
+            # Only the DOM configurations it changes are read
+            if changed:
+                rc = RunConfig(filename, readOnly=True, settings=INDEX_SETTINGS,
+                               hubs=changed)
+            for hub in changed:
+                domCfg = rc.domCfgs[hub]
+                doms = dict([(self.share(mbid),
+                              self.share(tuple([self.share(domCfg.getDOMSetting(mbid, s))
+                                                for s in INDEX_SETTINGS])))
+                             for mbid in domCfg.doms])
+                domName = hubDeltas[hub][0]
+                self.hubFiles[domName] = ((DELTA_TAG, cfgName), doms)
+                for mbid in doms:
+                    self.doms.setdefault(mbid, set()).add(domName)
+        except (IOError, OSError, etree.XMLSyntaxError, RunConfigException) as err:
+            print("WARNING: couldn't read %s stored as deltas: %s" % (filename, err))
+        self.runConfigs[cfgName] = (stat, entries)
+        for (hub, domName) in entries:
+            self.users.setdefault(domName, set()).add((cfgName, hub))
+
+    def addRunConfig(self, cfgName, stat):
+        from lxml import etree
+        if isDeltaStat(stat):
+            self.addDeltaVersion(cfgName, stat)
+            return
+        filename = os.path.join(self.configDir, cfgName + ".xml")
+        entries = []
+        try:
+            for child in etree.parse(filename).getroot():
+                entry = getHubEntry(child)
+                if entry is not None:
+                    entries.append(entry)
+        except etree.XMLSyntaxError as err:
+            print("WARNING: couldn't parse %s: %s" % (filename, err))
+        self.runConfigs[cfgName] = (stat, entries)
+        for (hub, domName) in entries:
+            self.users.setdefault(domName, set()).add((cfgName, hub))
+
+    def update(self):
+        """
+        Bring the index up to date with the configuration directory,
+        parsing only new and changed files.  Returns the number of
+        files parsed and removed.
+        """
+        (nParsed, nRemoved) = (0, 0)
+        runConfigFiles = self.listFiles(self.configDir)
+        runConfigFiles.update(self.listDeltaVersions())
+        for (current, files, remove, add) in \
+            [(self.hubFiles,
+              self.listFiles(os.path.join(self.configDir, RunConfig.DOMPATH)),
+              self.removeHubFile, self.addHubFile),
+             (self.runConfigs, runConfigFiles,
+              self.removeRunConfig, self.addRunConfig)]:
+            for name in list(current):
+                # DOM configurations changed by a version stored as
+                # deltas are removed with it, unless written out
+                if (current is self.hubFiles) and isDeltaStat(current[name][0]) and \
+                   (name not in files):
+                    continue
+                if (name not in files) or (files[name] != current[name][0]):
+                    remove(name)
+                    if name not in files:
+                        nRemoved += 1
+            for name in files:
+                if name not in current:
+                    add(name, files[name])
+                    nParsed += 1
+        return (nParsed, nRemoved)
+
+    def getRunConfigs(self):
+        """Names of the run configurations (files listing DOM
+        configurations), in order"""
+        return sorted([name for name in self.runConfigs if self.runConfigs[name][1]],
+                      key=naturalKey)
+
+    def getDOMEntries(self, mbid):
+        """(run config, hub, DOM config name, settings) for each run
+        configuration containing a DOM, in order"""
+        entries = []
+        for domName in self.doms.get(mbid, []):
+            settings = dict(zip(INDEX_SETTINGS, self.hubFiles[domName][1][mbid]))
+            for (cfgName, hub) in self.users.get(domName, []):
+                entries.append((cfgName, hub, domName, settings))
+        return sorted(entries, key=lambda e: naturalKey(e[0]))
+
+    def getExcludedRunConfigs(self, mbid):
+        """Run configurations not containing a DOM, in order"""
+        included = set([e[0] for e in self.getDOMEntries(mbid)])
+        return [name for name in self.getRunConfigs() if name not in included]
+
+    def getSettingHistory(self, mbid, setting, changesOnly=True):
+        """
+        (run config, hub, value) of a setting of a DOM over the run
+        configurations containing it, in order; if changesOnly is set,
+        only the first and those where the value changes.
+        """
+        history = []
+        for (cfgName, hub, domName, settings) in self.getDOMEntries(mbid):
+            value = settings.get(setting)
+            if changesOnly and history and (history[-1][2] == value):
+                continue
+            history.append((cfgName, hub, value))
+        return history
+
+def main():
+    """
+    Update and query the index of DOMs in the run configurations of a
+    configuration directory.
+    """
+    #---------------------------------------------------
+    # Parse command-line options
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hNaf:",
+                     ["help", "no-update", "all", "file="])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage()
+        sys.exit(2)
+
+    doUpdate = True
+    changesOnly = True
+    indexFile = None
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-N", "--no-update"):
+            doUpdate = False
+        elif o in ("-a", "--all"):
+            changesOnly = False
+        elif o in ("-f", "--file"):
+            indexFile = a
+        else:
+            assert False, "unhandled option"
+
+    if len(args) < 1:
+        usage()
+        sys.exit(2)
+
+    configDir = args[0]
+    (command, params) = ("update", [])
+    if len(args) > 1:
+        (command, params) = (args[1], args[2:])
+    nParams = {"update": (0, 0), "configs": (1, 1), "excluded": (1, 1),
+               "history": (1, 2)}
+    if (command not in nParams) or \
+       not (nParams[command][0] <= len(params) <= nParams[command][1]):
+        usage()
+        sys.exit(2)
+    if not os.path.isdir(configDir):
+        print("ERROR: no configuration directory %s" % configDir)
+        sys.exit(-1)
+
+    index = ConfigIndex(configDir, indexFile)
+    if doUpdate:
+        (nParsed, nRemoved) = index.update()
+        if nParsed or nRemoved:
+            try:
+                index.save()
+            except (IOError, OSError) as err:
+                print("WARNING: couldn't save index %s: %s" % (index.indexFile, err))
+        if command == "update":
+            print("Indexed %d DOMs in %d run configurations and %d DOM configurations" % \
+                  (len(index.doms), len(index.getRunConfigs()), len(index.hubFiles)), \
+                  "(%d files parsed, %d removed)" % (nParsed, nRemoved))
+    if command == "update":
+        return
+
+    nicks = nicknames()
+    mbid = nicks.findMBID(params[0])
+    if mbid is None:
+        print("ERROR: unknown DOM %s" % params[0])
+        sys.exit(-1)
+    pos = nicks.getDOMPosition(mbid)
+    print("%s %s %s" % (mbid, pos and "%02d-%02d" % (pos[0], pos[1]) or "-",
+                        nicks.getDOMName(mbid)))
+
+    if command == "configs":
+        entries = index.getDOMEntries(mbid)
+        for (cfgName, hub, domName, settings) in entries:
+            print("    %-40s hub %-3s %-30s HV %s" % \
+                  (cfgName, hub, domName, settings.get('pmtHighVoltage')))
+        print("In %d of %d run configurations" % (len(entries), len(index.getRunConfigs())))
+    elif command == "excluded":
+        excluded = index.getExcludedRunConfigs(mbid)
+        for cfgName in excluded:
+            print("    %s" % cfgName)
+        print("Not in %d of %d run configurations" % \
+              (len(excluded), len(index.getRunConfigs())))
+    elif command == "history":
+        setting = (len(params) > 1) and params[1] or 'pmtHighVoltage'
+        if setting not in INDEX_SETTINGS:
+            print("ERROR: setting %s is not indexed (one of %s)" % \
+                  (setting, ", ".join(INDEX_SETTINGS)))
+            sys.exit(-1)
+        for (cfgName, hub, value) in index.getSettingHistory(mbid, setting, changesOnly):
+            print("    %-40s hub %-3s %s %s" % (cfgName, hub, setting, value))
+
+if __name__ == "__main__":
+    main()
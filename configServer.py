@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+#
+# configServer.py
+#
+# Local HTTP query service that keeps parsed run configurations,
+# nicknames and calibration results in memory, reloading them when
+# the underlying files change.
+#
+
+from __future__ import print_function
+from builtins import str
+from builtins import object
+import sys
+import getopt
+import os
+import json
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    # Python 2
+    from future.moves.http.server import BaseHTTPRequestHandler, HTTPServer
+    from future.moves.urllib.parse import urlparse, parse_qs
+
+from calibration import CalibrationResults, findCalibrationFiles
+from runConfig import RunConfig, RunConfigException, fileStats
+from nicknames import NICKNAMES, nicknames
+from badDOMs import getBadDOMs
+
+DEFAULT_PORT = 8086
+
+def usage():
+    """ Print program usage """
+    print("Usage: %s [-h] [-p port] [-k nicknames_file] config_dir" % (sys.argv[0]))
+    print("    -h       print this help message")
+    print("    -p port  port to listen on (localhost only, default %d)" % DEFAULT_PORT)
+    print("    -k file  nicknames file")
+    print("Queries (GET, JSON results; configs are relative to config_dir):")
+    print("    /dom?dom=D                           DOM name, position and MBID")
+    print("    /setting?config=C&dom=D[&setting=S]  DOM setting(s) in a configuration")
+    print("    /baddoms?config=C                    DOMs missing or with HV off")
+    print("    /diff?config=C&other=C2              DOM setting differences")
+    print("    /calibration?cal=DIR&dom=D[&config=C]")
+    print("                                         calibration at configured settings")
+    print("   dom       can be specified by position, MBID, or name")
+
+class QueryError(Exception):
+    pass
+
+class ConfigCache(object):
+    """
+    Parsed run configurations, nicknames and calibration results,
+    each reloaded when any of the files it was read from changes, and
+    the result files found in each calibration directory.
+    """
+    def __init__(self, configDir, nicknameFile=NICKNAMES):
+        self.configDir = configDir
+        self.nicknameFile = nicknameFile
+        self.lock = threading.Lock()
+        self.nicks = None
+        self.nickStats = None
+        self.configs = {}
+        self.calFiles = {}
+        self.cals = {}
+
+    def getNicknames(self):
+        stats = fileStats([self.nicknameFile])
+        if (self.nicks is None) or (stats != self.nickStats):
+            self.nicks = nicknames(nicknameFile=self.nicknameFile)
+            self.nickStats = stats
+        return self.nicks
+
+    def getRunConfig(self, name):
+        if name is None:
+            raise QueryError("no configuration specified")
+        filename = os.path.join(self.configDir, name)
+        if not filename.endswith(".xml"):
+            filename += ".xml"
+        if name in self.configs:
+            (rc, stats) = self.configs[name]
+            if fileStats(rc.getFiles()) == stats:
+                return rc
+        if not os.path.exists(filename):
+            raise QueryError("no such configuration %s" % name)
+        try:
+            rc = RunConfig(filename, readOnly=True, snapshot=True)
+        except RunConfigException as err:
+            raise QueryError(str(err))
+        self.configs[name] = (rc, fileStats(rc.getFiles()))
+        return rc
+
+    def getCalibrationFiles(self, calDir):
+        """
+        DOMCal result files by MBID in a calibration directory or
+        archive, found again when a result is added to or removed from
+        the directory or its subdirectories, or the archive changes.
+        """
+        if calDir in self.calFiles:
+            (calFiles, dirs, stats) = self.calFiles[calDir]
+            if fileStats(dirs) == stats:
+                return calFiles
+        dirs = [calDir]
+        if os.path.isdir(calDir):
+            dirs += [os.path.join(calDir, d) for d in sorted(os.listdir(calDir))
+                     if os.path.isdir(os.path.join(calDir, d))]
+        stats = fileStats(dirs)
+        calFiles = findCalibrationFiles(calDir)
+        self.calFiles[calDir] = (calFiles, dirs, stats)
+        return calFiles
+
+    def getCalibration(self, calDir, mbid):
+        if calDir is None:
+            raise QueryError("no calibration directory specified")
+        filename = self.getCalibrationFiles(calDir).get(mbid)
+        if filename is None:
+            return None
+        stats = fileStats([filename])
+        if (mbid, calDir) in self.cals:
+            (cal, calStats) = self.cals[(mbid, calDir)]
+            if calStats == stats:
+                return cal
+        cal = CalibrationResults(calDir, filter=os.path.relpath(filename, calDir))
+        if not cal.exists(mbid):
+            return None
+        self.cals[(mbid, calDir)] = (cal, stats)
+        return cal
+
+    def findMBID(self, dom):
+        if dom is None:
+            raise QueryError("no DOM specified")
+        mbid = self.getNicknames().findMBID(dom)
+        if mbid is None:
+            raise QueryError("unknown DOM %s" % dom)
+        return mbid
+
+    def query(self, path, params):
+        """Answer a query, returning a JSON-serializable result"""
+        with self.lock:
+            nicks = self.getNicknames()
+            if path == "/dom":
+                mbid = self.findMBID(params.get("dom"))
+                return {"mbid": mbid,
+                        "name": nicks.getDOMName(mbid),
+                        "domid": nicks.getDOMID(mbid),
+                        "position": nicks.getDOMPosition(mbid)}
+            elif path == "/setting":
+                rc = self.getRunConfig(params.get("config"))
+                mbid = self.findMBID(params.get("dom"))
+                domCfg = rc.getDOMConfig(mbid)
+                if domCfg is None:
+                    raise QueryError("DOM %s not in configuration" % mbid)
+                if "setting" in params:
+                    return {"mbid": mbid, params["setting"]:
+                            domCfg.getDOMSetting(mbid, params["setting"])}
+                result = domCfg.getDOMSettings(mbid)
+                result["mbid"] = mbid
+                return result
+            elif path == "/baddoms":
+                rc = self.getRunConfig(params.get("config"))
+                badList = getBadDOMs(rc, nicks)
+                return {"count": len(badList),
+                        "doms": ["%02d-%02d" % (pos[0], pos[1]) for pos in badList]}
+            elif path == "/diff":
+                rc = self.getRunConfig(params.get("config"))
+                other = self.getRunConfig(params.get("other"))
+                return rc.compare(other)
+            elif path == "/calibration":
+                mbid = self.findMBID(params.get("dom"))
+                cal = self.getCalibration(params.get("cal"), mbid)
+                result = {"mbid": mbid, "exists": cal is not None}
+                if (cal is not None) and ("config" in params):
+                    rc = self.getRunConfig(params["config"])
+                    domCfg = rc.getDOMConfig(mbid)
+                    if domCfg is None:
+                        raise QueryError("DOM %s not in configuration" % mbid)
+                    hv = int(domCfg.getDOMSetting(mbid, 'pmtHighVoltage'))
+                    speDisc = int(domCfg.getDOMSetting(mbid, 'speTriggerDiscriminator'))
+                    gain = cal.getGain(mbid, hv/2.)
+                    result["gain"] = gain
+                    result["speThreshPE"] = cal.getSPEThresh(mbid, speDisc, gain)
+                    result["atwdFreqMHz"] = [
+                        cal.getATWDFreq(mbid, atwd,
+                                        int(domCfg.getDOMSetting(mbid, 'atwd%dTriggerBias' % atwd)))
+                        for atwd in range(2)]
+                return result
+            else:
+                raise QueryError("unknown query %s" % path)
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """Answer GET queries from the cache held by the server"""
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = dict([(k, v[0]) for (k, v) in parse_qs(url.query).items()])
+        try:
+            result = self.server.cache.query(url.path, params)
+            code = 200
+        except QueryError as err:
+            result = {"error": str(err)}
+            code = 400
+        except Exception as err:
+            result = {"error": "%s: %s" % (type(err).__name__, err)}
+            code = 500
+        body = json.dumps(result).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def main():
+    """
+    Serve queries about run configurations, DOMs and calibration
+    results from memory on a localhost port.
+    """
+    #---------------------------------------------------
+    # Parse command-line options
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hp:k:",
+                     ["help", "port=", "nicknames="])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage()
+        sys.exit(2)
+
+    port = DEFAULT_PORT
+    nicknameFile = NICKNAMES
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-p", "--port"):
+            port = int(a)
+        elif o in ("-k", "--nicknames"):
+            nicknameFile = a
+        else:
+            assert False, "unhandled option"
+
+    if len(args) != 1:
+        usage()
+        sys.exit(2)
+
+    server = HTTPServer(("127.0.0.1", port), QueryHandler)
+    server.cache = ConfigCache(args[0], nicknameFile=nicknameFile)
+    server.cache.getNicknames()
+    print("Serving queries for configurations in", args[0], \
+          "on http://127.0.0.1:%d/" % port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+#
+# diagnostics.py
+#
+# Buffered collection of warnings, grouped by category, so that tools
+# processing the whole detector can print a short summary instead of
+# one line per warning.
+#
+
+from __future__ import print_function
+from builtins import object
+import sys
+from collections import OrderedDict
+
+class Diagnostics(object):
+    """
+    Warnings collected by category for each item (e.g. DOM).  Warnings
+    for an item can be cleared when it is reprocessed.
+    """
+    def __init__(self):
+        # item -> list of (category, message)
+        self.entries = OrderedDict()
+
+    def add(self, item, category, message):
+        """Add a warning for an item, ignoring repeats"""
+        if item not in self.entries:
+            self.entries[item] = []
+        if (category, message) not in self.entries[item]:
+            self.entries[item].append((category, message))
+
+    def clear(self, item):
+        if item in self.entries:
+            del self.entries[item]
+
+    def count(self):
+        return sum([len(e) for e in self.entries.values()])
+
+    def byCategory(self):
+        """Messages grouped by category, in order of first appearance"""
+        categories = OrderedDict()
+        for entries in self.entries.values():
+            for (category, message) in entries:
+                if category not in categories:
+                    categories[category] = []
+                categories[category].append(message)
+        return categories
+
+    def printSummary(self, examples=0, out=sys.stdout):
+        """Print the number of warnings in each category, followed by
+        up to the given number of example messages"""
+        categories = self.byCategory()
+        if not categories:
+            return
+        print("Warnings by category (%d total):" % self.count(), file=out)
+        for category in categories:
+            messages = categories[category]
+            print("%8d  %s" % (len(messages), category), file=out)
+            for message in messages[:examples]:
+                print("              ", message.rstrip(), file=out)
+        out.flush()
+
+    def write(self, filename):
+        """Write all warnings to a file, grouped by category"""
+        f = open(filename, "w")
+        categories = self.byCategory()
+        for category in categories:
+            f.write("# %s (%d)\n" % (category, len(categories[category])))
+            f.write("".join(["WARNING: %s\n" % m.rstrip() for m in categories[category]]))
+        f.close()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+#
+# geometry.py
+#
+# Deployed DOM layout of IceCube, with a dense (string, position)
+# table of mainboard IDs, detector categories and hubs built once
+# from the nicknames file.
+#
+
+from __future__ import print_function
+from builtins import range
+from builtins import object
+import sys
+
+from nicknames import NICKNAMES, nicknames
+
+# Deployed layout: 60 in-ice DOMs on each of 86 strings, four IceTop
+# DOMs (two tanks, high- and low-gain) at each of 81 stations, and
+# scintillator panels above position 64
+N_STRINGS = 86
+N_ICETOP_STATIONS = 81
+N_INICE_POSITIONS = 60
+ICETOP_POSITIONS = (61, 62, 63, 64)
+MAX_STANDARD_POSITION = 64
+
+# DOM categories
+INICE = "inice"
+ICETOP = "icetop"
+SCINT = "scint"
+
+def classify(string, dompos):
+    """Return the (category, isLowGain) of a DOM position"""
+    isIceTop = (string <= N_STRINGS) and (dompos in ICETOP_POSITIONS)
+    if isIceTop:
+        # Low-gain IceTop DOMs are at even positions
+        return (ICETOP, dompos % 2 == 0)
+    if (string <= N_STRINGS) and (dompos > MAX_STANDARD_POSITION):
+        return (SCINT, False)
+    return (INICE, False)
+
+def isDeployed(string, dompos):
+    """Is this an in-ice or IceTop position of the standard layout?"""
+    if (string < 1) or (string > N_STRINGS) or (dompos < 1):
+        return False
+    if dompos <= N_INICE_POSITIONS:
+        return True
+    return (string <= N_ICETOP_STATIONS) and (dompos in ICETOP_POSITIONS)
+
+class Geometry(object):
+    """
+    Tables indexed by [string][position] of the mainboard ID, category
+    and hub of every slot, plus the category of every DOM in the
+    nicknames file (including those outside the standard layout).
+    """
+    def __init__(self, nicks):
+        self.nicks = nicks
+
+        # Leave room for any scintillators beyond the standard positions
+        self.nPositions = MAX_STANDARD_POSITION
+        for pos in nicks.posDict.values():
+            if (pos[0] >= 1) and (pos[0] <= N_STRINGS):
+                self.nPositions = max(self.nPositions, pos[1])
+
+        self.mbids = [[None]*(self.nPositions+1) for s in range(N_STRINGS+1)]
+        self.categories = [[classify(s, p) for p in range(self.nPositions+1)]
+                           for s in range(N_STRINGS+1)]
+        # In-ice hubs are numbered by string; IceTop and scintillator
+        # hubs are only known from a run configuration (see setHubs)
+        self.hubs = [[(p <= N_INICE_POSITIONS) and s or None
+                      for p in range(self.nPositions+1)]
+                     for s in range(N_STRINGS+1)]
+
+        self.domCategories = {}
+        for (mbid, (string, dompos)) in nicks.posDict.items():
+            if self.inRange(string, dompos):
+                self.mbids[string][dompos] = mbid
+                self.domCategories[mbid] = self.categories[string][dompos]
+            else:
+                self.domCategories[mbid] = classify(string, dompos)
+
+        self.deployed = [(s, p) for s in range(1, N_STRINGS+1)
+                         for p in range(1, self.nPositions+1) if isDeployed(s, p)]
+
+    def inRange(self, string, dompos):
+        return (string >= 0) and (string <= N_STRINGS) and \
+            (dompos >= 0) and (dompos <= self.nPositions)
+
+    def getMBID(self, string, dompos):
+        if self.inRange(string, dompos):
+            return self.mbids[string][dompos]
+        return None
+
+    def getCategory(self, mbid):
+        """(category, isLowGain) of a DOM, or None if its position is unknown"""
+        return self.domCategories.get(mbid)
+
+    def getHub(self, string, dompos):
+        if self.inRange(string, dompos):
+            return self.hubs[string][dompos]
+        return None
+
+    def setHubs(self, rc):
+        """Fill in the hubs of the DOMs in a run configuration"""
+        for (hub, domCfg) in rc.domCfgs.items():
+            for mbid in domCfg.getDOMs():
+                pos = self.nicks.getDOMPosition(mbid)
+                if (pos is not None) and self.inRange(pos[0], pos[1]):
+                    self.hubs[pos[0]][pos[1]] = int(hub)
+
+    def getDeployedPositions(self):
+        """All (string, position) slots of the standard layout, in order"""
+        return self.deployed
+
+    def getMissingPositions(self, positions):
+        """Deployed slots not in a collection of (string, position) pairs"""
+        present = set([tuple(p) for p in positions])
+        return [pos for pos in self.deployed if pos not in present]
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        filename = sys.argv[1]
+    else:
+        filename = NICKNAMES
+    geom = Geometry(nicknames(nicknameFile=filename))
+    counts = {}
+    for (string, dompos) in geom.getDeployedPositions():
+        category = geom.categories[string][dompos][0]
+        counts[category] = counts.get(category, 0) + 1
+    print(len(geom.getDeployedPositions()), "deployed positions:", \
+          ", ".join(["%d %s" % (counts[c], c) for c in sorted(counts)]))
+    empty = [pos for pos in geom.getDeployedPositions()
+             if geom.getMBID(pos[0], pos[1]) is None]
+    print(len(empty), "deployed positions without a DOM in the nicknames file")
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+#
+# materializeConfig.py
+#
+# Write out run configuration versions stored as setting deltas (see
+# the -D option of updateCalibration.py and the other scripts) as
+# standard pDAQ XML files, or list the versions stored as deltas in a
+# configuration directory.
+#
+
+from __future__ import print_function
+from builtins import str
+import sys
+import getopt
+import os
+import time
+from collections import OrderedDict
+
+from runConfig import RunConfig, RunConfigException, getDeltaFile, isDeltaVersion, readDelta
+
+def usage():
+    """ Print program usage """
+    print("Usage: %s [-hn] run_config.xml..." % (sys.argv[0]))
+    print("       %s -l config_dir" % (sys.argv[0]))
+    print("    -h       print this help message")
+    print("    -n       list the files that would be written, without writing them")
+    print("    -l       list the versions stored as deltas, with their parent")
+    print("             versions and whether they have been written out")
+    print("A version is given by its usual file name (e.g. config_dir/sps-new-V2.xml)")
+    print("or by its delta file (config_dir/%s/sps-new-V2.xml)." % RunConfig.DELTAPATH)
+
+def getVersionName(filename):
+    """The usual file name of a version, given it or its delta file"""
+    directory = os.path.dirname(os.path.abspath(filename))
+    if os.path.basename(directory) == RunConfig.DELTAPATH:
+        return os.path.join(os.path.dirname(directory), os.path.basename(filename))
+    return filename
+
+def getDeltaHubs(cfgName):
+    """
+    The DOM configuration names, by hub, of the hubs changed by a
+    version stored as deltas or by the versions stored as deltas that
+    it derives from, and the number of those versions.
+    """
+    hubs = OrderedDict()
+    nDeltas = 0
+    while isDeltaVersion(cfgName):
+        (parent, hubDeltas) = readDelta(getDeltaFile(cfgName))
+        for (hub, (domName, removed, changes)) in hubDeltas.items():
+            # The newest version's name for the hub
+            if hub not in hubs:
+                hubs[hub] = domName
+        nDeltas += 1
+        cfgName = os.path.join(os.path.dirname(cfgName), parent)
+    return (hubs, nDeltas)
+
+def getMissingFiles(cfgName, hubs):
+    """Files of a version stored as deltas that don't exist yet, by hub"""
+    directory = os.path.dirname(cfgName)
+    missing = OrderedDict()
+    for (hub, domName) in hubs.items():
+        path = os.path.join(directory, RunConfig.DOMPATH, "%s.xml" % domName)
+        if not os.path.exists(path):
+            missing[hub] = path
+    return missing
+
+def materialize(cfgName, dryrun=False):
+    """Write out a version stored as deltas, returning the files written
+    (or that would be written)"""
+    (hubs, nDeltas) = getDeltaHubs(cfgName)
+    missing = getMissingFiles(cfgName, hubs)
+    if dryrun:
+        return list(missing.values()) + [cfgName]
+    # Only the DOM configurations to write are parsed; at least one hub
+    # must be loaded
+    load = list(missing.keys()) or list(hubs.keys())[:1] or None
+    rc = RunConfig(cfgName, hubs=load)
+    return rc.materialize()
+
+def listDeltas(configDir):
+    """Print the versions stored as deltas in a configuration directory"""
+    deltaDir = os.path.join(configDir, RunConfig.DELTAPATH)
+    if not os.path.isdir(deltaDir):
+        print("No versions stored as deltas in", configDir)
+        return
+    print("%-30s %-30s %5s %6s  %s" % ("version", "parent", "hubs", "DOMs", "written out"))
+    for filename in sorted(os.listdir(deltaDir)):
+        if not filename.endswith(".xml"):
+            continue
+        (parent, hubDeltas) = readDelta(os.path.join(deltaDir, filename))
+        nDOMs = sum([len(removed) + len(changes)
+                     for (domName, removed, changes) in hubDeltas.values()])
+        written = os.path.exists(os.path.join(configDir, filename))
+        print("%-30s %-30s %5d %6d  %s" % (filename, parent, len(hubDeltas), nDOMs,
+                                          written and "yes" or "no"))
+
+def main():
+    """
+    Write out run configuration versions stored as setting deltas.
+    """
+    #---------------------------------------------------
+    # Parse command-line options
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hnl", ["help", "dryrun", "list"])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage()
+        sys.exit(2)
+
+    dryrun = False
+    listOnly = False
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-n", "--dryrun"):
+            dryrun = True
+        elif o in ("-l", "--list"):
+            listOnly = True
+        else:
+            assert False, "unhandled option"
+
+    if (len(args) < 1) or (listOnly and (len(args) != 1)):
+        usage()
+        sys.exit(2)
+
+    if listOnly:
+        listDeltas(args[0])
+        return
+
+    for filename in args:
+        cfgName = getVersionName(filename)
+        if not isDeltaVersion(cfgName):
+            if os.path.exists(cfgName):
+                print("%s is already stored in full" % cfgName)
+                continue
+            print("ERROR: no configuration %s or delta %s" % (cfgName, getDeltaFile(cfgName)))
+            sys.exit(-1)
+        start = time.time()
+        try:
+            files = materialize(cfgName, dryrun)
+        except (IOError, RunConfigException) as err:
+            print("ERROR: couldn't write out %s: %s" % (cfgName, str(err)))
+            sys.exit(-1)
+        if dryrun:
+            print("%s: would write %d files" % (cfgName, len(files)))
+        else:
+            print("%s: wrote %d files in %.2f s" % (cfgName, len(files), time.time()-start))
+        for f in files:
+            print("    %s" % f)
+
+if __name__ == "__main__":
+    main()
@@ -7,21 +7,71 @@ import sys
 import getopt
 import os
 
-from calibration import *
-from runConfig import *
-from nicknames import *
+from runConfig import RunConfig, RunConfigException, getStringHubs, parseIntList
+from nicknames import nicknames
 
 def usage():
     """ Print program usage """
-    print("Usage: %s [-h] [-v ###] [-n new_config_name]" % (sys.argv[0]), \
-          "[-l dom_list] run_config.xml [dom1 dom2...]")
+    print("Usage: %s [-hD] [-v ###] [-n new_config_name]" % (sys.argv[0]), \
+          "[-l dom_list] [--hubs hub_list | --strings string_list]", \
+          "run_config.xml [dom1 dom2...]")
     print("    -h       print this help message")
     print("    -l       list of DOMs to remove")
     print("    -v ###   version number of new configuration")
     print("    -n name  name of new configuration (top level)")
     print("    -c name  name of new configuration (DOM config base name)")
+    print("    -D       store the new version as setting changes against run_config.xml")
+    print("             instead of new files (see materializeConfig.py)")
+    print("    --hubs list    only read and write these hubs (e.g. 1-10,201)")
+    print("    --strings list only remove DOMs on these strings (e.g. 1-10,21)")
     print("   dom       can be specified by position, MBID, or name")
 
+def readDOMList(domFile, nicks):
+    """
+    Read a list of DOMs, one per line, specified by position, MBID,
+    or name, and return their mainboard IDs.
+    """
+    domList = []
+    f = open(domFile, "r")
+    if not f:
+        print("Error: couldn't open DOM list file", domFile, file=sys.stderr)
+        sys.exit(-1)
+
+    for line in f.readlines():
+        val = line.rstrip()
+        if len(val)==0:
+            # skip blank lines
+            continue
+
+        d = nicks.findMBID(val)
+        if d is not None:
+            try:
+                int(d, 16)
+                domList.append(d)
+            except ValueError:
+                print("Skipping invalid mbid: ", val, file=sys.stderr)
+                continue
+    f.close()
+    return domList
+
+def removeDOMs(rc, domList, nicks):
+    """
+    Remove a list of DOMs from a run configuration, returning the
+    number actually removed.
+    """
+    nRemoved = 0
+    for mbid in domList:
+        (string, dompos) = nicks.getDOMPosition(mbid)
+        if rc.removeDOM(mbid):
+            nRemoved += 1
+            print("Removed DOM", mbid, "%02d-%02d" % (string, dompos), \
+                nicks.getDOMName(mbid))
+        else:
+            print(("WARNING: couldn't find DOM %s %02d-%02d %s "
+                   "to remove!") % (mbid, string,
+                                    dompos, nicks.getDOMName(mbid)))
+    return nRemoved
+
 def main():
     """
     Remove DOMs from a pDAQ run configuration.
@@ -29,8 +79,9 @@ def main():
     #---------------------------------------------------
     # Parse command-line options
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hl:v:n:c:",
-                     ["help", "list", "version", "name", "domname"])
+        opts, args = getopt.getopt(sys.argv[1:], "hDl:v:n:c:",
+                     ["help", "delta", "list=", "version=", "name=", "domname=",
+                      "hubs=", "strings="])
     except getopt.GetoptError as err:
         print(str(err))
         usage()
@@ -40,6 +91,9 @@ def main():
     cfgNewName = None
     cfgDomName = None
     domFile = None
+    storeDelta = False
+    hubs = None
+    strings = None
     for o, a in opts:
         if o in ("-h", "--help"):
             usage()
@@ -52,6 +106,12 @@ def main():
             cfgDomName = a            
         elif o in ("-l", "--list"):
             domFile = a                        
+        elif o in ("-D", "--delta"):
+            storeDelta = True
+        elif o == "--hubs":
+            hubs = parseIntList(a)
+        elif o == "--strings":
+            strings = parseIntList(a)
         else:
             assert False, "unhandled option"
 
@@ -61,6 +121,12 @@ def main():
 
     cfgName = args[0]
 
+    if (hubs is not None) and (strings is not None):
+        print("ERROR: specify only one of --hubs and --strings")
+        sys.exit(2)
+    if strings is not None:
+        hubs = getStringHubs(strings)
+
     # DOM positions, names, etc.
     nicks = nicknames()
 
@@ -70,25 +136,11 @@ def main():
 
     
     if domFile is not None:
-        f = open(domFile, "r")
-        if not f:
-            print("Error: couldn't open DOM list file", domFile, file=sys.stderr)
-            sys.exit(-1)
-            
-        for line in f.readlines():
-            val = line.rstrip()
-            if len(val)==0:
-                # skip blank lines
-                continue
-            
-            d = nicks.findMBID(val)
-            if d is not None:
-                try:                
-                    int(d, 16)
-                    domList.append(d)                    
-                except ValueError:
-                    print("Skipping invalid mbid: ", vals[0], file=sys.stderr)
-                    continue                
+        domList.extend(readDOMList(domFile, nicks))
+
+    if strings is not None:
+        domList = [mbid for mbid in domList
+                   if nicks.getDOMPosition(mbid)[0] in strings]
 
     # Check that renaming options have been specified
     if cfgNewName is None or \
@@ -112,21 +164,16 @@ def main():
 
     # Parse the run configuration files
     try:
-        rc = RunConfig(cfgName, oldFormat=False)
-    except RunConfigException:
-        print("WARNING: couldn't parse run configuration; trying old format...")
-        rc = RunConfig(cfgName, oldFormat=True)
+        rc = RunConfig(cfgName, hubs=hubs)
+    except IOError:
+        print("ERROR: couldn't read configuration file %s, exiting." % cfgName,
+              file=sys.stderr)
+        sys.exit(-1)
+    except RunConfigException as err:
+        print("ERROR:", str(err), file=sys.stderr)
+        sys.exit(-1)
         
-    for mbid in domList:
-        (string, dompos) = nicks.getDOMPosition(mbid)
-        if rc.removeDOM(mbid):
-            print("Removed DOM", mbid, "%02d-%02d" % (string, dompos), \
-                nicks.getDOMName(mbid))
-        else:
-            print(("WARNING: couldn't find DOM %s %02d-%02d %s "
-                   "to remove!") % (mbid, string,
-                                    dompos, nicks.getDOMName(mbid)))
-
+    removeDOMs(rc, domList, nicks)
             
     # Save updated run configuration files
     # Fix me deal with user specifying only some of these
@@ -134,9 +181,14 @@ def main():
     if (cfgNewName is not None) and \
             (cfgVersion is not None) and \
             (cfgDomName is not None):
-        rc.write(newName=cfgNewName,
-                 newVersion=cfgVersion,
-                 newDomCfgName=cfgDomName)
+        try:
+            rc.write(newName=cfgNewName,
+                     newVersion=cfgVersion,
+                     newDomCfgName=cfgDomName,
+                     delta=storeDelta)
+        except RunConfigException as err:
+            print("ERROR:", str(err))
+            sys.exit(-1)
     else:
         rc.write()
 
@@ -12,8 +12,15 @@ from builtins import range
 from builtins import object
 import sys
 import os
+from collections import OrderedDict
 
-from lxml import etree
+# lxml and the snapshot modules (hashlib, pickle, tempfile) are imported
+# where they are used, so that scripts start quickly when they don't
+# need them (e.g. for a usage message)
+
+# Snapshots of parsed read-only configurations (see RunConfig)
+SNAPSHOT_DIR = os.path.join(os.path.expanduser("~"), ".cache", "config-scripts")
+SNAPSHOT_VERSION = 3
 
 #-------
 # exception raised not finding any
@@ -23,6 +30,45 @@ class RunConfigException(Exception):
 
 #---------------------------------------------
 
+def parseIntList(spec):
+    """Parse a list of integers and ranges such as '1-10,21,201-211'"""
+    values = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        if "-" in item:
+            (lo, hi) = item.split("-", 1)
+            values.extend(list(range(int(lo), int(hi)+1)))
+        else:
+            values.append(int(item))
+    return values
+
+def fileStats(files):
+    """Modification times and sizes used to detect changed files"""
+    stats = []
+    for f in files:
+        try:
+            st = os.stat(f)
+            stats.append((f, st.st_mtime, st.st_size))
+        except OSError:
+            stats.append((f, None, None))
+    return stats
+
+def isIceTopHub(hub):
+    h = int(hub)
+    return (h >= 200) and (h < 220)
+
+def getStringHubs(strings):
+    """
+    Hubs that may hold DOMs on the given strings: the in-ice hubs
+    with the same numbers, and all IceTop hubs, which each serve
+    several stations.
+    """
+    return [s for s in strings] + list(range(200, 220))
+
+#---------------------------------------------
+
 class XMLConfig(object):
     """XML element tree for configuration files"""
     def __init__(self, filename):
@@ -32,6 +78,7 @@ class XMLConfig(object):
         self.filename = os.path.basename(filename)
         self.modified = False
 
+        from lxml import etree
         parser = etree.XMLParser(remove_comments=False, remove_pis=False)
         self.tree = etree.parse(filename, parser=parser)
         if self.tree:
@@ -67,62 +114,255 @@ class DOMConfig(XMLConfig):
     
     def __init__(self, filename):
         XMLConfig.__init__(self, filename)
+        # Index of the DOM elements by mainboard ID
+        self.doms = OrderedDict()
+        for dom in self.root.findall('domConfig'):
+            mbid = dom.get('mbid')
+            if mbid not in self.doms:
+                self.doms[mbid] = dom
+
+    def getLeafSettings(self, dom):
+        from lxml import etree
+        settings = {}
+        for child in dom.iterchildren(tag=etree.Element):
+            if len(child) > 0:
+                continue
+            t = child.text
+            if t is not None:
+                t = t.strip()
+            settings[child.tag] = t
+        return settings
 
-    # FIX ME this must be really slow!
     def getDOMSetting(self, mbid, setting):
-        for dom in self.root.findall('domConfig'):
-            if dom.get('mbid') == mbid:
-                t = dom.find(setting).text
-                if t is not None:
-                    t = t.strip()
-                return t
-        return None
+        dom = self.doms.get(mbid)
+        if dom is None:
+            return None
+        t = dom.find(setting).text
+        if t is not None:
+            t = t.strip()
+        return t
 
     def setDOMSetting(self, mbid, setting, value):
-        for dom in self.root.findall('domConfig'):
-            if dom.get('mbid') == mbid:
-                self.modified = True                
-                dom.find(setting).text = str(value)
+        dom = self.doms.get(mbid)
+        if dom is not None:
+            self.modified = True
+            dom.find(setting).text = str(value)
+
+    def setDOMSettings(self, setting, value, match=None):
+        """
+        Set a setting, in one pass, for every DOM for which
+        match(mbid, settings) is true (or every DOM, if no match function
+        is given), where settings is a dictionary of the DOM's current
+        settings.  The value may be a function of (mbid, settings).
+        Returns the list of DOMs whose setting changed.
+        """
+        changed = []
+        needSettings = (match is not None) or callable(value)
+        for (mbid, dom) in self.doms.items():
+            settings = needSettings and self.getLeafSettings(dom) or None
+            if (match is not None) and not match(mbid, settings):
+                continue
+            child = dom.find(setting)
+            if child is None:
+                raise RunConfigException("DOM %s in %s has no setting %s" % \
+                                         (mbid, self.filename, setting))
+            if callable(value):
+                newValue = str(value(mbid, settings))
+            else:
+                newValue = str(value)
+            if (child.text or "").strip() != newValue:
+                child.text = newValue
+                changed.append(mbid)
+        if changed:
+            self.modified = True
+        return changed
 
     def getDOMBaselines(self, mbid):
         blArr = [[0, 0, 0], [0, 0, 0]]
-        for dom in self.root.findall('domConfig'):
-            if dom.get('mbid') == mbid:
-                for child in dom.find(DOMConfig.BASELINEPARENT):
-                    if child.tag == DOMConfig.BASELINETAG:
-                        atwd = DOMConfig.ATWDDICT[child.get('atwd')]
-                        ch = int(child.get('ch'))
-                        bl = int(child.text)
-                        blArr[atwd][ch] = bl
+        dom = self.doms.get(mbid)
+        if dom is not None:
+            for child in dom.find(DOMConfig.BASELINEPARENT):
+                if child.tag == DOMConfig.BASELINETAG:
+                    atwd = DOMConfig.ATWDDICT[child.get('atwd')]
+                    ch = int(child.get('ch'))
+                    bl = int(child.text)
+                    blArr[atwd][ch] = bl
         return blArr
 
+    def hasDOMBaselines(self, mbid):
+        """Does the DOM have stored ATWD baselines?"""
+        dom = self.doms.get(mbid)
+        return (dom is not None) and (dom.find(DOMConfig.BASELINEPARENT) is not None)
+
 
     def setDOMBaselines(self, mbid, blArr):        
-        for dom in self.root.findall('domConfig'):
-            if dom.get('mbid') == mbid:
-                for child in dom.find(DOMConfig.BASELINEPARENT):
-                    if child.tag == DOMConfig.BASELINETAG:
-                        atwd = DOMConfig.ATWDDICT[child.get('atwd')]
-                        ch = int(child.get('ch'))
-                        child.text = str(blArr[atwd][ch])
-                        self.modified = True                        
-                return                        
+        dom = self.doms.get(mbid)
+        if dom is not None:
+            for child in dom.find(DOMConfig.BASELINEPARENT):
+                if child.tag == DOMConfig.BASELINETAG:
+                    atwd = DOMConfig.ATWDDICT[child.get('atwd')]
+                    ch = int(child.get('ch'))
+                    child.text = str(blArr[atwd][ch])
+                    self.modified = True                        
     
+    def getDOMSettings(self, mbid):
+        """Return a dictionary of the simple (leaf) settings of a DOM"""
+        dom = self.doms.get(mbid)
+        if dom is None:
+            return None
+        return self.getLeafSettings(dom)
+
     def getDOMs(self):
-        domList = []
-        for dom in self.root.findall('domConfig'):
-            domList.append(dom.get('mbid'))
-        return domList
+        return list(self.doms.keys())
 
     def removeDOM(self, mbid):
-        for dom in self.root.findall('domConfig'):
-            if dom.get('mbid') == mbid:
-                self.root.remove(dom)
-                self.modified = True                
-                return True
-        return False
+        dom = self.doms.pop(mbid, None)
+        if dom is None:
+            return False
+        dom.getparent().remove(dom)
+        self.modified = True                
+        return True
+
+    def getDelta(self, parent, element):
+        """
+        Add to an element the changes since a read-only copy of the
+        parent version of this DOM configuration, loaded with all its
+        settings: the removed DOMs, and the changed leaf settings and
+        ATWD baselines of the others.
+        """
+        from lxml import etree
+        for mbid in parent.getDOMs():
+            if mbid not in self.doms:
+                etree.SubElement(element, RunConfig.DELTAREMOVED, mbid=mbid)
+        for mbid in self.getDOMs():
+            oldSettings = parent.getDOMSettings(mbid)
+            if oldSettings is None:
+                raise RunConfigException("DOM %s was added to %s and can't be "
+                                         "stored as a delta" % (mbid, self.filename))
+            settings = self.getDOMSettings(mbid)
+            changed = [s for s in settings if settings[s] != oldSettings.get(s)]
+            blArr = None
+            if mbid in parent.baselines:
+                blArr = self.getDOMBaselines(mbid)
+                if blArr == parent.getDOMBaselines(mbid):
+                    blArr = None
+            if (not changed) and (blArr is None):
+                continue
+            dom = etree.SubElement(element, "domConfig", mbid=mbid)
+            for setting in changed:
+                etree.SubElement(dom, setting).text = settings[setting]
+            if blArr is not None:
+                parentElement = etree.SubElement(dom, DOMConfig.BASELINEPARENT)
+                for atwd in sorted(DOMConfig.ATWDDICT):
+                    for ch in range(3):
+                        etree.SubElement(parentElement, DOMConfig.BASELINETAG, atwd=atwd,
+                                         ch=str(ch)).text = \
+                            str(blArr[DOMConfig.ATWDDICT[atwd]][ch])
+
+    def applyDelta(self, removed, changes):
+        """Apply the changes of a version stored as deltas (see readDelta)"""
+        for mbid in removed:
+            self.removeDOM(mbid)
+        for (mbid, settings) in changes.items():
+            for (setting, value) in settings.items():
+                if setting == DOMConfig.BASELINEPARENT:
+                    self.setDOMBaselines(mbid, value)
+                else:
+                    self.setDOMSetting(mbid, setting, value)
+        # The changes are part of the version, not modifications of it
+        self.modified = False
     
 #-----------------------------------------------------
+
+class ReadOnlyDOMConfig(object):
+    """
+    Read-only DOM settings from a DOM configuration file, extracted by
+    streaming the file without keeping an element tree.  If a list of
+    settings is given, only those are kept; the ATWD baselines are kept
+    if the list includes DOMConfig.BASELINEPARENT.
+    """
+    def __init__(self, filename, settings=None):
+        self.path = os.path.dirname(filename)
+        if not self.path:
+            self.path = "."
+        self.filename = os.path.basename(filename)
+        self.modified = False
+        self.settings = settings
+        self.doms = OrderedDict()
+        self.baselines = {}
+
+        from lxml import etree
+        for event, dom in etree.iterparse(filename, events=("end",),
+                                          tag="domConfig"):
+            values = {}
+            for child in dom.iterchildren(tag=etree.Element):
+                if len(child) > 0:
+                    if (child.tag == DOMConfig.BASELINEPARENT) and \
+                       ((settings is None) or (child.tag in settings)):
+                        self.baselines[dom.get('mbid')] = self.readBaselines(child)
+                    continue
+                if (settings is not None) and (child.tag not in settings):
+                    continue
+                t = child.text
+                if t is not None:
+                    t = t.strip()
+                values[child.tag] = t
+            self.doms[dom.get('mbid')] = values
+            # Free the parsed elements as we go
+            dom.clear()
+            while dom.getprevious() is not None:
+                del dom.getparent()[0]
+
+    def readBaselines(self, parent):
+        return readBaselines(parent)
+
+    def getDOMBaselines(self, mbid):
+        if (self.settings is not None) and \
+           (DOMConfig.BASELINEPARENT not in self.settings):
+            raise RunConfigException("Baselines not loaded from %s" % self.filename)
+        return self.baselines.get(mbid, [[0, 0, 0], [0, 0, 0]])
+
+    def hasDOMBaselines(self, mbid):
+        """Does the DOM have stored ATWD baselines?"""
+        if (self.settings is not None) and \
+           (DOMConfig.BASELINEPARENT not in self.settings):
+            raise RunConfigException("Baselines not loaded from %s" % self.filename)
+        return mbid in self.baselines
+
+    def getDOMSetting(self, mbid, setting):
+        if (self.settings is not None) and (setting not in self.settings):
+            raise RunConfigException("Setting %s not loaded from %s" % 
+                                     (setting, self.filename))
+        if mbid in self.doms:
+            return self.doms[mbid].get(setting)
+        return None
+
+    def getDOMSettings(self, mbid):
+        if mbid in self.doms:
+            return dict(self.doms[mbid])
+        return None
+
+    def getDOMs(self):
+        return list(self.doms.keys())
+
+    def applyDelta(self, removed, changes):
+        """Apply the changes of a version stored as deltas (see readDelta),
+        keeping only the settings that were loaded"""
+        for mbid in removed:
+            self.doms.pop(mbid, None)
+            self.baselines.pop(mbid, None)
+        for (mbid, settings) in changes.items():
+            if mbid not in self.doms:
+                continue
+            for (setting, value) in settings.items():
+                if (self.settings is not None) and (setting not in self.settings):
+                    continue
+                if setting == DOMConfig.BASELINEPARENT:
+                    self.baselines[mbid] = value
+                else:
+                    self.doms[mbid][setting] = value
+
+#-----------------------------------------------------
     
 class RunConfig(XMLConfig):
     """Tree of XML element trees for DAQ top-level 
@@ -138,87 +378,247 @@ class RunConfig(XMLConfig):
     
     TRIGPATH = "trigger"
     TRIGTAG = "triggerConfig"
+
+    # Versions stored as setting deltas against their parent version
+    DELTAPATH = "deltas"
+    DELTATAG = "runConfigDelta"
+    DELTAHUB = "hub"
+    DELTAREMOVED = "removedDOM"
     
-    def __init__(self, filename, oldFormat=False):
+    def __init__(self, filename, oldFormat=None, readOnly=False, settings=None,
+                 hubs=None, snapshot=False, snapshotDir=None):
+        """
+        Parse a run configuration and the trigger and DOM configurations
+        it references.  DOM configurations may be listed in the old
+        (domConfigList) or new (stringHub) format, or a mix of both;
+        set oldFormat to True or False to accept only one of them.
+
+        If readOnly is set, the DOM configurations are loaded as
+        ReadOnlyDOMConfig settings (optionally only those in the list
+        of settings) instead of element trees, and cannot be modified.
+
+        If a list of hubs is given, only their DOM configurations are
+        loaded, and only they are written along with the top-level file.
+
+        If snapshot is set for a read-only configuration, the parsed DOM
+        settings are saved in a snapshot file in snapshotDir (by default
+        SNAPSHOT_DIR) and loaded from it, instead of parsing the DOM
+        configurations, as long as none of the files have changed.
+
+        A version stored as setting deltas (see writeDelta) is opened
+        by its usual file name, from its parent version and deltas.
+        """
+        if isDeltaVersion(filename):
+            self.openDelta(filename, oldFormat, readOnly, settings, hubs,
+                           snapshot, snapshotDir)
+            return
         XMLConfig.__init__(self, filename)
         self.trigroot = None
         self.domCfgs = {}
         self.oldFormat = oldFormat
+        self.readOnly = readOnly
+        # Delta files this version was opened from, base version first
+        self.deltaFiles = []
+        if hubs is not None:
+            hubs = set([str(h) for h in hubs])
+        snapshotKey = (oldFormat, settings and tuple(sorted(settings)),
+                       hubs and tuple(sorted(hubs)))
+        snapshotFile = None
+        if readOnly and snapshot:
+            snapshotFile = self.getSnapshotFile(filename, snapshotKey, snapshotDir)
+            if self.loadSnapshot(snapshotFile, snapshotKey):
+                return
         
-        # Recursively parse trigger and DOM configs
+        # Recursively parse trigger and DOM configs in a single
+        # pass, detecting the format of each DOM config entry
         for child in self.root:
 
-            trig = (child.tag == RunConfig.TRIGTAG)
-            if self.oldFormat:
-                dom = (child.tag == RunConfig.DOMTAG)
-            else:
-                dom = (child.tag == RunConfig.STRINGHUB)
-
-            if not trig and not dom:
-                continue
-                    
-            filename = None
-            if trig:
+            if child.tag == RunConfig.TRIGTAG:
                 filename = os.path.join(self.path,
                                         RunConfig.TRIGPATH,
                                         "%s.xml" % child.text)
-            elif dom:
-                if self.oldFormat:
-                    filename = os.path.join(self.path,
-                                            RunConfig.DOMPATH,
-                                            child.text+".xml")            
-                    hub = child.get('hub')
-                    self.domCfgs[hub] = DOMConfig(filename)
-                else:
-                    dom_fname = child.get(RunConfig.DOMATTRIB)
-                    filename = os.path.join(self.path,
-                                            RunConfig.DOMPATH,
-                                            "%s.xml" % dom_fname)
-                
-                    hub = child.get('hubId')
-                    self.domCfgs[hub] = DOMConfig(filename)
-
-            if trig:
                 self.trigroot = XMLConfig(filename)
+                continue
+
+            entry = self.getHubEntry(child)
+            if entry is None:
+                continue
+            (hub, domName) = entry
+            if (hubs is not None) and (hub not in hubs):
+                continue
+            filename = os.path.join(self.path,
+                                    RunConfig.DOMPATH,
+                                    "%s.xml" % domName)
+            if readOnly:
+                self.domCfgs[hub] = ReadOnlyDOMConfig(filename, settings)
+            else:
+                self.domCfgs[hub] = DOMConfig(filename)
 
         if len(self.domCfgs)==0:
-            # This class as is does not understand OLD config
-            # files, check for this problem by noting if there
-            # are no domCfgs
-            raise RunConfigException("No dom configs found in %s (old format?)" % 
+            raise RunConfigException("No dom configs found in %s" % 
                                      self.filename)
 
-    def write(self, newName=None, newVersion=None, newDomCfgName=None):
+        if snapshotFile is not None:
+            self.saveSnapshot(snapshotFile, snapshotKey)
+
+    def getSnapshotFile(self, filename, key, snapshotDir=None):
+        """Snapshot file for a configuration, unique to its path and to
+        the options it is loaded with"""
+        import hashlib
+        if snapshotDir is None:
+            snapshotDir = SNAPSHOT_DIR
+        name = os.path.abspath(filename) + repr(key)
+        digest = hashlib.md5(name.encode("utf-8")).hexdigest()
+        return os.path.join(snapshotDir, "%s-%s.snapshot" % \
+                            (os.path.splitext(self.filename)[0], digest[:12]))
 
+    def loadSnapshot(self, snapshotFile, key):
+        """
+        Load the trigger configuration and the DOM settings from a
+        snapshot, if it exists, was taken with the same options and none
+        of the files it was taken from have changed.  Returns True if
+        the snapshot was loaded.
+        """
+        import pickle
+        try:
+            f = open(snapshotFile, "rb")
+            try:
+                snap = pickle.load(f)
+            finally:
+                f.close()
+        except Exception:
+            return False
+        if (not isinstance(snap, dict)) or \
+           (snap.get("version") != SNAPSHOT_VERSION) or \
+           (snap.get("key") != key) or \
+           (fileStats([s[0] for s in snap["files"]]) != snap["files"]):
+            return False
+        # Paths are stored in full, but are given relative to this
+        # configuration as when the files are parsed
+        if snap["trigger"] is not None:
+            self.trigroot = XMLConfig(os.path.join(self.path, RunConfig.TRIGPATH,
+                                                   os.path.basename(snap["trigger"])))
+        self.domCfgs = snap["domCfgs"]
+        for domCfg in self.domCfgs.values():
+            domCfg.path = os.path.join(self.path, RunConfig.DOMPATH)
+        return True
+
+    def saveSnapshot(self, snapshotFile, key):
+        """Save the parsed DOM settings to a snapshot, with full paths so
+        that it can be loaded from any directory; failures (e.g. an
+        unwritable snapshot directory) are ignored"""
+        import copy
+        import pickle
+        import tempfile
+        trigger = None
+        if self.trigroot is not None:
+            trigger = os.path.abspath(os.path.join(self.trigroot.path,
+                                                   self.trigroot.filename))
+        domCfgs = {}
+        for (hub, domCfg) in self.domCfgs.items():
+            domCfgs[hub] = copy.copy(domCfg)
+            domCfgs[hub].path = os.path.abspath(domCfg.path)
+        snap = {"version": SNAPSHOT_VERSION, "key": key,
+                "files": fileStats([os.path.abspath(f) for f in self.getFiles()]),
+                "trigger": trigger, "domCfgs": domCfgs}
+        try:
+            snapshotDir = os.path.dirname(snapshotFile)
+            if not os.path.isdir(snapshotDir):
+                os.makedirs(snapshotDir)
+            # Write and rename, so that readers never see a partial file
+            (fd, tmpName) = tempfile.mkstemp(dir=snapshotDir)
+            f = os.fdopen(fd, "wb")
+            pickle.dump(snap, f, pickle.HIGHEST_PROTOCOL)
+            f.close()
+            os.rename(tmpName, snapshotFile)
+        except (IOError, OSError):
+            pass
+
+    def getHubEntry(self, child):
+        return getHubEntry(child, self.oldFormat)
+
+    def openDelta(self, filename, oldFormat, readOnly, settings, hubs,
+                  snapshot, snapshotDir):
+        """
+        Open a version stored as setting deltas: open its parent version
+        (which may itself be stored as deltas) and apply the changes.
+        """
+        deltaFile = getDeltaFile(filename)
+        (parentName, hubDeltas) = readDelta(deltaFile)
+        parent = RunConfig(os.path.join(os.path.dirname(filename), parentName),
+                           oldFormat=oldFormat, readOnly=readOnly, settings=settings,
+                           hubs=hubs, snapshot=snapshot, snapshotDir=snapshotDir)
+        (self.path, self.tree, self.root) = (parent.path, parent.tree, parent.root)
+        self.filename = os.path.basename(filename)
+        self.modified = False
+        (self.trigroot, self.domCfgs) = (parent.trigroot, parent.domCfgs)
+        (self.oldFormat, self.readOnly) = (oldFormat, readOnly)
+        self.deltaFiles = parent.deltaFiles + [deltaFile]
+        for child in self.root:
+            entry = self.getHubEntry(child)
+            if (entry is None) or (entry[0] not in hubDeltas):
+                continue
+            hub = entry[0]
+            (domName, removed, changes) = hubDeltas[hub]
+            setHubEntry(child, domName)
+            # Only hubs that were loaded
+            domCfg = self.domCfgs.get(hub)
+            if domCfg is not None:
+                domCfg.applyDelta(removed, changes)
+                domCfg.filename = domName + ".xml"
+
+    def getUnstoredHubs(self):
+        """Hubs whose DOM configurations exist only as deltas and were
+        not loaded, so can't be written"""
+        unstored = []
+        if not self.deltaFiles:
+            return unstored
+        for child in self.root:
+            entry = self.getHubEntry(child)
+            if (entry is not None) and (entry[0] not in self.domCfgs) and \
+               not os.path.exists(os.path.join(self.path, RunConfig.DOMPATH,
+                                               "%s.xml" % entry[1])):
+                unstored.append(entry[0])
+        return unstored
+
+    def write(self, newName=None, newVersion=None, newDomCfgName=None, delta=False):
+        """
+        Write the configuration files in place or, given a new name,
+        version and DOM configuration name, write the changed DOM
+        configurations under new names and a new top-level file.  If
+        delta is set, the new version is stored as setting deltas
+        instead (see writeDelta).
+        """
+        if self.readOnly:
+            raise RunConfigException("Can't write read-only configuration %s" % 
+                                     self.filename)
         if (self.root is None) or (self.tree is None):
             return        
+        if delta:
+            self.writeDelta(newName, newVersion, newDomCfgName)
+            return
+        unstored = self.getUnstoredHubs()
+        if unstored:
+            raise RunConfigException("DOM configurations of hubs %s in %s are stored "
+                                     "as deltas and weren't loaded" % \
+                                     (",".join(unstored), self.filename))
         # Save referenced files
         for child in self.root:
-            if ((self.oldFormat and (child.tag == RunConfig.DOMTAG)) or
-                (not self.oldFormat and (child.tag == RunConfig.STRINGHUB))):
-                if self.oldFormat:
-                    hub = child.get('hub')
-                else:
-                    hub = child.get('hubId')
+            entry = self.getHubEntry(child)
+            # Only hubs that were loaded
+            if (entry is not None) and (entry[0] in self.domCfgs):
+                hub = entry[0]
                     
                 if (newVersion is not None) and (newDomCfgName is not None):
-                    # IceTop hubs
-                    h = int(hub)
-                    if (h >= 200) and (h < 220):                    
-                        hubName = "%02dt" % (h-200)
-                    else:
-                        hubName = "%02di" % (h)
-                        
-                    newDomName = "sps-%s-%s-%d" % (hubName,
-                                                   newDomCfgName,
-                                                   newVersion)
-                    if self.domCfgs[hub].modified:
-                        if self.oldFormat:
-                            child.text = newDomName
-                        else:
-                            child.set(RunConfig.DOMATTRIB, newDomName)
+                    newDomName = getDOMConfigName(hub, newDomCfgName, newVersion)
+                    domCfg = self.domCfgs[hub]
+                    if domCfg.modified:
+                        setHubEntry(child, newDomName)
                         self.modified = True                        
-                        self.domCfgs[hub].write(newDomName+".xml")
+                        domCfg.write(newDomName+".xml")
+                    elif not os.path.exists(os.path.join(domCfg.path, domCfg.filename)):
+                        # Stored only as deltas
+                        domCfg.write()
                 else:
                     self.domCfgs[hub].write()
                                 
@@ -227,11 +627,102 @@ class RunConfig(XMLConfig):
         else:
             filename = self.filename
         self.tree.write(self.path+"/"+filename, xml_declaration=True)
-        
+
+    def writeDelta(self, newName, newVersion, newDomCfgName):
+        """
+        Store a new version as the changes to the DOMs of the changed
+        hubs since the version that was opened, in a single file in
+        DELTAPATH, instead of writing new DOM configurations and a new
+        top-level file.  The new version is opened by its usual name,
+        and materialize() writes it out in full.  The versions it is
+        derived from must not be rewritten in place.
+        """
+        from lxml import etree
+        if None in (newName, newVersion, newDomCfgName):
+            raise RunConfigException("Storing %s as a delta needs a new name, version "
+                                     "and DOM configuration name" % self.filename)
+        filename = "%s-V%d.xml" % (newName, newVersion)
+        if os.path.exists(os.path.join(self.path, filename)):
+            raise RunConfigException("%s is already stored in full" % filename)
+        if os.path.exists(os.path.join(self.path, RunConfig.DELTAPATH, filename)):
+            raise RunConfigException("%s is already stored as a delta" % filename)
+        root = etree.Element(RunConfig.DELTATAG, parent=self.filename)
+        modified = [hub for hub in self.domCfgs if self.domCfgs[hub].modified]
+        if modified:
+            parent = RunConfig(os.path.join(self.path, self.filename),
+                               oldFormat=self.oldFormat, readOnly=True, hubs=modified)
+            for child in self.root:
+                entry = self.getHubEntry(child)
+                if (entry is None) or (entry[0] not in modified):
+                    continue
+                hub = entry[0]
+                element = etree.SubElement(root, RunConfig.DELTAHUB, id=hub)
+                element.set(RunConfig.DOMATTRIB,
+                            getDOMConfigName(hub, newDomCfgName, newVersion))
+                self.domCfgs[hub].getDelta(parent.domCfgs[hub], element)
+
+        deltaDir = os.path.join(self.path, RunConfig.DELTAPATH)
+        if not os.path.isdir(deltaDir):
+            os.makedirs(deltaDir)
+        etree.ElementTree(root).write(os.path.join(deltaDir, filename),
+                                      xml_declaration=True, encoding="UTF-8",
+                                      pretty_print=True)
+
+    def materialize(self):
+        """
+        Write a version opened from deltas as standard pDAQ XML files:
+        the top-level file and the DOM configurations that don't exist
+        yet.  Returns the paths of the files written.
+        """
+        if self.readOnly:
+            raise RunConfigException("Can't write read-only configuration %s" % 
+                                     self.filename)
+        unstored = self.getUnstoredHubs()
+        if unstored:
+            raise RunConfigException("DOM configurations of hubs %s in %s are stored "
+                                     "as deltas and weren't loaded" % \
+                                     (",".join(unstored), self.filename))
+        written = []
+        for child in self.root:
+            entry = self.getHubEntry(child)
+            if (entry is None) or (entry[0] not in self.domCfgs):
+                continue
+            domCfg = self.domCfgs[entry[0]]
+            path = os.path.join(domCfg.path, domCfg.filename)
+            if not os.path.exists(path):
+                domCfg.write()
+                written.append(path)
+        path = os.path.join(self.path, self.filename)
+        if not os.path.exists(path):
+            self.tree.write(path, xml_declaration=True)
+            written.append(path)
+        return written
+
     def getHubs(self):
         return list(self.domCfgs.keys())
 
+    def setDOMSettings(self, setting, value, match=None):
+        """
+        Set a setting for every DOM for which match(hub, mbid, settings)
+        is true, in one pass over each DOM configuration; the value may
+        be a function of (mbid, settings), as for DOMConfig.setDOMSettings.
+        Returns a dictionary of the DOMs changed in each hub.
+        """
+        if self.readOnly:
+            raise RunConfigException("Can't modify read-only configuration %s" % 
+                                     self.filename)
+        changed = OrderedDict()
+        for hub in sorted(self.domCfgs, key=int):
+            hubMatch = None
+            if match is not None:
+                hubMatch = lambda mbid, settings, hub=hub: match(hub, mbid, settings)
+            changed[hub] = self.domCfgs[hub].setDOMSettings(setting, value, hubMatch)
+        return changed
+
     def removeDOM(self, mbid):
+        if self.readOnly:
+            raise RunConfigException("Can't remove DOMs from read-only configuration %s" % 
+                                     self.filename)
         for h in self.domCfgs:
             removed = self.domCfgs[h].removeDOM(mbid)
             if removed:
@@ -241,8 +732,147 @@ class RunConfig(XMLConfig):
     def getDOMConfigs(self):
         return list(self.domCfgs.values())
 
+    def getDOMConfig(self, mbid):
+        """Return the DOM configuration containing a DOM, or None"""
+        for domCfg in self.domCfgs.values():
+            if mbid in domCfg.doms:
+                return domCfg
+        return None
+
+    def getDOMs(self):
+        domList = []
+        for domCfg in self.domCfgs.values():
+            domList.extend(domCfg.getDOMs())
+        return domList
+
+    def getDOMSetting(self, mbid, setting):
+        domCfg = self.getDOMConfig(mbid)
+        if domCfg is None:
+            return None
+        return domCfg.getDOMSetting(mbid, setting)
+
+    def getFiles(self):
+        """Return the paths of the top-level, trigger and DOM
+        configuration files making up this run configuration"""
+        files = [os.path.join(self.path, self.filename)] + self.deltaFiles
+        if self.trigroot is not None:
+            files.append(os.path.join(self.trigroot.path,
+                                      self.trigroot.filename))
+        for domCfg in self.domCfgs.values():
+            files.append(os.path.join(domCfg.path, domCfg.filename))
+        return files
+
+    def compare(self, other):
+        """
+        Compare the DOM settings with those of another run configuration.
+        Returns a dictionary of the DOMs only in this configuration
+        ('removed'), only in the other ('added'), and, for DOMs in both,
+        the settings that differ as [this, other] pairs ('changed').
+        """
+        settings = {}
+        for domCfg in self.getDOMConfigs():
+            for mbid in domCfg.doms:
+                settings[mbid] = domCfg.getDOMSettings(mbid)
+        otherSettings = {}
+        for domCfg in other.getDOMConfigs():
+            for mbid in domCfg.doms:
+                otherSettings[mbid] = domCfg.getDOMSettings(mbid)
+
+        diff = {"removed": [], "added": [], "changed": {}}
+        for mbid in settings:
+            if mbid not in otherSettings:
+                diff["removed"].append(mbid)
+                continue
+            changed = {}
+            for s in set(settings[mbid]) | set(otherSettings[mbid]):
+                (v1, v2) = (settings[mbid].get(s), otherSettings[mbid].get(s))
+                if v1 != v2:
+                    changed[s] = [v1, v2]
+            if changed:
+                diff["changed"][mbid] = changed
+        for mbid in otherSettings:
+            if mbid not in settings:
+                diff["added"].append(mbid)
+        return diff
+
+def setHubEntry(child, domName):
+    """Set the DOM config name of a top-level hub element"""
+    if child.tag == RunConfig.DOMTAG:
+        child.text = domName
+    else:
+        child.set(RunConfig.DOMATTRIB, domName)
+
+def getDOMConfigName(hub, domCfgName, version):
+    """Name of the DOM configuration of a hub in a new version"""
+    h = int(hub)
+    if isIceTopHub(h):
+        hubName = "%02dt" % (h-200)
+    else:
+        hubName = "%02di" % (h)
+    return "sps-%s-%s-%d" % (hubName, domCfgName, version)
+
+def readBaselines(parent):
+    """ATWD baselines, as [atwd][ch], from a pedestal settings element"""
+    blArr = [[0, 0, 0], [0, 0, 0]]
+    for child in parent:
+        if child.tag == DOMConfig.BASELINETAG:
+            atwd = DOMConfig.ATWDDICT[child.get('atwd')]
+            blArr[atwd][int(child.get('ch'))] = int(child.text)
+    return blArr
+
+def getDeltaFile(filename):
+    """Delta file of a run configuration version stored as deltas"""
+    return os.path.join(os.path.dirname(filename), RunConfig.DELTAPATH,
+                        os.path.basename(filename))
+
+def isDeltaVersion(filename):
+    """Is a run configuration version stored only as deltas?"""
+    return (not os.path.exists(filename)) and os.path.exists(getDeltaFile(filename))
+
+def readDelta(filename):
+    """
+    Read a version stored as deltas, returning the file name of its
+    parent version and, for each changed hub, the (DOM config name,
+    removed DOMs, changed settings by mainboard ID), where changed ATWD
+    baselines are under DOMConfig.BASELINEPARENT.
+    """
+    from lxml import etree
+    root = etree.parse(filename).getroot()
+    if root.tag != RunConfig.DELTATAG:
+        raise RunConfigException("%s is not a run configuration delta" % filename)
+    hubDeltas = OrderedDict()
+    for element in root.iterchildren(tag=RunConfig.DELTAHUB):
+        removed = [e.get('mbid') for e in element.iterchildren(tag=RunConfig.DELTAREMOVED)]
+        changes = OrderedDict()
+        for dom in element.iterchildren(tag="domConfig"):
+            settings = OrderedDict()
+            for child in dom.iterchildren(tag=etree.Element):
+                if child.tag == DOMConfig.BASELINEPARENT:
+                    settings[child.tag] = readBaselines(child)
+                    continue
+                t = child.text
+                if t is not None:
+                    t = t.strip()
+                settings[child.tag] = t
+            changes[dom.get('mbid')] = settings
+        hubDeltas[element.get('id')] = (element.get(RunConfig.DOMATTRIB), removed, changes)
+    return (root.get('parent'), hubDeltas)
+
+def getHubEntry(child, oldFormat=None):
+    """
+    Return the (hub, DOM config name) of a top-level run configuration
+    element listing a DOM configuration in either format (or only the
+    old or new format, if oldFormat is True or False), or None for
+    other elements.
+    """
+    if (child.tag == RunConfig.DOMTAG) and (oldFormat is not False):
+        return (child.get('hub'), child.text.strip())
+    if (child.tag == RunConfig.STRINGHUB) and (oldFormat is not True):
+        return (child.get('hubId'), child.get(RunConfig.DOMATTRIB))
+    return None
+
 if __name__ == "__main__":
-    rc = RunConfig(sys.argv[1], oldFormat=False)
+    rc = RunConfig(sys.argv[1])
 
     testhub = '1'
     testid = 'e9fed8c717dd'
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+#
+# runPipeline.py
+#
+# Apply a sequence of operations (DOM removal, calibration update,
+# bad DOM report) to a run configuration that is parsed once and
+# written once at the end.
+#
+
+from __future__ import print_function
+from builtins import str
+import sys
+import getopt
+import os
+import shlex
+
+from runConfig import RunConfig, RunConfigException
+from nicknames import nicknames
+from removeDOMs import readDOMList, removeDOMs
+from updateCalibration import CalibrationUpdater, savePlotFile
+from badDOMs import getBadDOMs, formatBadDOMs
+
+def usage():
+    """ Print program usage """
+    print("Usage: %s [-htD] [-v ###] [-n new_config_name]" % (sys.argv[0]), \
+          "[-c new_domconfig_name] run_config.xml job_file")
+    print("    -h       print this help message")
+    print("    -t       test run; do not write out new configuration")
+    print("    -v ###   version number of new configuration")
+    print("    -n name  name of new configuration (top level)")
+    print("    -c name  name of new configuration (DOM config base name)")
+    print("    -D       store the new version as setting changes against run_config.xml")
+    print("             instead of new files (see materializeConfig.py)")
+    print("The job file lists one operation per line, applied in order:")
+    print("    remove [-l dom_list] [dom1 dom2...]")
+    print("    calibrate [-si] [-g gain_file] [-d disc_file] [-a atwd_file]", \
+          "[-b baseline_file] [-r beacon_rate] calibration_dir")
+    print("    baddoms")
+    print("with options as for removeDOMs.py and updateCalibration.py.")
+
+def readJob(jobFile):
+    """Read the job file, returning a list of (operation, args) steps"""
+    steps = []
+    try:
+        f = open(jobFile, "r")
+    except IOError:
+        print("ERROR: couldn't open job file", jobFile, file=sys.stderr)
+        sys.exit(-1)
+    for line in f.readlines():
+        if line.strip().startswith("#"):
+            continue
+        words = shlex.split(line)
+        if not words:
+            continue
+        if words[0] not in ("remove", "calibrate", "baddoms"):
+            print("ERROR: unknown operation", words[0], "in job file", \
+                  jobFile, file=sys.stderr)
+            sys.exit(-1)
+        steps.append((words[0], words[1:]))
+    f.close()
+    return steps
+
+def runRemove(rc, nicks, args):
+    opts, args = getopt.gnu_getopt(args, "l:", ["list="])
+    domList = []
+    for d in args:
+        mbid = nicks.findMBID(d)
+        if mbid is None:
+            print("WARNING: couldn't find DOM %s to remove" % d)
+        else:
+            domList.append(mbid)
+    for o, a in opts:
+        if o in ("-l", "--list"):
+            domList.extend(readDOMList(a, nicks))
+    nRemoved = removeDOMs(rc, domList, nicks)
+    return "remove: removed %d of %d DOMs" % (nRemoved, len(domList))
+
+def runCalibrate(rc, nicks, args, dryrun):
+    opts, args = getopt.gnu_getopt(args, "sid:g:a:b:r:",
+                               ["save", "icetop", "disc=", "gain=", "atwd=",
+                                "baseline=", "rate="])
+    if len(args) != 1:
+        raise getopt.GetoptError("calibrate needs one calibration directory")
+    calDir = args[0]
+
+    savePlotResults = False
+    icetopDisable = False
+    files = {}
+    beaconRate = None
+    for o, a in opts:
+        if o in ("-s", "--save"):
+            savePlotResults = True
+        elif o in ("-i", "--icetop"):
+            icetopDisable = True
+        elif o in ("-d", "--disc"):
+            files["discFile"] = a
+        elif o in ("-g", "--gain"):
+            files["gainFile"] = a
+        elif o in ("-a", "--atwd"):
+            files["atwdFile"] = a
+        elif o in ("-b", "--baseline"):
+            files["baselineFile"] = a
+        elif o in ("-r", "--rate"):
+            beaconRate = float(a)
+
+    updater = CalibrationUpdater(nicks, dryrun=dryrun,
+                                 icetopDisable=icetopDisable,
+                                 beaconRate=beaconRate,
+                                 keepRecords=savePlotResults)
+    updater.loadExceptions(**files)
+    updater.updateRunConfig(rc, calDir)
+    updater.diagnostics.printSummary(examples=3)
+    updater.stats.printSummary()
+
+    if savePlotResults:
+        savePlotFile(updater.records.values())
+
+    counts = updater.counts
+    return "calibrate: updated %d DOMs from %s, %d without calibration, %d warnings" \
+        % (counts["calibrated"], calDir, counts["doms"]-counts["calibrated"],
+           counts["warnings"])
+
+def runBadDOMs(rc, nicks, args):
+    badList = getBadDOMs(rc, nicks)
+    return "baddoms: found %d bad DOMs\n%s" % (len(badList), formatBadDOMs(badList))
+
+def main():
+    """
+    Run a job of configuration operations on a single in-memory
+    pDAQ run configuration.
+    """
+    #---------------------------------------------------
+    # Parse command-line options
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "htDv:n:c:",
+                     ["help", "test", "delta", "version=", "name=", "domname="])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage()
+        sys.exit(2)
+
+    dryrun = False
+    cfgVersion = None
+    cfgNewName = None
+    cfgDomName = None
+    storeDelta = False
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-t", "--test"):
+            dryrun = True
+        elif o in ("-D", "--delta"):
+            storeDelta = True
+        elif o in ("-v", "--version"):
+            cfgVersion = int(a)
+        elif o in ("-n", "--name"):
+            cfgNewName = a
+        elif o in ("-c", "--domname"):
+            cfgDomName = a
+        else:
+            assert False, "unhandled option"
+
+    if len(args) != 2:
+        usage()
+        sys.exit(2)
+
+    cfgName = args[0]
+    steps = readJob(args[1])
+
+    # Check that renaming options have been specified
+    if not dryrun and (cfgNewName is None or \
+                       cfgVersion is None or \
+                       cfgDomName is None):
+        print(("ERROR: if you do not specify -v -n and -c "
+               "this program will overwrite configuration "
+               "files (bad)!"), file=sys.stderr)
+        print("-"*60, file=sys.stderr)
+        usage()
+        sys.exit(-1)
+
+    # Check that new and old names are not the same
+    if not dryrun:
+        cfgBase = os.path.splitext(os.path.basename(cfgName))[0]
+        cfgBaseNew = "%s-V%d" % (os.path.splitext(os.path.basename(cfgNewName))[0], cfgVersion)
+        if (cfgBase == cfgBaseNew):
+            print("ERROR: new configuration name cannot be the same as original!", file=sys.stderr)
+            sys.exit(-1)
+
+    # Parse the run configuration files
+    try:
+        rc = RunConfig(cfgName)
+    except IOError:
+        print("ERROR: couldn't read configuration file %s, exiting." % cfgName)
+        sys.exit(-1)
+    except RunConfigException as err:
+        print("ERROR:", str(err), file=sys.stderr)
+        sys.exit(-1)
+
+    # DOM positions, names, etc.
+    nicks = nicknames()
+
+    report = []
+    for (op, stepArgs) in steps:
+        print("-"*60)
+        print("Running", op, " ".join(stepArgs))
+        try:
+            if op == "remove":
+                report.append(runRemove(rc, nicks, stepArgs))
+            elif op == "calibrate":
+                report.append(runCalibrate(rc, nicks, stepArgs, dryrun))
+            elif op == "baddoms":
+                report.append(runBadDOMs(rc, nicks, stepArgs))
+        except getopt.GetoptError as err:
+            print("ERROR: bad arguments for", op, ":", str(err), file=sys.stderr)
+            sys.exit(2)
+
+    # Save updated run configuration files
+    if not dryrun:
+        try:
+            rc.write(newName=cfgNewName, newVersion=cfgVersion, newDomCfgName=cfgDomName,
+                     delta=storeDelta)
+        except RunConfigException as err:
+            print("ERROR:", str(err))
+            sys.exit(-1)
+
+    print("="*60)
+    for r in report:
+        print(r)
+
+if __name__ == "__main__":
+    main()
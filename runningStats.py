@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+#
+# runningStats.py
+#
+# Online (single-pass, constant memory) statistics of the per-DOM
+# setting changes made by updateCalibration, by quantity and DOM
+# category.  Statistics from separate runs can be merged.
+#
+
+from __future__ import print_function
+from builtins import range
+from builtins import object
+import sys
+import math
+from collections import OrderedDict
+
+# Quantities summarized: (name, record key, index into a list-valued
+# record entry, histogram range and number of bins)
+STAT_QUANTITIES = [
+    ("HV change (V)",            "hvDiff",          None, -50., 50., 20),
+    ("gain change (%)",          "gainDiffPct",     None, -50., 50., 20),
+    ("SPE disc. change",         "speDiscDiff",     None, -20., 20., 20),
+    ("SPE disc. change (PE)",    "speDiscDiffPE",   None, -0.2, 0.2, 20),
+    ("ATWD0 bias change",        "atwdFreqDiff",    0,    -20., 20., 20),
+    ("ATWD1 bias change",        "atwdFreqDiff",    1,    -20., 20., 20),
+    ("ATWD0 freq. change (MHz)", "atwdFreqMHzDiff", 0,    -5.,  5.,  20),
+    ("ATWD1 freq. change (MHz)", "atwdFreqMHzDiff", 1,    -5.,  5.,  20),
+    ]
+
+class RunningStats(object):
+    """
+    Count, mean, variance (Welford's method), minimum, maximum and a
+    fixed-bin histogram (with underflow and overflow) of a quantity.
+    """
+    def __init__(self, lo, hi, nBins):
+        (self.lo, self.hi, self.nBins) = (lo, hi, nBins)
+        self.n = 0
+        self.mean = 0.
+        self.m2 = 0.
+        self.min = None
+        self.max = None
+        # Underflow, bins, overflow
+        self.bins = [0]*(nBins+2)
+
+    def add(self, x):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta/self.n
+        self.m2 += delta*(x - self.mean)
+        if (self.min is None) or (x < self.min):
+            self.min = x
+        if (self.max is None) or (x > self.max):
+            self.max = x
+        if x < self.lo:
+            self.bins[0] += 1
+        elif x >= self.hi:
+            self.bins[-1] += 1
+        else:
+            self.bins[1 + int((x-self.lo)/(self.hi-self.lo)*self.nBins)] += 1
+
+    def merge(self, other):
+        """Add the statistics of another set with the same binning"""
+        if (other.lo, other.hi, other.nBins) != (self.lo, self.hi, self.nBins):
+            raise ValueError("can't merge statistics with different binning")
+        if other.n == 0:
+            return
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.mean += delta*other.n/n
+        self.m2 += other.m2 + delta*delta*self.n*other.n/n
+        self.n = n
+        if (self.min is None) or (other.min < self.min):
+            self.min = other.min
+        if (self.max is None) or (other.max > self.max):
+            self.max = other.max
+        self.bins = [a+b for (a, b) in zip(self.bins, other.bins)]
+
+    def getStdDev(self):
+        if self.n < 2:
+            return 0.
+        return math.sqrt(self.m2/(self.n-1))
+
+    def getQuantile(self, q):
+        """Estimate a quantile from the histogram, interpolating within
+        a bin; under- and overflows are placed at the minimum and maximum"""
+        if self.n == 0:
+            return None
+        target = q*self.n
+        width = (self.hi-self.lo)/self.nBins
+        count = 0
+        for (i, c) in enumerate(self.bins):
+            if (c > 0) and (count + c >= target):
+                if i == 0:
+                    return self.min
+                if i == self.nBins+1:
+                    return self.max
+                lo = self.lo + (i-1)*width
+                value = lo + width*(target-count)/c
+                return min(max(value, self.min), self.max)
+            count += c
+        return self.max
+
+    def toDict(self):
+        return {"range": [self.lo, self.hi, self.nBins], "n": self.n,
+                "mean": self.mean, "m2": self.m2, "min": self.min,
+                "max": self.max, "bins": list(self.bins)}
+
+    @classmethod
+    def fromDict(cls, d):
+        stats = cls(*d["range"])
+        (stats.n, stats.mean, stats.m2) = (d["n"], d["mean"], d["m2"])
+        (stats.min, stats.max) = (d["min"], d["max"])
+        stats.bins = list(d["bins"])
+        return stats
+
+class StatsTable(object):
+    """RunningStats for each quantity in STAT_QUANTITIES and DOM category"""
+    def __init__(self):
+        # (quantity, category) -> RunningStats
+        self.stats = OrderedDict()
+
+    def getStats(self, quantity, category):
+        key = (quantity[0], category)
+        if key not in self.stats:
+            self.stats[key] = RunningStats(*quantity[3:])
+        return self.stats[key]
+
+    def addRecord(self, record):
+        """Add the changes in an updateCalibration per-DOM record"""
+        if not record["calibrated"]:
+            return
+        for quantity in STAT_QUANTITIES:
+            (name, key, index) = quantity[:3]
+            value = record.get(key)
+            if (value is not None) and (index is not None):
+                value = value[index]
+            if (value is None) or math.isnan(value) or math.isinf(value):
+                continue
+            self.getStats(quantity, record["category"]).add(value)
+
+    def merge(self, other):
+        for key in other.stats:
+            if key not in self.stats:
+                self.stats[key] = RunningStats.fromDict(other.stats[key].toDict())
+            else:
+                self.stats[key].merge(other.stats[key])
+
+    def toDict(self):
+        return {"stats": [[name, category, self.stats[(name, category)].toDict()]
+                          for (name, category) in self.stats]}
+
+    @classmethod
+    def fromDict(cls, d):
+        table = cls()
+        for (name, category, stats) in d["stats"]:
+            table.stats[(name, category)] = RunningStats.fromDict(stats)
+        return table
+
+    def printSummary(self, out=sys.stdout):
+        """Print a table of the statistics, in the order of STAT_QUANTITIES"""
+        if not self.stats:
+            return
+        print("%-25s %-7s %5s %9s %9s %9s %9s %9s" % \
+              ("change", "DOMs", "n", "mean", "std dev", "min", "median", "max"),
+              file=out)
+        for quantity in STAT_QUANTITIES:
+            for (name, category) in self.stats:
+                if name != quantity[0]:
+                    continue
+                s = self.stats[(name, category)]
+                print("%-25s %-7s %5d %9.3f %9.3f %9.3f %9.3f %9.3f" % \
+                      (name, category, s.n, s.mean, s.getStdDev(), s.min,
+                       s.getQuantile(0.5), s.max), file=out)
+        out.flush()
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+#
+# scanCalibration.py
+#
+# Check every DOMCal result in a calibration directory, in parallel,
+# for the problems that would make updateCalibration fall back to
+# defaults, and report them by DOM.  DOMs may have several results
+# (e.g. unvetted ones in subdirectories); all of them are checked.
+#
+
+from __future__ import print_function
+from builtins import str
+import sys
+import getopt
+import os
+import math
+
+from calibration import CalibrationIndex, CalibrationResults
+from runConfig import RunConfig, RunConfigException
+from nicknames import nicknames
+from updateCalibration import ATWD_FREQ_MHZ
+
+# DOM status, in increasing order of severity
+STATUS_OK = "OK"
+STATUS_FALLBACK = "FALLBACK"
+STATUS_MISSING_FIT = "MISSING_FIT"
+STATUS_PARSE_ERROR = "PARSE_ERROR"
+STATUS_LIST = [STATUS_OK, STATUS_FALLBACK, STATUS_MISSING_FIT, STATUS_PARSE_ERROR]
+
+def usage():
+    """ Print program usage """
+    print("Usage: %s [-h] [-j jobs] [-o report_file]" % (sys.argv[0]), \
+          "calibration_dir [run_config.xml]")
+    print("    -h       print this help message")
+    print("    -j jobs  number of parallel processes (default: all cores)")
+    print("    -o file  write the per-DOM report to a file instead of stdout")
+    print("DOMs are classified as:")
+    print("    %-12s all fits present and usable" % STATUS_OK)
+    print("    %-12s PMT discriminator fit missing or bad; pulser disc. used" % STATUS_FALLBACK)
+    print("    %-12s HV/gain, discriminator or ATWD frequency fit missing/unusable" \
+          % STATUS_MISSING_FIT)
+    print("    %-12s file could not be parsed" % STATUS_PARSE_ERROR)
+    print("Every result of a DOM is checked; the one updateCalibration uses is")
+    print("marked in the 'use' column.")
+
+def checkCalibration(args):
+    """
+    Check a calibration result for one DOM, given by its name relative
+    to the calibration directory, returning (mbid, name, status,
+    problem list, DOMCal version, temperature).
+    """
+    (calDir, mbid, filename) = args
+    cal = CalibrationResults(calDir, filter=filename)
+    if not cal.exists(mbid):
+        return (mbid, filename, STATUS_PARSE_ERROR, ["couldn't parse %s" % filename],
+                None, None)
+
+    root = cal.cal[mbid]
+    version = root.get('version')
+    temperature = root.findtext('temperature')
+    if temperature is not None:
+        temperature = temperature.strip()
+
+    problems = []
+    status = STATUS_OK
+
+    if cal.getFitCal(mbid, 'hvGainCal') is None:
+        problems.append("no hvGainCal fit")
+        status = STATUS_MISSING_FIT
+
+    if cal.getFitCal(mbid, 'discriminator', filters=[['id', 'spe']]) is None:
+        problems.append("no SPE discriminator fit")
+        status = STATUS_MISSING_FIT
+
+    for atwd in range(2):
+        freqCal = cal.getFitCal(mbid, 'atwdfreq', [['atwd', str(atwd)]])
+        if (freqCal is None) or (None in freqCal):
+            problems.append("no ATWD%d frequency fit" % atwd)
+            status = STATUS_MISSING_FIT
+            continue
+        (c0, c1, c2) = freqCal
+        if (c2 == 0) or (c1*c1 - 4*(c0-ATWD_FREQ_MHZ)*c2 < 0):
+            problems.append("ATWD%d frequency fit unsolvable at %g MHz" \
+                            % (atwd, ATWD_FREQ_MHZ))
+            status = STATUS_MISSING_FIT
+
+    pmtDiscCal = cal.getFitCal(mbid, 'pmtDiscCal')
+    if pmtDiscCal is None:
+        problems.append("no pmtDiscCal fit")
+    else:
+        (b, m) = pmtDiscCal
+        # DOMCal 7.6.0 had a bug that resulted in garbage here if the HV was off
+        if math.isnan(b) or math.isnan(m) or (b > 0) or (m < 0):
+            problems.append("bad pmtDiscCal fit (%g, %g)" % (b, m))
+            pmtDiscCal = None
+    if (pmtDiscCal is None) and (status == STATUS_OK):
+        status = STATUS_FALLBACK
+
+    return (mbid, filename, status, problems, version, temperature)
+
+def main():
+    """
+    Scan a DOMCal result directory and report the calibration
+    quality of each DOM, cross-checked against a run configuration.
+    """
+    #---------------------------------------------------
+    # Parse command-line options
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hj:o:",
+                     ["help", "jobs=", "output="])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage()
+        sys.exit(2)
+
+    jobs = None
+    reportFile = None
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-j", "--jobs"):
+            jobs = int(a)
+        elif o in ("-o", "--output"):
+            reportFile = a
+        else:
+            assert False, "unhandled option"
+
+    if len(args) not in (1, 2):
+        usage()
+        sys.exit(2)
+
+    calDir = args[0]
+    rc = None
+    if len(args) > 1:
+        try:
+            # Only the DOMs are needed
+            rc = RunConfig(args[1], readOnly=True, settings=[])
+        except IOError:
+            print("ERROR: couldn't read configuration file %s, exiting." % args[1])
+            sys.exit(-1)
+        except RunConfigException as err:
+            print("ERROR:", str(err), file=sys.stderr)
+            sys.exit(-1)
+
+    # DOM positions, names, etc.
+    nicks = nicknames()
+
+    index = CalibrationIndex(calDir)
+    calFiles = index.entries
+    tasks = [(calDir, mbid, entry["name"]) for mbid in sorted(calFiles)
+             for entry in sorted(calFiles[mbid], key=lambda e: e["name"])]
+    print("Scanning", len(tasks), "calibration results for", len(calFiles), \
+          "DOMs in", calDir)
+
+    import multiprocessing
+    pool = multiprocessing.Pool(processes=jobs)
+    results = pool.map(checkCalibration, tasks, chunksize=16)
+    pool.close()
+    pool.join()
+
+    # Sort by position, with unknown DOMs last
+    def posKey(result):
+        pos = nicks.getDOMPosition(result[0])
+        if pos is None:
+            return (1, 0, 0, result[0], result[1])
+        return (0, pos[0], pos[1], result[0], result[1])
+    results.sort(key=posKey)
+
+    configDOMs = set()
+    if rc is not None:
+        configDOMs = set(rc.getDOMs())
+
+    if reportFile is not None:
+        f = open(reportFile, "w")
+    else:
+        f = sys.stdout
+    f.write("# %-12s %-6s %-20s %-12s %-8s %-6s %-3s %-3s %-28s %s\n" % \
+            ("mbid", "pos", "name", "status", "version", "temp", "cfg", "use",
+             "file", "problems"))
+    counts = dict([(s, 0) for s in STATUS_LIST])
+    for (mbid, filename, status, problems, version, temperature) in results:
+        counts[status] += 1
+        pos = nicks.getDOMPosition(mbid)
+        if pos is not None:
+            posStr = "%02d-%02d" % (pos[0], pos[1])
+        else:
+            posStr = "-"
+        if rc is not None:
+            inConfig = (mbid in configDOMs) and "yes" or "no"
+        else:
+            inConfig = "-"
+        used = (filename == index.getFile(mbid)) and "yes" or "no"
+        f.write("  %-12s %-6s %-20s %-12s %-8s %-6s %-3s %-3s %-28s %s\n" % \
+                (mbid, posStr, nicks.getDOMName(mbid), status, version,
+                 temperature, inConfig, used, filename, "; ".join(problems)))
+    if reportFile is not None:
+        f.close()
+        print("Wrote report for", len(results), "results to", reportFile)
+
+    print("-"*60)
+    for s in STATUS_LIST:
+        print("%-12s %5d" % (s, counts[s]))
+    if rc is not None:
+        noCal = [mbid for mbid in rc.getDOMs() if mbid not in calFiles]
+        notConfigured = [mbid for mbid in calFiles if mbid not in configDOMs]
+        print("%d DOMs in %s have no calibration results" % \
+              (len(noCal), os.path.basename(args[1])))
+        for mbid in noCal:
+            pos = nicks.getDOMPosition(mbid)
+            print("    ", mbid, pos and "%02d-%02d" % (pos[0], pos[1]), \
+                  nicks.getDOMName(mbid))
+        print("%d calibration results are for DOMs not in the configuration" % \
+              len(notConfigured))
+
+if __name__ == "__main__":
+    main()
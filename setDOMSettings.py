@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+#
+# setDOMSettings.py
+#
+# Set one DOM setting for all DOMs in a run configuration that match
+# a selection by hub, string, category or current settings.
+#
+
+from __future__ import print_function
+from builtins import str
+import sys
+import getopt
+import os
+
+from runConfig import RunConfig, RunConfigException, getStringHubs, parseIntList
+from nicknames import nicknames
+from geometry import Geometry, INICE, ICETOP, SCINT
+
+def usage():
+    """ Print program usage """
+    print("Usage: %s [-htD] [-v ###] [-n new_config_name]" % (sys.argv[0]), \
+          "[-c new_domconfig_name] [--hubs hub_list] [--strings string_list]", \
+          "[--category cat] [--where setting=value] [--add]", \
+          "run_config.xml setting value")
+    print("    -h       print this help message")
+    print("    -t       test run; do not write out new configuration")
+    print("    -v ###   version number of new configuration")
+    print("    -n name  name of new configuration (top level)")
+    print("    -c name  name of new configuration (DOM config base name)")
+    print("    -D       store the new version as setting changes against run_config.xml")
+    print("             instead of new files (see materializeConfig.py)")
+    print("    --hubs list      only DOMs on these hubs (e.g. 1-10,201)")
+    print("    --strings list   only DOMs on these strings (e.g. 1-10,21)")
+    print("    --category cat   only %s, %s or %s DOMs" % (INICE, ICETOP, SCINT))
+    print("    --where s=v      only DOMs whose setting s is v; may be repeated")
+    print("    --add            add value to the current (integer) setting")
+
+def getMatch(nicks, strings=None, categories=None, where=None):
+    """
+    Return a function of (hub, mbid, settings) selecting DOMs on the
+    given strings, in the given categories and with the given settings.
+    """
+    geometry = Geometry(nicks)
+    def match(hub, mbid, settings):
+        if strings is not None:
+            pos = nicks.getDOMPosition(mbid)
+            if (pos is None) or (pos[0] not in strings):
+                return False
+        if categories is not None:
+            category = geometry.getCategory(mbid)
+            if (category is None) or (category[0] not in categories):
+                return False
+        if where is not None:
+            for (s, v) in where:
+                if settings.get(s) != v:
+                    return False
+        return True
+    return match
+
+def main():
+    """
+    Set a DOM setting across a pDAQ run configuration.
+    """
+    #---------------------------------------------------
+    # Parse command-line options
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "htDv:n:c:",
+                     ["help", "test", "delta", "version=", "name=", "domname=",
+                      "hubs=", "strings=", "category=", "where=", "add"])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage()
+        sys.exit(2)
+
+    dryrun = False
+    cfgVersion = None
+    cfgNewName = None
+    cfgDomName = None
+    storeDelta = False
+    hubs = None
+    strings = None
+    categories = None
+    where = None
+    add = False
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-t", "--test"):
+            dryrun = True
+        elif o in ("-D", "--delta"):
+            storeDelta = True
+        elif o in ("-v", "--version"):
+            cfgVersion = int(a)
+        elif o in ("-n", "--name"):
+            cfgNewName = a
+        elif o in ("-c", "--domname"):
+            cfgDomName = a
+        elif o == "--hubs":
+            hubs = parseIntList(a)
+        elif o == "--strings":
+            strings = parseIntList(a)
+        elif o == "--category":
+            if a not in (INICE, ICETOP, SCINT):
+                print("ERROR: unknown DOM category", a)
+                sys.exit(2)
+            categories = (categories or []) + [a]
+        elif o == "--where":
+            if "=" not in a:
+                print("ERROR: --where needs setting=value")
+                sys.exit(2)
+            where = (where or []) + [tuple(a.split("=", 1))]
+        elif o == "--add":
+            add = True
+        else:
+            assert False, "unhandled option"
+
+    if len(args) != 3:
+        usage()
+        sys.exit(2)
+
+    (cfgName, setting, value) = args
+
+    # Check that renaming options have been specified
+    if not dryrun and (cfgNewName is None or \
+                       cfgVersion is None or \
+                       cfgDomName is None):
+        print(("ERROR: if you do not specify -v -n and -c "
+               "this program will overwrite configuration "
+               "files (bad)!"), file=sys.stderr)
+        print("-"*60, file=sys.stderr)
+        usage()
+        sys.exit(-1)
+
+    # Check that new and old names are not the same
+    if not dryrun:
+        cfgBase = os.path.splitext(os.path.basename(cfgName))[0]
+        cfgBaseNew = "%s-V%d" % (os.path.splitext(os.path.basename(cfgNewName))[0], cfgVersion)
+        if (cfgBase == cfgBaseNew):
+            print("ERROR: new configuration name cannot be the same as original!", file=sys.stderr)
+            sys.exit(-1)
+
+    # Only read the hubs that can hold DOMs on the strings
+    if (strings is not None) and (hubs is None):
+        hubs = getStringHubs(strings)
+
+    if add:
+        try:
+            delta = int(value)
+        except ValueError:
+            print("ERROR: --add needs an integer value, not %s" % value)
+            usage()
+            sys.exit(2)
+        value = lambda mbid, settings: int(settings[setting]) + delta
+
+    # Parse the run configuration files
+    try:
+        rc = RunConfig(cfgName, hubs=hubs)
+    except IOError:
+        print("ERROR: couldn't read configuration file %s, exiting." % cfgName)
+        sys.exit(-1)
+    except RunConfigException as err:
+        print("ERROR:", str(err), file=sys.stderr)
+        sys.exit(-1)
+
+    nicks = nicknames()
+    match = getMatch(nicks, strings=strings, categories=categories, where=where)
+
+    try:
+        changed = rc.setDOMSettings(setting, value, match=match)
+    except (RunConfigException, ValueError) as err:
+        # A missing setting, or one that can't be added to
+        print("ERROR:", str(err))
+        usage()
+        sys.exit(2)
+
+    nChanged = 0
+    for hub in changed:
+        nDOMs = len(rc.domCfgs[hub].getDOMs())
+        print("hub %3s: changed %s for %d of %d DOMs" % \
+              (hub, setting, len(changed[hub]), nDOMs))
+        nChanged += len(changed[hub])
+    print("Changed %s for %d DOMs" % (setting, nChanged))
+
+    # Save updated run configuration files
+    if not dryrun:
+        try:
+            rc.write(newName=cfgNewName, newVersion=cfgVersion, newDomCfgName=cfgDomName,
+                     delta=storeDelta)
+        except RunConfigException as err:
+            print("ERROR:", str(err))
+            sys.exit(-1)
+
+if __name__ == "__main__":
+    main()
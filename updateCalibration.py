@@ -10,10 +10,18 @@ import os
 import re
 import json
 import math
+import time
+import copy
+import itertools
+from collections import OrderedDict, deque
 
-from calibration import *
-from runConfig import *
-from nicknames import *
+from calibration import CalibrationIndex, CalibrationResults, POLICIES, POLICY_NEWEST, \
+    POLICY_VETTED, findCalibrationFiles, isCalibrationArchive
+from runConfig import RunConfig, RunConfigException, fileStats, getStringHubs, parseIntList
+from nicknames import nicknames
+from geometry import Geometry, INICE, ICETOP, SCINT
+from diagnostics import Diagnostics
+from runningStats import StatsTable
 
 # Calibration settings rules
 GAIN_SCINT = 4.7e6
@@ -32,6 +40,17 @@ ATWD_FREQ_MHZ = 300.
 MAX_HV = 3300
 MAX_HV_SCINT = 2500
 
+# Rule parameters that can be changed for a CalibrationUpdater (see --sweep)
+DEFAULT_RULES = OrderedDict([("GAIN_SCINT", GAIN_SCINT),
+                             ("GAIN_INICE", GAIN_INICE),
+                             ("GAIN_IT_HIGH", GAIN_IT_HIGH),
+                             ("GAIN_IT_LOW", GAIN_IT_LOW),
+                             ("DISC_SCINT_PE", DISC_SCINT_PE),
+                             ("DISC_INICE_PE", DISC_INICE_PE),
+                             ("ATWD_FREQ_MHZ", ATWD_FREQ_MHZ),
+                             ("MAX_HV", MAX_HV),
+                             ("MAX_HV_SCINT", MAX_HV_SCINT)])
+
 # Warning settings
 WARN_HV_CHANGE = 15
 WARN_SPE_DISC_CHANGE = 5
@@ -43,12 +62,33 @@ WARN_MAX_GAIN_DIFF_PCT = 15
 # Difference output log for plotting
 OUTPUT_FILE = "calupdate.txt"
 
+# Records per write of the per-DOM record stream
+STREAM_BATCH_SIZE = 64
+
+# Number of DOMs whose calibration results are read ahead of the
+# update, and threads reading them
+PREFETCH_DEPTH = 16
+PREFETCH_THREADS = 4
+
+# Format version of the partial results written with --shard
+SHARD_VERSION = 1
+
 def usage():
     """ Print program usage """
     print("Usage: %s [-htsi] [-v ###] [-n new_config_name]" % (sys.argv[0]), \
         "[-c new_domconfig_name] [-g gain_file]",\
         "[-d disc_file] [-a atwd_file] [-b baseline_file]", \
-        "[-r beacon_rate] run_config.xml calibration_dir")
+        "[-r beacon_rate] [-w seconds] [-H history_file]", \
+        "[-o record_file] [-W warning_file] [-p depth] [-VD]", \
+        "[--policy vetted|newest]", \
+        "[--hubs hub_list | --strings string_list]", \
+        "[--sweep NAME=v1,v2... [--choose N]]", \
+        "[--shard shard_file]", \
+        "run_config.xml calibration_dir")
+    print("       %s --merge [-tsD] [-v ###] [-n new_config_name]" % (sys.argv[0]), \
+        "[-c new_domconfig_name] [-H history_file] [-o record_file] [-W warning_file]", \
+        "run_config.xml shard_file...")
+    print("       %s --reduce record_file" % (sys.argv[0]))
     print("    -h       print this help message")
     print("    -t       test run; do not write out new configuration")
     print("    -s       save differences in settings for later plotting")
@@ -58,9 +98,39 @@ def usage():
     print("    -a       ATWD override file")
     print("    -b       baseline override file")
     print("    -r       target beacon rate in Hz")
+    print("    -w secs  watch calibration_dir, recalculating settings as")
+    print("             results arrive; write configuration when interrupted")
+    print("    -H file  append per-DOM results to a calibration history file")
+    print("    -o file  stream per-DOM results to a file as JSON, one DOM per line")
+    print("    -W file  write all warnings, grouped by category, to a file")
+    print("    -p N     read calibration results for up to N DOMs ahead (default %d;" \
+          % PREFETCH_DEPTH)
+    print("             0 reads each DOM's results when it is updated)")
+    print("    -V       print each warning as it occurs, not just the summary")
+    print("    -D       store the new version as setting changes against run_config.xml")
+    print("             instead of new files (see materializeConfig.py)")
+    print("    --policy p     choose between several results for a DOM by policy:")
+    print("             %s (default): results in calibration_dir before those" % POLICY_VETTED)
+    print("             in subdirectories, then the newest by DOMCal date;")
+    print("             %s: the newest, wherever it is" % POLICY_NEWEST)
     print("    -v ###   version number of new configuration")
     print("    -n name  name of new configuration (top level)")
-    print("    -c name  name of new configuration (DOM config base name)")    
+    print("    -c name  name of new configuration (DOM config base name)")
+    print("    --hubs list    only read, update and write these hubs (e.g. 1-10,201)")
+    print("    --strings list only update DOMs on these strings (e.g. 1-10,21)")
+    print("    --sweep NAME=v1,v2,...")
+    print("             compare the results of a rule parameter (e.g. GAIN_INICE,")
+    print("             DISC_INICE_PE) over a list of values; may be repeated for")
+    print("             a grid of values.  Nothing is written unless --choose is given.")
+    print("    --choose N     write the configuration for sweep variant N")
+    print("    --shard file   save the new settings, records, warnings and statistics")
+    print("             for the selected hubs or strings to a file instead of")
+    print("             writing the configuration")
+    print("    --merge  combine shard files made from run_config.xml, with disjoint")
+    print("             DOMs, and write a single new configuration")
+    print("    --reduce file  save differences from a per-DOM result file")
+    print("             for plotting, as with -s")
+    print("   calibration_dir may also be a .tar, .tar.gz or .zip archive of results")    
 
 def getGainExceptions(filename):
     gainExc = {}
@@ -183,6 +253,822 @@ def getRateSetting(rate):
     
     return rate_int
 
+def getCalibration(calDir, mbid, index=None):
+    """
+    Read the calibration results for a DOM, preferring vetted results
+    in the calibration directory over those in a subdirectory, or as
+    chosen by a calibration index.  If the preferred results can't be
+    parsed the next ones are used.  Returns None if there are no
+    results for the DOM.
+    """
+    if index is None:
+        index = CalibrationIndex(calDir)
+    for header in index.getCandidates(mbid):
+        cal = CalibrationResults(calDir, filter=header["name"])
+        if cal.exists(mbid):
+            return cal
+    return None
+
+
+def prefetchCalibrations(calDir, mbids, depth=PREFETCH_DEPTH,
+                         threads=PREFETCH_THREADS, policy=POLICY_VETTED):
+    """
+    Generate (mbid, calibration results) for a list of DOMs in order,
+    with the results for up to depth DOMs ahead read and parsed in a
+    pool of threads while the caller works on the current one.
+    """
+    index = CalibrationIndex(calDir, policy)
+    if depth <= 0:
+        for mbid in mbids:
+            yield (mbid, getCalibration(calDir, mbid, index))
+        return
+
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(threads, depth))
+    pending = deque()
+    try:
+        for mbid in mbids:
+            pending.append((mbid, pool.apply_async(getCalibration,
+                                                   (calDir, mbid, index))))
+            if len(pending) > depth:
+                (m, result) = pending.popleft()
+                yield (m, result.get())
+        while pending:
+            (m, result) = pending.popleft()
+            yield (m, result.get())
+    finally:
+        pool.terminate()
+        pool.join()
+
+def getPlotResults(records):
+    """Reduce per-DOM records to the lists of setting differences
+    saved for plotting"""
+    (hvDiffList, hvDiffListIT, gainDiffList, gainDiffListIT,
+     speDiscList, speDiscListIT, speDiscPEList, atwdFreqList,
+     atwdFreqMHzList) = ([], [], [], [], [], [], [], [], [])
+    (hvDiffListScint, gainDiffListScint, speDiscListScint) = ([],[],[])
+
+    for record in records:
+        if not record["calibrated"]:
+            continue
+        if record["category"] == ICETOP:
+            hvDiffListIT.append(record["hvDiff"])
+            gainDiffListIT.append(record["gainDiffPct"])
+            speDiscListIT.append(record["speDiscDiff"])
+        elif record["category"] == SCINT:
+            hvDiffListScint.append(record["hvDiff"])
+            gainDiffListScint.append(record["gainDiffPct"])
+            speDiscListScint.append(record["speDiscDiff"])
+        else:
+            hvDiffList.append(record["hvDiff"])
+            gainDiffList.append(record["gainDiffPct"])
+            speDiscList.append(record["speDiscDiff"])
+            speDiscPEList.append(record["speDiscDiffPE"])
+        atwdFreqList.extend(record["atwdFreqDiff"])
+        atwdFreqMHzList.extend(record["atwdFreqMHzDiff"])
+
+    return {"hvDiffList":hvDiffList,
+            "hvDiffListIT":hvDiffListIT,
+            "gainDiffList":gainDiffList,
+            "gainDiffListIT":gainDiffListIT,
+            "speDiscList":speDiscList,
+            "speDiscPEList":speDiscPEList,
+            "speDiscListIT":speDiscListIT,
+            "hvDiffListScint":hvDiffListScint,
+            "gainDiffListScint":gainDiffListScint,
+            "speDiscListScint":speDiscListScint,
+            "atwdFreqList":atwdFreqList,
+            "atwdFreqMHzList":atwdFreqMHzList}
+
+def savePlotFile(records):
+    print("Saving differences in calibration to file",OUTPUT_FILE)
+    f = open(OUTPUT_FILE, 'w')
+    json.dump(getPlotResults(records), f)
+    f.close()
+
+class RecordStream(object):
+    """
+    Newline-delimited JSON output of per-DOM records, written as each
+    DOM is processed and flushed in batches.  A DOM may appear more than
+    once (e.g. in watch mode); its last record supersedes earlier ones.
+    """
+    def __init__(self, filename, batchSize=STREAM_BATCH_SIZE):
+        self.f = open(filename, "w")
+        self.batchSize = batchSize
+        self.buffer = []
+
+    def write(self, record):
+        self.buffer.append(json.dumps(record)+"\n")
+        if len(self.buffer) >= self.batchSize:
+            self.flush()
+
+    def flush(self):
+        self.f.write("".join(self.buffer))
+        self.f.flush()
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+def readRecordStream(filename):
+    """Read the latest record for each DOM from a record stream"""
+    records = OrderedDict()
+    f = open(filename, "r")
+    for line in f:
+        if line.strip():
+            record = json.loads(line)
+            records[record["mbid"]] = record
+    f.close()
+    return records
+
+def writeShard(filename, shard):
+    """Write the partial results of a shard, replacing the file only
+    once it is complete"""
+    tmpName = filename + ".tmp"
+    f = open(tmpName, "w")
+    json.dump(shard, f)
+    f.close()
+    os.rename(tmpName, filename)
+
+def readShard(filename):
+    f = open(filename, "r")
+    try:
+        shard = json.load(f)
+    finally:
+        f.close()
+    if (not isinstance(shard, dict)) or (shard.get("version") != SHARD_VERSION):
+        raise ValueError("%s is not a version %d shard file" % (filename, SHARD_VERSION))
+    shard["filename"] = filename
+    return shard
+
+def checkShards(shards, cfgName):
+    """
+    Check that shards can be merged: they were all made from the same,
+    unchanged, run configuration, with the same options, and no DOM is
+    in more than one of them.  Raises ValueError if not.
+    """
+    cfgPath = os.path.abspath(cfgName)
+    owner = {}
+    for shard in shards:
+        if shard["config"] != cfgPath:
+            raise ValueError("%s was made from %s, not %s" % \
+                             (shard["filename"], shard["config"], cfgPath))
+        if shard["options"] != shards[0]["options"]:
+            raise ValueError("%s and %s were made with different options" % \
+                             (shards[0]["filename"], shard["filename"]))
+        # JSON turns the (file, mtime, size) tuples into lists
+        files = [f for (f, mtime, size) in shard["files"]]
+        if [list(s) for s in fileStats(files)] != shard["files"]:
+            raise ValueError("configuration files changed since %s was made" % \
+                             shard["filename"])
+        for record in shard["records"]:
+            if record["mbid"] in owner:
+                raise ValueError("DOM %s is in both %s and %s" % \
+                                 (record["mbid"], owner[record["mbid"]],
+                                  shard["filename"]))
+            owner[record["mbid"]] = shard["filename"]
+
+def applySettingsPlan(rc, plan):
+    """Apply the setting changes saved in a shard to a run configuration"""
+    for hub in plan:
+        domCfg = rc.domCfgs.get(hub)
+        if domCfg is None:
+            raise RunConfigException("hub %s is not in %s" % (hub, rc.filename))
+        for (mbid, change) in plan[hub].items():
+            for (setting, value) in change["settings"].items():
+                domCfg.setDOMSetting(mbid, setting, value)
+            if change["baselines"] is not None:
+                domCfg.setDOMBaselines(mbid, change["baselines"])
+
+def getRules(overrides=None):
+    """The default rule parameters, updated with any overrides"""
+    rules = OrderedDict(DEFAULT_RULES)
+    if overrides:
+        rules.update(overrides)
+    return rules
+
+def parseSweep(spec):
+    """
+    Parse a sweep option of the form NAME=v1,v2,... into the rule
+    parameter name and its list of values.
+    """
+    if "=" not in spec:
+        raise ValueError("sweep must be NAME=value[,value...]: %s" % spec)
+    (name, values) = spec.split("=", 1)
+    name = name.strip()
+    if name not in DEFAULT_RULES:
+        raise ValueError("unknown rule parameter %s (one of %s)" % \
+                         (name, ", ".join(DEFAULT_RULES)))
+    # Keep integer parameters (e.g. HV limits) as integers
+    valueType = type(DEFAULT_RULES[name])
+    return (name, [valueType(v) for v in values.split(",") if v.strip()])
+
+def getVariants(grid):
+    """All combinations of the values in a list of (name, values)"""
+    names = [name for (name, values) in grid]
+    return [OrderedDict(zip(names, values))
+            for values in itertools.product(*[values for (name, values) in grid])]
+
+def getQuantiles(values, fractions=(0.1, 0.5, 0.9)):
+    """Quantiles of a list of values (NaN if empty)"""
+    values = sorted(values)
+    if not values:
+        return [float('nan')]*len(fractions)
+    return [values[min(int(f*len(values)), len(values)-1)] for f in fractions]
+
+def summarizeVariant(updater):
+    """Summarize the records of a sweep variant for comparison"""
+    records = [r for r in updater.records.values() if r["calibrated"]]
+    categories = updater.diagnostics.byCategory()
+    inice = [r for r in records if r["category"] == INICE]
+    return {"nDOMs": len(records),
+            "hvClamped": len(categories.get("HV setting clamped", [])),
+            "warnings": sum([len(r["warnings"]) for r in records]),
+            "warnDOMs": len([r for r in records if r["warnings"]]),
+            "hv": getQuantiles([r["hvNew"]/2. for r in records]),
+            "gainDiffPct": getQuantiles([r["gainDiffPct"] for r in records]),
+            "speThreshPE": getQuantiles([r["speThreshPENew"] for r in inice
+                                         if r["speThreshPENew"] is not None])}
+
+def newCounts():
+    """Counts of DOMs with records, calibrated DOMs, and the warnings
+    of calibrated DOMs and DOMs with warnings"""
+    return {"doms": 0, "calibrated": 0, "warnings": 0, "warnDOMs": 0}
+
+def printSweep(variants, summaries):
+    """Print a table comparing the sweep variants; distributions are
+    given as median [10%, 90%]"""
+    names = list(variants[0].keys())
+    print(" ".join(["%3s" % "#"] + ["%13s" % n for n in names] +
+                   ["%5s %7s %8s %7s %-20s %-20s %-20s" % \
+                    ("DOMs", "clamped", "warnings", "warnDOM", "HV (V)",
+                     "gain change (%)", "SPE thresh (PE)")]))
+    for (i, (rules, summary)) in enumerate(zip(variants, summaries)):
+        (hv, gain, thresh) = (summary["hv"], summary["gainDiffPct"],
+                              summary["speThreshPE"])
+        print(" ".join(["%3d" % (i+1)] + ["%13g" % rules[n] for n in names] +
+                       ["%5d %7d %8d %7d %-20s %-20s %-20s" % \
+                        (summary["nDOMs"], summary["hvClamped"],
+                         summary["warnings"], summary["warnDOMs"],
+                         "%.1f [%.1f, %.1f]" % (hv[1], hv[0], hv[2]),
+                         "%.1f [%.1f, %.1f]" % (gain[1], gain[0], gain[2]),
+                         "%.3f [%.3f, %.3f]" % (thresh[1], thresh[0], thresh[2]))]))
+    sys.stdout.flush()
+
+class CalibrationUpdater(object):
+    """
+    Calculate new DOM settings from DOMCal results according to the
+    calibration rules, making a record of the changes and warnings for
+    each DOM.  The records are added to the statistics and counts as
+    they are made, and only kept if keepRecords is set.
+    """
+    def __init__(self, nicks, dryrun=False, icetopDisable=False,
+                 beaconRate=None, verbose=False, strings=None, rules=None,
+                 prefetch=PREFETCH_DEPTH, policy=POLICY_VETTED, keepRecords=False):
+        self.nicks = nicks
+        self.geometry = Geometry(nicks)
+        self.dryrun = dryrun
+        self.icetopDisable = icetopDisable
+        self.beaconRate = beaconRate
+        self.verbose = verbose
+        self.strings = strings
+        self.rules = getRules(rules)
+        self.prefetch = prefetch
+        self.policy = policy
+        self.stream = None
+        self.diagnostics = Diagnostics()
+        # Running statistics of the changes, by quantity and category
+        self.stats = StatsTable()
+
+        (self.hvExc, self.gainExc) = ({}, {})
+        (self.discExc, self.discExcPE) = ({}, {})
+        (self.chipExc, self.bias0Exc, self.bias1Exc) = ({}, {}, {})
+        self.blExc = {}
+        self.exceptionFiles = [None, None, None, None]
+
+        # Per-DOM records, in processing order, if kept
+        self.keepRecords = keepRecords
+        self.records = OrderedDict()
+        self.counts = newCounts()
+        # Calibrated DOMs whose beacon rate may be set
+        self.beaconDOMs = set()
+
+    def loadExceptions(self, gainFile=None, discFile=None, atwdFile=None,
+                       baselineFile=None):
+        self.exceptionFiles = [gainFile, discFile, atwdFile, baselineFile]
+        (self.hvExc, self.gainExc) = getGainExceptions(gainFile)
+        (self.discExc, self.discExcPE) = getDiscExceptions(discFile)
+        (self.chipExc, self.bias0Exc, self.bias1Exc) = getATWDExceptions(atwdFile)
+        self.blExc = getBaselineExceptions(baselineFile)
+        if self.hvExc:
+            print("Applying",len(self.hvExc),"HV exceptions from",gainFile)
+        if self.gainExc:
+            print("Applying",len(self.gainExc),"gain exceptions from",gainFile)
+        if self.discExc:
+            print("Applying",len(self.discExc),"discriminator exceptions from",discFile)
+        if self.discExcPE:
+            print("Applying",len(self.discExcPE),"discriminator PE exceptions from",discFile)
+        #if self.chipExc:
+        #    print "Applying",len(self.chipExc),"ATWD chip selection exceptions from",atwdFile
+        if self.bias0Exc:
+            print("Applying",len(self.bias0Exc),"ATWD0 bias exceptions from",atwdFile)
+        if self.bias1Exc:
+            print("Applying",len(self.bias1Exc),"ATWD1 bias exceptions from",atwdFile)
+        if self.blExc:
+            print("Applying",len(self.blExc),"ATWD baseline exceptions from",baselineFile)
+
+    def getVariant(self, rules):
+        """A dry-run copy of this updater, with the same exceptions,
+        for a different set of rule parameters"""
+        variant = copy.copy(self)
+        variant.rules = getRules(self.rules)
+        variant.rules.update(rules)
+        variant.dryrun = True
+        variant.verbose = False
+        variant.stream = None
+        # Kept to summarize the variant
+        variant.keepRecords = True
+        variant.records = OrderedDict()
+        variant.counts = newCounts()
+        variant.beaconDOMs = set()
+        variant.diagnostics = Diagnostics()
+        variant.stats = StatsTable()
+        return variant
+
+    def isSelected(self, mbid):
+        """Is the DOM on one of the selected strings (if any)?"""
+        if self.strings is None:
+            return True
+        pos = self.nicks.getDOMPosition(mbid)
+        return (pos is not None) and (pos[0] in self.strings)
+
+    def newRecord(self, mbid):
+        """Start a new record for a DOM, replacing any earlier one"""
+        record = {"mbid": mbid,
+                  "position": self.nicks.getDOMPosition(mbid),
+                  "category": None,
+                  "calibrated": False,
+                  "warnings": []}
+        if mbid in self.records:
+            self.countRecord(self.records[mbid], -1)
+        if self.keepRecords:
+            self.records[mbid] = record
+        self.beaconDOMs.discard(mbid)
+        self.diagnostics.clear(mbid)
+        return record
+
+    def warn(self, record, category, *args):
+        """Record a warning for a DOM, printing it at once if verbose"""
+        msg = " ".join([str(a) for a in args])
+        record["warnings"].append(msg)
+        self.diagnostics.add(record["mbid"], category, msg)
+        if self.verbose:
+            print("WARNING:", msg)
+
+    def countRecord(self, record, sign=1):
+        """Add a completed DOM record to the counts of DOMs and
+        warnings (or, with sign -1, remove it)"""
+        self.counts["doms"] += sign
+        if record["calibrated"]:
+            self.counts["calibrated"] += sign
+            self.counts["warnings"] += sign*len(record["warnings"])
+            if record["warnings"]:
+                self.counts["warnDOMs"] += sign
+
+    def recordDone(self, record):
+        """Add a completed DOM record to the statistics and counts and
+        write it to the stream, if any"""
+        self.stats.addRecord(record)
+        self.countRecord(record)
+        if (self.beaconRate is not None) and record["calibrated"] and \
+           not ((record["category"] == ICETOP) and self.icetopDisable):
+            self.beaconDOMs.add(record["mbid"])
+        if self.stream is not None:
+            self.stream.write(record)
+        return record
+
+    def missingCalibration(self, mbid):
+        record = self.newRecord(mbid)
+        self.warn(record, "no calibration results", "no calibration results for", mbid,
+                  self.nicks.getDOMPosition(mbid), self.nicks.getDOMName(mbid))
+        return self.recordDone(record)
+
+    def updateDOM(self, domCfg, mbid, cal):
+        """
+        Calculate the new settings for one DOM from its calibration
+        results and, unless this is a dry run, apply them to the DOM
+        configuration.  Returns the record of changes for the DOM.
+        """
+        nicks = self.nicks
+        rules = self.rules
+        record = self.newRecord(mbid)
+        record["calibrated"] = True
+        if not self.verbose:
+            cal.diagnostics = self.diagnostics
+
+        omkey = nicks.getDOMPosition(mbid)
+        if omkey is not None:
+            (string, dompos) = omkey
+            (category, isLowGain) = self.geometry.getCategory(mbid)
+        else:
+            self.warn(record, "no string, position", "no string, position for ", mbid)
+            (category, isLowGain) = (INICE, False)
+            (string, dompos) = (0, 0)
+        isIceTop = (category == ICETOP)
+        isScint = (category == SCINT)
+        record["category"] = category
+
+        #-----------------------------------------------------
+        # Determine new HV setting
+        if mbid in self.gainExc:
+            gain = self.gainExc[mbid]
+        else:
+            if isIceTop:
+                if isLowGain:
+                    gain = rules["GAIN_IT_LOW"]
+                else:
+                    gain = rules["GAIN_IT_HIGH"]
+            elif isScint:
+                gain = rules["GAIN_SCINT"]
+            else:
+                gain = rules["GAIN_INICE"]
+
+        if mbid in self.hvExc:
+            hvSetNew = self.hvExc[mbid]
+            gain = cal.getGain(mbid, hvSetNew/2.)
+        else:
+            hvSetNew = cal.getHVSetting(mbid, gain)
+
+        # Make sure HV is in range
+        if not isScint and (hvSetNew > rules["MAX_HV"]):
+            self.warn(record, "HV setting clamped", "HV setting %d for %s too high!  Clamping!\n" % (hvSetNew, mbid))
+            hvSetNew = rules["MAX_HV"]
+        elif isScint and (hvSetNew > rules["MAX_HV_SCINT"]):
+            self.warn(record, "HV setting clamped", "HV setting %d for scintillator %s too high!  Clamping!\n" \
+                      % (hvSetNew, mbid))
+            hvSetNew = rules["MAX_HV_SCINT"]
+
+        hvSetOld = int(domCfg.getDOMSetting(mbid, 'pmtHighVoltage'))
+
+        hvDiff = (hvSetNew-hvSetOld)/2.
+        gainOld = cal.getGain(mbid, hvSetOld/2.)
+        if gain > 0:
+            gainDiffPct = (gain-gainOld)/gain*100.
+            if (math.fabs(gainDiffPct) > WARN_MAX_GAIN_DIFF_PCT):
+                # Old gain is zero (or unknown) if the HV was off
+                if gainOld > 0:
+                    logGainOld = math.log10(gainOld)
+                else:
+                    logGainOld = float('-inf')
+                self.warn(record, "large gain change", "large gain change (%.1f%%)" % (gainDiffPct),\
+                          mbid, "%02d-%02d" % (string, dompos), \
+                          nicks.getDOMName(mbid), "%.1f %.1f" \
+                          % (logGainOld, math.log10(gain)))
+        else:
+            gainDiffPct = 0.
+
+        record.update({"hvOld": hvSetOld, "hvNew": hvSetNew, "hvDiff": hvDiff,
+                       "gainOld": gainOld, "gainNew": gain,
+                       "gainDiffPct": gainDiffPct})
+
+        # If desired, ignore all IceTop high voltage changes
+        # unless specifically overridden in the HV exceptions list
+        if isIceTop and self.icetopDisable and not (mbid in self.hvExc):
+            if abs(hvDiff) > WARN_HV_CHANGE:
+                self.warn(record, "large HV change (disabled for IceTop)", "large HV change predicted, but disabled for IceTop (%.1f V)" % (hvDiff),\
+                          mbid, "%02d-%02d" % (string, dompos), \
+                          nicks.getDOMName(mbid), hvSetOld, hvSetNew)
+        else:
+            if abs(hvDiff) > WARN_HV_CHANGE:
+                self.warn(record, "large HV change", "large HV change (%.1f V)" % (hvDiff),\
+                          mbid, "%02d-%02d" % (string, dompos), \
+                          nicks.getDOMName(mbid), hvSetOld, hvSetNew)
+
+            if not self.dryrun:
+                domCfg.setDOMSetting(mbid, 'pmtHighVoltage', hvSetNew)
+
+        #-----------------------------------------------------
+        # Discriminator settings
+        if mbid in self.discExc:
+            (speDiscNew, mpeDiscNew) = self.discExc[mbid]
+        elif mbid in self.discExcPE:
+            if isIceTop:
+                self.warn(record, "SPE-only discriminator override for IceTop", "SPE-only discriminator override applied to IceTop DOM!")
+            speDiscNew = cal.getSPEDisc(mbid, self.discExcPE[mbid], gain)
+            mpeDiscNew = speDiscNew+100
+        else:
+            if isIceTop:
+                if not isLowGain:
+                    (speDiscNew, mpeDiscNew) = DISC_IT_HIGH
+                else:
+                    (speDiscNew, mpeDiscNew) = DISC_IT_LOW
+            elif isScint:
+                speDiscNew = cal.getSPEDisc(mbid, rules["DISC_SCINT_PE"], gain)
+                mpeDiscNew = speDiscNew+100
+            else:
+                # Note: use new gain
+                speDiscNew = cal.getSPEDisc(mbid, rules["DISC_INICE_PE"], gain)
+                mpeDiscNew = speDiscNew+100
+
+        speDiscOld = int(domCfg.getDOMSetting(mbid, 'speTriggerDiscriminator'))
+
+        speDiscDiff = speDiscNew-speDiscOld
+        (oldDiscPE, newDiscPE, speDiscDiffPE) = (None, None, None)
+        if not isIceTop and not isScint:
+            oldDiscPE = cal.getSPEThresh(mbid, speDiscOld, gain)
+            newDiscPE = cal.getSPEThresh(mbid, speDiscNew, gain)
+            speDiscDiffPE = newDiscPE-oldDiscPE
+
+        record.update({"speDiscOld": speDiscOld, "speDiscNew": speDiscNew,
+                       "mpeDiscNew": mpeDiscNew, "speDiscDiff": speDiscDiff,
+                       "speThreshPEOld": oldDiscPE, "speThreshPENew": newDiscPE,
+                       "speDiscDiffPE": speDiscDiffPE})
+
+        # Do not check IceTop differences
+        if not isIceTop and (abs(speDiscDiff) > WARN_SPE_DISC_CHANGE):
+            self.warn(record, "large SPE discriminator change (counts)", "large SPE discriminator change (%d counts)" % (speDiscDiff),\
+                      mbid, "%02d-%02d" % (string, dompos), \
+                      nicks.getDOMName(mbid), speDiscOld, speDiscNew)
+
+        if not isIceTop and not isScint and (abs(speDiscDiffPE) > WARN_SPE_DISC_CHANGE_PE):
+            self.warn(record, "large SPE discriminator change (PE)", "large SPE discriminator change (%.2f PE)" % (speDiscDiffPE),\
+                      mbid, "%02d-%02d" % (string, dompos), \
+                      nicks.getDOMName(mbid), "%0.2f" % oldDiscPE, rules["DISC_INICE_PE"])
+
+        if not self.dryrun:
+            domCfg.setDOMSetting(mbid, 'speTriggerDiscriminator', speDiscNew)
+            domCfg.setDOMSetting(mbid, 'mpeTriggerDiscriminator', mpeDiscNew)
+
+        #-----------------------------------------------------
+        # Determine new ATWD frequency (trigger bias) settings
+
+        atwdFreqNew = [ None, None ]
+        if mbid in self.bias0Exc:
+            atwdFreqNew[0] = self.bias0Exc[mbid]
+        else:
+            atwdFreqNew[0] = cal.getATWDFreqSetting(mbid, 0, rules["ATWD_FREQ_MHZ"])
+        if mbid in self.bias1Exc:
+            atwdFreqNew[1] = self.bias1Exc[mbid]
+        else:
+            atwdFreqNew[1] = cal.getATWDFreqSetting(mbid, 1, rules["ATWD_FREQ_MHZ"])
+
+        atwdFreqOld = [ int(domCfg.getDOMSetting(mbid, 'atwd0TriggerBias')),
+                        int(domCfg.getDOMSetting(mbid, 'atwd1TriggerBias'))]
+        atwdFreqMHzOld = (cal.getATWDFreq(mbid, 0, atwdFreqOld[0]),
+                          cal.getATWDFreq(mbid, 1, atwdFreqOld[1]))
+        atwdFreqMHzNew = (cal.getATWDFreq(mbid, 0, atwdFreqNew[0]),
+                          cal.getATWDFreq(mbid, 1, atwdFreqNew[1]))
+
+        atwdFreqMHzDiff = (atwdFreqMHzNew[0]-atwdFreqMHzOld[0], atwdFreqMHzNew[1]-atwdFreqMHzOld[1])
+
+        if (abs(atwdFreqNew[0]-atwdFreqOld[0]) > WARN_ATWD_FREQ_CHANGE) or \
+           (abs(atwdFreqNew[1]-atwdFreqOld[1]) > WARN_ATWD_FREQ_CHANGE):
+            self.warn(record, "large ATWD trigger bias change", "large ATWD trigger bias change",\
+                      mbid, "%02d-%02d" % (string, dompos), \
+                      nicks.getDOMName(mbid), atwdFreqOld, atwdFreqNew)
+
+        if ((math.fabs(atwdFreqMHzDiff[0]) > WARN_ATWD_FREQ_CHANGE_MHZ)) or \
+           ((math.fabs(atwdFreqMHzDiff[1]) > WARN_ATWD_FREQ_CHANGE_MHZ)):
+            self.warn(record, "large ATWD sampling speed change", "large ATWD sampling speed change",\
+                      mbid, "%02d-%02d" % (string, dompos), \
+                      nicks.getDOMName(mbid), "(%.2f, %.2f MHz)" % (atwdFreqMHzNew[0]-atwdFreqMHzOld[0],atwdFreqMHzNew[1]-atwdFreqMHzOld[1]))
+
+        record.update({"atwdBiasOld": atwdFreqOld, "atwdBiasNew": atwdFreqNew,
+                       "atwdFreqDiff": [atwdFreqNew[0]-atwdFreqOld[0],
+                                        atwdFreqNew[1]-atwdFreqOld[1]],
+                       "atwdFreqMHzDiff": list(atwdFreqMHzDiff)})
+
+        if not self.dryrun:
+            domCfg.setDOMSetting(mbid, 'atwd0TriggerBias', atwdFreqNew[0])
+            domCfg.setDOMSetting(mbid, 'atwd1TriggerBias', atwdFreqNew[1])
+
+        #-----------------------------------------------------
+        # FIX ME ADD CHIP SELECT
+
+        #-----------------------------------------------------
+        # In special cases, recalculate or update the ATWD baselines
+        if mbid in self.blExc:
+            blOld = domCfg.getDOMBaselines(mbid)
+            blNew = [[0,0,0],[0,0,0]]
+            for chip in range(2):
+                for ch in range(3):
+                    blNew[chip][ch] = cal.getBaseline(mbid, chip, ch)
+
+            self.warn(record, "ATWD baselines updated", "updating ATWD baselines", \
+                      mbid, "%02d-%02d" % (string, dompos), \
+                      nicks.getDOMName(mbid), blOld, blNew)
+
+            if not self.dryrun:
+                domCfg.setDOMBaselines(mbid,blNew)
+
+        #-----------------------------------------------------
+        # If requested, check that the beacon rate can be set (see
+        # setBeaconRates, which sets it for all DOMs at once)
+        if (self.beaconRate is not None) and not (isIceTop and self.icetopDisable):
+            pulserMode = domCfg.getDOMSetting(mbid, 'pulserMode')
+            if (pulserMode != 'beacon'):
+                self.warn(record, "unexpected pulser mode", "unexpected pulser mode",pulserMode,"for MBID",mbid)
+
+        return self.recordDone(record)
+
+    def getSelectedDOMs(self, rc):
+        """Map each selected DOM in a run configuration to its DOM
+        configuration, in configuration order"""
+        domCfgs = OrderedDict()
+        for domCfg in rc.getDOMConfigs():
+            for mbid in domCfg.getDOMs():
+                if self.isSelected(mbid):
+                    domCfgs[mbid] = domCfg
+        return domCfgs
+
+    def updateRunConfig(self, rc, calDir):
+        """Update every DOM in a run configuration from the calibration
+        results in a directory"""
+        domCfgs = self.getSelectedDOMs(rc)
+        # Read the calibration results ahead of the updates
+        for (mbid, cal) in prefetchCalibrations(calDir, list(domCfgs),
+                                                depth=self.prefetch,
+                                                policy=self.policy):
+            if cal is None:
+                self.missingCalibration(mbid)
+            else:
+                self.updateDOM(domCfgs[mbid], mbid, cal)
+        self.setBeaconRates(rc)
+
+    def setBeaconRates(self, rc):
+        """
+        Set the pulser rate for the beacon rate, if one was requested,
+        for all updated DOMs in beacon mode (except IceTop DOMs, if
+        their updates are disabled).
+        """
+        if (self.beaconRate is None) or self.dryrun:
+            return
+        def isBeacon(hub, mbid, settings):
+            return (mbid in self.beaconDOMs) and (settings.get('pulserMode') == 'beacon')
+        changed = rc.setDOMSettings('pulserRate', getRateSetting(self.beaconRate),
+                                    match=isBeacon)
+        print("Set beacon pulser rate for", sum([len(c) for c in changed.values()]), \
+              "DOMs (%s)" % ", ".join(["hub %s: %d" % (hub, len(changed[hub]))
+                                      for hub in changed if changed[hub]]))
+
+    def loadCalibrations(self, rc, calDir):
+        """Read the calibration results for every selected DOM in a
+        run configuration, returning a list of (domCfg, mbid, cal)"""
+        domCfgs = self.getSelectedDOMs(rc)
+        return [(domCfgs[mbid], mbid, cal) for (mbid, cal) in
+                prefetchCalibrations(calDir, list(domCfgs), depth=self.prefetch,
+                                     policy=self.policy)]
+
+    def applyCalibrations(self, doms):
+        """Update DOMs from calibration results read by loadCalibrations"""
+        for (domCfg, mbid, cal) in doms:
+            if cal is None:
+                self.missingCalibration(mbid)
+            else:
+                self.updateDOM(domCfg, mbid, cal)
+
+    def getDOMState(self, rc):
+        """The hub, settings and (if they may be updated) ATWD baselines
+        of each selected DOM in a run configuration"""
+        state = OrderedDict()
+        for hub in sorted(rc.domCfgs, key=int):
+            domCfg = rc.domCfgs[hub]
+            for mbid in domCfg.getDOMs():
+                if self.isSelected(mbid):
+                    baselines = None
+                    if mbid in self.blExc:
+                        baselines = domCfg.getDOMBaselines(mbid)
+                    state[mbid] = (hub, domCfg.getDOMSettings(mbid), baselines)
+        return state
+
+    def getShard(self, rc, calDir, before):
+        """
+        The partial results of an update of the selected DOMs in a run
+        configuration: the settings changed since the DOM state before
+        (see getDOMState), the per-DOM records, warnings and statistics.
+        """
+        plan = OrderedDict()
+        for (mbid, (hub, settings, baselines)) in self.getDOMState(rc).items():
+            (oldHub, oldSettings, oldBaselines) = before[mbid]
+            change = {"settings": dict([(s, v) for (s, v) in settings.items()
+                                        if oldSettings.get(s) != v]),
+                      "baselines": None}
+            if baselines != oldBaselines:
+                change["baselines"] = baselines
+            if change["settings"] or (change["baselines"] is not None):
+                plan.setdefault(hub, OrderedDict())[mbid] = change
+        return {"version": SHARD_VERSION,
+                "config": os.path.abspath(os.path.join(rc.path, rc.filename)),
+                "files": fileStats(rc.getFiles()),
+                "hubs": sorted(rc.getHubs(), key=int),
+                "options": {"calDir": os.path.abspath(calDir),
+                            "rules": self.rules,
+                            "icetopDisable": self.icetopDisable,
+                            "beaconRate": self.beaconRate,
+                            "policy": self.policy,
+                            "exceptionFiles": self.exceptionFiles},
+                "plan": plan,
+                "records": list(self.records.values()),
+                "warnings": [[mbid, entries] for (mbid, entries) in
+                             self.diagnostics.entries.items()],
+                "stats": self.stats.toDict()}
+
+    def addShard(self, shard):
+        """Add the records, warnings and statistics of a shard"""
+        for record in shard["records"]:
+            self.countRecord(record)
+            if self.keepRecords:
+                self.records[record["mbid"]] = record
+        for (mbid, entries) in shard["warnings"]:
+            for (category, msg) in entries:
+                self.diagnostics.add(mbid, category, msg)
+        self.stats.merge(StatsTable.fromDict(shard["stats"]))
+
+    def sortRecords(self, mbids):
+        """Put the records and warnings in the order of a list of DOMs
+        (e.g. configuration order, after adding shards)"""
+        order = dict([(mbid, i) for (i, mbid) in enumerate(mbids)])
+        key = lambda item: order.get(item[0], len(order))
+        self.records = OrderedDict(sorted(self.records.items(), key=key))
+        self.diagnostics.entries = OrderedDict(sorted(self.diagnostics.entries.items(),
+                                                      key=key))
+
+    def getPlotResults(self):
+        """Collect the setting differences into lists for plotting"""
+        return getPlotResults(self.records.values())
+
+    def printSummary(self, changed=None):
+        """Print calibration coverage and warning counts, followed by
+        the warnings for any DOMs in the changed list"""
+        (nDOMs, nCal) = (self.counts["doms"], self.counts["calibrated"])
+        (nWarn, nWarnDOMs) = (self.counts["warnings"], self.counts["warnDOMs"])
+        if nDOMs > 0:
+            pct = 100.*nCal/nDOMs
+        else:
+            pct = 0.
+        print("[%s] calibration coverage %d/%d DOMs (%.1f%%), %d missing;" \
+              % (time.strftime("%H:%M:%S"), nCal, nDOMs, pct, nDOMs-nCal), \
+              "%d warnings for %d DOMs" % (nWarn, nWarnDOMs))
+        if changed:
+            for mbid in changed:
+                for msg in self.records[mbid]["warnings"]:
+                    print("    WARNING:", msg.rstrip())
+        sys.stdout.flush()
+
+
+def watchCalibration(updater, rc, calDir, interval):
+    """
+    Poll the calibration directory and recalculate the settings for
+    each DOM whose calibration results appear or change, printing a
+    summary after each change.  Stops on keyboard interrupt and returns
+    the calibration results last read for each DOM.
+    """
+    domCfgs = updater.getSelectedDOMs(rc)
+
+    print("Watching", calDir, "for calibration results for", len(domCfgs), \
+          "DOMs every", interval, "seconds (interrupt to stop)")
+    seenStats = {}
+    cals = {}
+    try:
+        while True:
+            calFiles = findCalibrationFiles(calDir, updater.policy)
+            changed = []
+            for mbid in domCfgs:
+                filename = calFiles.get(mbid)
+                stat = None
+                if filename is not None:
+                    try:
+                        st = os.stat(filename)
+                        stat = (filename, st.st_mtime, st.st_size)
+                    except OSError:
+                        pass
+                if (mbid in seenStats) and (seenStats[mbid] == stat):
+                    continue
+                seenStats[mbid] = stat
+
+                cal = None
+                if stat is not None:
+                    cal = CalibrationResults(calDir,
+                                             filter=os.path.relpath(filename, calDir))
+                    if not cal.exists(mbid):
+                        cal = None
+                cals[mbid] = cal
+
+                if cal is None:
+                    updater.missingCalibration(mbid)
+                else:
+                    updater.updateDOM(domCfgs[mbid], mbid, cal)
+                changed.append(mbid)
+
+            if changed:
+                print("Recalculated settings for", len(changed), "DOMs")
+                updater.printSummary(changed)
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print()
+    return cals
+
 
 def main():
     """
@@ -194,10 +1080,12 @@ def main():
     #---------------------------------------------------
     # Parse command-line options
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "htsid:g:a:b:r:v:n:c:",
+        opts, args = getopt.getopt(sys.argv[1:], "htsiVDd:g:a:b:r:v:n:c:w:H:o:W:p:",
                      ["help", "test", "save", "icetop", 
-                      "disc", "gain", "atwd", "baseline", "rate",
-                      "version", "name", "domname"])
+                      "disc=", "gain=", "atwd=", "baseline=", "rate=",
+                      "version=", "name=", "domname=", "watch=", "history=",
+                      "output=", "reduce=", "warnings=", "verbose", "delta", "prefetch=", "policy=",
+                      "hubs=", "strings=", "sweep=", "choose=", "shard=", "merge"])
     except getopt.GetoptError as err:
         print(str(err))
         usage()
@@ -214,6 +1102,20 @@ def main():
     atwdFile = None
     baselineFile = None
     beaconRate = None
+    watchInterval = None
+    historyFile = None
+    streamFile = None
+    warningFile = None
+    verbose = False
+    storeDelta = False
+    hubs = None
+    strings = None
+    sweepGrid = []
+    chosenVariant = None
+    shardFile = None
+    merge = False
+    prefetch = PREFETCH_DEPTH
+    policy = POLICY_VETTED
     for o, a in opts:
         if o in ("-h", "--help"):
             usage()
@@ -240,309 +1142,230 @@ def main():
             baselineFile = a
         elif o in ("-r", "--rate"):
             beaconRate = float(a)
+        elif o in ("-w", "--watch"):
+            watchInterval = float(a)
+        elif o in ("-H", "--history"):
+            historyFile = a
+        elif o in ("-o", "--output"):
+            streamFile = a
+        elif o in ("-W", "--warnings"):
+            warningFile = a
+        elif o in ("-V", "--verbose"):
+            verbose = True
+        elif o in ("-D", "--delta"):
+            storeDelta = True
+        elif o in ("-p", "--prefetch"):
+            prefetch = int(a)
+        elif o == "--policy":
+            if a not in POLICIES:
+                print("ERROR: unknown calibration policy", a)
+                sys.exit(2)
+            policy = a
+        elif o == "--hubs":
+            hubs = parseIntList(a)
+        elif o == "--strings":
+            strings = parseIntList(a)
+        elif o == "--sweep":
+            try:
+                sweepGrid.append(parseSweep(a))
+            except ValueError as err:
+                print("ERROR:", str(err))
+                sys.exit(2)
+        elif o == "--choose":
+            chosenVariant = int(a)
+        elif o == "--shard":
+            shardFile = a
+        elif o == "--merge":
+            merge = True
+        elif o == "--reduce":
+            savePlotFile(readRecordStream(a).values())
+            sys.exit()
         else:
             assert False, "unhandled option"
 
-    if len(args) != 2:
+    if (len(args) != 2) and not (merge and (len(args) >= 2)):
         usage()
         sys.exit(2)
 
     cfgName = args[0]
     calDir = args[1]
 
-    # Parse the exception files
-    (hvExc, gainExc) = getGainExceptions(gainFile)
-    (discExc, discExcPE) = getDiscExceptions(discFile)
-    (chipExc, bias0Exc, bias1Exc) = getATWDExceptions(atwdFile)
-    blExc = getBaselineExceptions(baselineFile)
-    if hvExc:
-        print("Applying",len(hvExc),"HV exceptions from",gainFile)
-    if gainExc:
-        print("Applying",len(gainExc),"gain exceptions from",gainFile)
-    if discExc:
-        print("Applying",len(discExc),"discriminator exceptions from",discFile)
-    if discExcPE:
-        print("Applying",len(discExcPE),"discriminator PE exceptions from",discFile)
-    #if chipExc is not None:
-    #    print "Applying",len(chipExc),"ATWD chip selection exceptions from",atwdFile
-    if bias0Exc:
-        print("Applying",len(bias0Exc),"ATWD0 bias exceptions from",atwdFile)
-    if bias1Exc:
-        print("Applying",len(bias1Exc),"ATWD1 bias exceptions from",atwdFile)
-    if blExc:
-        print("Applying",len(blExc),"ATWD baseline exceptions from",baselineFile)
-
-    # Parse the run configuration files
-    try:
-        rc = RunConfig(cfgName, oldFormat=False)
-    except RunConfigException:
-        print("WARNING: couldn't parse run configuration; trying old format...")
-        rc = RunConfig(cfgName, oldFormat=True)
-    except IOError:
-        print("ERROR: couldn't read configuration file %s, exiting." % cfgName)
-        sys.exit(-1)
-        
-    # DOM positions, names, etc.
-    nicks = nicknames()
-
-    # Lists for saving results
-    (hvDiffList, hvDiffListIT, gainDiffList, gainDiffListIT,
-     speDiscList, speDiscListIT, speDiscPEList, atwdFreqList,
-     atwdFreqMHzList) = ([], [], [], [], [], [], [], [], [])
-    (hvDiffListScint, gainDiffListScint, speDiscListScint) = ([],[],[])	
+    shards = None
+    if merge:
+        if (hubs is not None) or (strings is not None) or sweepGrid or \
+           (watchInterval is not None) or (shardFile is not None):
+            print("ERROR: --merge takes its DOMs and options from the shard files")
+            sys.exit(2)
+        try:
+            shards = [readShard(f) for f in args[1:]]
+            checkShards(shards, cfgName)
+        except (IOError, ValueError) as err:
+            print("ERROR:", str(err))
+            sys.exit(-1)
+        # Only the hubs updated by the shards
+        hubs = sorted(set(itertools.chain(*[s["hubs"] for s in shards])), key=int)
+    elif (shardFile is not None) and (sweepGrid or (watchInterval is not None)):
+        print("ERROR: can't write a shard file in watch or sweep mode")
+        sys.exit(2)
 
-    # Iterate over the configuration files
-    for domCfg in rc.getDOMConfigs():
-        for mbid in domCfg.getDOMs():
+    if (hubs is not None) and (strings is not None):
+        print("ERROR: specify only one of --hubs and --strings")
+        sys.exit(2)
+    if strings is not None:
+        hubs = getStringHubs(strings)
 
-            # Read the calibration results for this DOM
-            f = "domcal_%s.xml" % (mbid)
-            cal = CalibrationResults(calDir, filter=f)
+    if storeDelta and None in (cfgNewName, cfgVersion, cfgDomName):
+        print("ERROR: -D needs the name and version of the new configuration (-v, -n and -c)")
+        sys.exit(2)
 
-            # Try subdirectory (for unvetted results)
-            if not cal.exists(mbid):
-                f = "*/domcal_%s.xml" % (mbid)
-                cal = CalibrationResults(calDir, filter=f)
+    variants = getVariants(sweepGrid)
+    if sweepGrid and (watchInterval is not None):
+        print("ERROR: can't sweep rule parameters in watch mode")
+        sys.exit(2)
+    if (chosenVariant is not None) and \
+       (not sweepGrid or (chosenVariant < 1) or (chosenVariant > len(variants))):
+        print("ERROR: --choose must give one of the", len(variants), "sweep variants")
+        sys.exit(2)
 
-            if not cal.exists(mbid):
-                print("WARNING: no calibration results for", mbid, \
-                      nicks.getDOMPosition(mbid), nicks.getDOMName(mbid))
-                continue
+    # DOM positions, names, etc.
+    nicks = nicknames()
 
-            omkey = nicks.getDOMPosition(mbid)
-            if omkey is not None:
-                (string, dompos) = omkey
-                isIceTop = (string <= 86) and (dompos > 60) and (dompos < 65)
-                if isIceTop:
-                    isLowGain = (dompos % 2 == 0)
-                isScint = (string <= 86) and (dompos > 64)
-            else:
-                print("WARNING: no string, position for ", mbid)
-                isIceTop = False
-                isScint = False
-                (string, dompos) = (0, 0)
-                
-            #-----------------------------------------------------
-            # Determine new HV setting
-            if mbid in gainExc:
-                gain = gainExc[mbid]
-            else:
-                if isIceTop:
-                    if isLowGain:
-                        gain = GAIN_IT_LOW
-                    else:
-                        gain = GAIN_IT_HIGH
-                elif isScint:
-                    gain = GAIN_SCINT
-                else:
-                    gain = GAIN_INICE
+    # Per-DOM records are only kept for the outputs that need them all
+    keepRecords = savePlotResults or (historyFile is not None) or \
+        (watchInterval is not None) or (shardFile is not None) or \
+        (merge and (streamFile is not None))
 
-            if mbid in hvExc:
-                hvSetNew = hvExc[mbid]
-                gain = cal.getGain(mbid, hvSetNew/2.)
-            else:
-                hvSetNew = cal.getHVSetting(mbid, gain)
-
-            # Make sure HV is in range
-            if not isScint and (hvSetNew > MAX_HV):
-                print("WARNING: HV setting %d for %s too high!  Clamping!\n" % (hvSetNew, mbid))
-                hvSetNew = MAX_HV
-            elif isScint and (hvSetNew > MAX_HV_SCINT):
-                print("WARNING: HV setting %d for scintillator %s too high!  Clamping!\n" \
-                      % (hvSetNew, mbid))
-                hvSetNew = MAX_HV_SCINT
-                
-            hvSetOld = int(domCfg.getDOMSetting(mbid, 'pmtHighVoltage'))
-
-            hvDiff = (hvSetNew-hvSetOld)/2.
-            gainOld = cal.getGain(mbid, hvSetOld/2.)
-            if gain > 0:
-                gainDiffPct = (gain-gainOld)/gain*100.
-                if (math.fabs(gainDiffPct) > WARN_MAX_GAIN_DIFF_PCT):
-                    print("WARNING: large gain change (%.1f%%)" % (gainDiffPct),\
-                        mbid, "%02d-%02d" % (string, dompos), \
-                        nicks.getDOMName(mbid), "%.1f %.1f" \
-                        % (math.log10(cal.getGain(mbid, hvSetOld/2.)), math.log10(gain)))
-            else:
-                gainDiffPct = 0.
-                
-            if isIceTop:
-                hvDiffListIT.append(hvDiff)
-                gainDiffListIT.append(gainDiffPct)
-            elif isScint:
-                hvDiffListScint.append(hvDiff)
-                gainDiffListScint.append(gainDiffPct)
-            else:
-                hvDiffList.append(hvDiff)
-                gainDiffList.append(gainDiffPct)                
-
-            # If desired, ignore all IceTop high voltage changes
-            # unless specifically overridden in the HV exceptions list
-            if isIceTop and icetopDisable and not (mbid in hvExc):
-                if abs(hvDiff) > WARN_HV_CHANGE:
-                    print("WARNING: large HV change predicted, but disabled for IceTop (%.1f V)" % (hvDiff),\
-                          mbid, "%02d-%02d" % (string, dompos), \
-                          nicks.getDOMName(mbid), hvSetOld, hvSetNew)
-            else:
-                if abs(hvDiff) > WARN_HV_CHANGE:
-                    print("WARNING: large HV change (%.1f V)" % (hvDiff),\
-                          mbid, "%02d-%02d" % (string, dompos), \
-                          nicks.getDOMName(mbid), hvSetOld, hvSetNew)
+    # Parse the exception files
+    updater = CalibrationUpdater(nicks, dryrun=dryrun,
+                                 icetopDisable=icetopDisable,
+                                 beaconRate=beaconRate,
+                                 verbose=verbose,
+                                 strings=strings,
+                                 prefetch=prefetch,
+                                 policy=policy,
+                                 keepRecords=keepRecords)
+    updater.loadExceptions(gainFile=gainFile, discFile=discFile,
+                           atwdFile=atwdFile, baselineFile=baselineFile)
 
-                if not dryrun:
-                    domCfg.setDOMSetting(mbid, 'pmtHighVoltage', hvSetNew)
-                
-            #-----------------------------------------------------
-            # Discriminator settings            
-            if mbid in discExc:
-                (speDiscNew, mpeDiscNew) = discExc[mbid]
-            elif mbid in discExcPE:
-                if isIceTop:
-                    print("WARNING: SPE-only discriminator override applied to IceTop DOM!")
-                speDiscNew = cal.getSPEDisc(mbid, discExcPE[mbid], gain)
-                mpeDiscNew = speDiscNew+100
-            else:
-                if isIceTop:
-                    if isHighGain:
-                        (speDiscNew, mpeDiscNew) = DISC_IT_HIGH
-                    else:
-                        (speDiscNew, mpeDiscNew) = DISC_IT_LOW
-                elif isScint:
-                    speDiscNew = cal.getSPEDisc(mbid, DISC_SCINT_PE, gain)
-                    mpeDiscNew = speDiscNew+100
-                else:
-                    # Note: use new gain
-                    speDiscNew = cal.getSPEDisc(mbid, DISC_INICE_PE, gain)
-                    mpeDiscNew = speDiscNew+100
+    # Parse the run configuration files
+    try:
+        rc = RunConfig(cfgName, hubs=hubs)
+    except IOError:
+        print("ERROR: couldn't read configuration file %s, exiting." % cfgName)
+        sys.exit(-1)
+    except RunConfigException as err:
+        print("ERROR:", str(err), file=sys.stderr)
+        sys.exit(-1)
 
-            speDiscOld = int(domCfg.getDOMSetting(mbid, 'speTriggerDiscriminator'))
+    if (watchInterval is not None) and isCalibrationArchive(calDir):
+        print("ERROR: can only watch a calibration directory, not an archive")
+        sys.exit(-1)
 
-            speDiscDiff = speDiscNew-speDiscOld
-            if isIceTop:
-                speDiscListIT.append(speDiscDiff)
-            elif isScint:
-                speDiscListScint.append(speDiscDiff)
-            else:    
-                speDiscList.append(speDiscDiff)
-                oldDiscPE = cal.getSPEThresh(mbid, speDiscOld, gain)
-                newDiscPE = cal.getSPEThresh(mbid, speDiscNew, gain)
-                speDiscDiffPE = newDiscPE-oldDiscPE
-                speDiscPEList.append(speDiscDiffPE)
-
-            # Do not check IceTop differences
-            if not isIceTop and (abs(speDiscDiff) > WARN_SPE_DISC_CHANGE):
-                print("WARNING: large SPE discriminator change (%d counts)" % (speDiscDiff),\
-                      mbid, "%02d-%02d" % (string, dompos), \
-                      nicks.getDOMName(mbid), speDiscOld, speDiscNew)
+    if streamFile is not None:
+        updater.stream = RecordStream(streamFile)
 
-            if not isIceTop and not isScint and (abs(speDiscDiffPE) > WARN_SPE_DISC_CHANGE_PE):
-                print("WARNING: large SPE discriminator change (%.2f PE)" % (speDiscDiffPE),\
-                      mbid, "%02d-%02d" % (string, dompos), \
-                      nicks.getDOMName(mbid), "%0.2f" % oldDiscPE, DISC_INICE_PE)
-            
+    if shards is not None:
+        for shard in shards:
+            updater.addShard(shard)
             if not dryrun:
-                domCfg.setDOMSetting(mbid, 'speTriggerDiscriminator', speDiscNew)
-                domCfg.setDOMSetting(mbid, 'mpeTriggerDiscriminator', mpeDiscNew)                
-
-            #-----------------------------------------------------
-            # Determine new ATWD frequency (trigger bias) settings
+                applySettingsPlan(rc, shard["plan"])
+        updater.sortRecords(rc.getDOMs())
+        if updater.stream is not None:
+            for record in updater.records.values():
+                updater.stream.write(record)
+        print("Merged", len(shards), "shards with results for", updater.counts["doms"], \
+              "DOMs in", len(hubs), "hubs")
+        entries = [rc.getHubEntry(child) for child in rc.root]
+        missing = [e[0] for e in entries if (e is not None) and (e[0] not in hubs)]
+        if missing:
+            print("WARNING: no shard for hubs", ", ".join(sorted(missing, key=int)))
+    elif shardFile is not None:
+        # Update the configuration in memory only, to find the changes
+        before = updater.getDOMState(rc)
+        updater.dryrun = False
+        updater.updateRunConfig(rc, calDir)
+        updater.dryrun = True
+        writeShard(shardFile, updater.getShard(rc, calDir, before))
+        print("Saved results for", updater.counts["doms"], "DOMs in", \
+              len(rc.getHubs()), "hubs to shard file", shardFile)
+    elif watchInterval is not None:
+        # Don't touch the configuration until the calibration
+        # results have settled, then apply the latest ones
+        updater.dryrun = True
+        updater.verbose = False
+        cals = watchCalibration(updater, rc, calDir, watchInterval)
+        updater.dryrun = dryrun
+        if not dryrun:
+            for domCfg in rc.getDOMConfigs():
+                for mbid in domCfg.getDOMs():
+                    if updater.isSelected(mbid) and (cals.get(mbid) is not None):
+                        updater.updateDOM(domCfg, mbid, cals[mbid])
+            updater.setBeaconRates(rc)
+        # Only count the final results for each DOM
+        updater.stats = StatsTable()
+        for record in updater.records.values():
+            updater.stats.addRecord(record)
+        updater.printSummary()
+    elif sweepGrid:
+        # Read the calibration results once and evaluate every variant
+        doms = updater.loadCalibrations(rc, calDir)
+        summaries = []
+        for rules in variants:
+            variant = updater.getVariant(rules)
+            variant.applyCalibrations(doms)
+            summaries.append(summarizeVariant(variant))
+        print("Compared", len(variants), "rule variants for", len(doms), "DOMs")
+        printSweep(variants, summaries)
+        if chosenVariant is None:
+            if updater.stream is not None:
+                updater.stream.close()
+            return
+        print("Applying variant", chosenVariant)
+        updater.rules.update(variants[chosenVariant-1])
+        updater.applyCalibrations(doms)
+        updater.setBeaconRates(rc)
+    else:
+        updater.updateRunConfig(rc, calDir)
 
-            atwdFreqNew = [ None, None ]
-            if mbid in bias0Exc:
-                atwdFreqNew[0] = bias0Exc[mbid]
-            else:
-                atwdFreqNew[0] = cal.getATWDFreqSetting(mbid, 0, ATWD_FREQ_MHZ)
-            if mbid in bias1Exc:
-                atwdFreqNew[1] = bias1Exc[mbid]
+    # Save updated run configuration files
+    if not dryrun and (shardFile is None):
+        # Fix me deal with user specifying only some of these
+        try:
+            if (cfgNewName is not None) and (cfgVersion is not None) and (cfgDomName is not None):
+                rc.write(newName=cfgNewName, newVersion=cfgVersion, newDomCfgName=cfgDomName,
+                         delta=storeDelta)
             else:
-                atwdFreqNew[1] = cal.getATWDFreqSetting(mbid, 1, ATWD_FREQ_MHZ)
-
-            atwdFreqOld = [ int(domCfg.getDOMSetting(mbid, 'atwd0TriggerBias')),
-                            int(domCfg.getDOMSetting(mbid, 'atwd1TriggerBias'))]
-            atwdFreqMHzOld = (cal.getATWDFreq(mbid, 0, atwdFreqOld[0]),
-                              cal.getATWDFreq(mbid, 1, atwdFreqOld[1]))
-            atwdFreqMHzNew = (cal.getATWDFreq(mbid, 0, atwdFreqNew[0]),
-                              cal.getATWDFreq(mbid, 1, atwdFreqNew[1]))
-
-            atwdFreqMHzDiff = (atwdFreqMHzNew[0]-atwdFreqMHzOld[0], atwdFreqMHzNew[1]-atwdFreqMHzOld[1])
-
-            if (abs(atwdFreqNew[0]-atwdFreqOld[0]) > WARN_ATWD_FREQ_CHANGE) or \
-               (abs(atwdFreqNew[1]-atwdFreqOld[1]) > WARN_ATWD_FREQ_CHANGE):
-                print("WARNING: large ATWD trigger bias change",\
-                      mbid, "%02d-%02d" % (string, dompos), \
-                      nicks.getDOMName(mbid), atwdFreqOld, atwdFreqNew)
-
-            if ((math.fabs(atwdFreqMHzDiff[0]) > WARN_ATWD_FREQ_CHANGE_MHZ)) or \
-               ((math.fabs(atwdFreqMHzDiff[1]) > WARN_ATWD_FREQ_CHANGE_MHZ)):
-                print("WARNING: large ATWD sampling speed change",\
-                      mbid, "%02d-%02d" % (string, dompos), \
-                      nicks.getDOMName(mbid), "(%.2f, %.2f MHz)" % (atwdFreqMHzNew[0]-atwdFreqMHzOld[0],atwdFreqMHzNew[1]-atwdFreqMHzOld[1]))
-                
-            atwdFreqList.append(atwdFreqNew[0]-atwdFreqOld[0])
-            atwdFreqList.append(atwdFreqNew[1]-atwdFreqOld[1])
-            atwdFreqMHzList.append(atwdFreqMHzDiff[0])
-            atwdFreqMHzList.append(atwdFreqMHzDiff[1])
+                rc.write()
+        except RunConfigException as err:
+            print("ERROR:", str(err))
+            sys.exit(-1)
 
-            if not dryrun:
-                domCfg.setDOMSetting(mbid, 'atwd0TriggerBias', atwdFreqNew[0])
-                domCfg.setDOMSetting(mbid, 'atwd1TriggerBias', atwdFreqNew[1])
-
-            #-----------------------------------------------------
-            # FIX ME ADD CHIP SELECT 
-
-            #-----------------------------------------------------
-            # In special cases, recalculate or update the ATWD baselines
-            if mbid in blExc:
-                blOld = domCfg.getDOMBaselines(mbid)
-                blNew = [[0,0,0],[0,0,0]]
-                for chip in range(2):
-                    for ch in range(3):
-                        blNew[chip][ch] = cal.getBaseline(mbid, chip, ch)
-
-                print("WARNING: updating ATWD baselines", \
-                      mbid, "%02d-%02d" % (string, dompos), \
-                      nicks.getDOMName(mbid), blOld, blNew)
+    if updater.stream is not None:
+        updater.stream.close()
 
-                if not dryrun:
-                    domCfg.setDOMBaselines(mbid,blNew)
-
-            #-----------------------------------------------------
-            # If request, calculate the required beacon rate setting
-            if (beaconRate is not None) and not (isIceTop and icetopDisable):
-                rateSetting = getRateSetting(beaconRate)
-                pulserMode = domCfg.getDOMSetting(mbid, 'pulserMode')
-                if (pulserMode == 'beacon'):
-                    if not dryrun:
-                        domCfg.setDOMSetting(mbid, 'pulserRate', rateSetting)
-                else:
-                    print("WARNING: unexpected pulser mode",pulserMode,"for MBID",mbid)
-            
-    # Save updated run configuration files
-    if not dryrun:
-        # Fix me deal with user specifying only some of these
-        if (cfgNewName is not None) and (cfgVersion is not None) and (cfgDomName is not None):
-            rc.write(newName=cfgNewName, newVersion=cfgVersion, newDomCfgName=cfgDomName)
-        else:
-            rc.write()
+    # Report warnings and summarize changes
+    updater.diagnostics.printSummary(examples=3)
+    updater.stats.printSummary()
+    if warningFile is not None:
+        print("Writing", updater.diagnostics.count(), "warnings to file", warningFile)
+        updater.diagnostics.write(warningFile)
 
     # Save results for plotting
     if savePlotResults:
-        print("Saving differences in calibration to file",OUTPUT_FILE)
-        f = open(OUTPUT_FILE, 'w')
-        plotResults = {"hvDiffList":hvDiffList,
-                       "hvDiffListIT":hvDiffListIT,
-                       "gainDiffList":gainDiffList,
-                       "gainDiffListIT":gainDiffListIT,
-                       "speDiscList":speDiscList,
-                       "speDiscPEList":speDiscPEList,
-                       "speDiscListIT":speDiscListIT,
-                       "hvDiffListScint":hvDiffListScint,
-                       "gainDiffListScint":gainDiffListScint,
-                       "speDiscListScint":speDiscListScint,
-                       "atwdFreqList":atwdFreqList,
-                       "atwdFreqMHzList":atwdFreqMHzList}
-        json.dump(plotResults, f)
-        f.close()
+        savePlotFile(updater.records.values())
+
+    # Save per-DOM results in the history
+    if historyFile is not None:
+        if cfgNewName is not None:
+            cfgHistName = os.path.splitext(os.path.basename(cfgNewName))[0]
+        else:
+            cfgHistName = os.path.splitext(os.path.basename(cfgName))[0]
+        from calHistory import CalibrationHistory
+        history = CalibrationHistory(historyFile)
+        n = history.addRun(list(updater.records.values()), config=cfgHistName,
+                           version=cfgVersion, test=dryrun)
+        history.close()
+        print("Saved results for",n,"DOMs to history file",historyFile)
 
 if __name__ == "__main__":
     main()
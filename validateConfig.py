@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+#
+# validateConfig.py
+#
+# Pre-flight check of the DOM settings in a run configuration: the
+# settings of all DOMs are extracted into columns, and each rule of a
+# rule table is checked over the whole detector at once.
+#
+
+from __future__ import print_function
+from builtins import str
+from builtins import range
+import sys
+import getopt
+
+from runConfig import DOMConfig, RunConfig
+from nicknames import nicknames
+from geometry import Geometry, INICE, ICETOP, SCINT
+from updateCalibration import MAX_HV, MAX_HV_SCINT
+
+# DAC ranges of the settings (the HV and ATWD trigger bias DACs are
+# 12-bit, the discriminator DACs 10-bit)
+MAX_DAC_12BIT = 4095
+MAX_DAC_10BIT = 1023
+
+# Highest pulser rate that updateCalibration.getRateSetting produces
+MAX_BEACON_RATE = 1 << 17
+
+# Nominal ATWD baseline and allowed deviation from it
+BASELINE_NOMINAL = 128
+BASELINE_TOLERANCE = 10
+
+# Settings extracted from each DOM
+SETTINGS = ['pmtHighVoltage', 'speTriggerDiscriminator', 'mpeTriggerDiscriminator',
+            'atwd0TriggerBias', 'atwd1TriggerBias', 'pulserMode', 'pulserRate']
+
+# Integer settings, by column name
+INT_COLUMNS = [("hv", 'pmtHighVoltage'), ("speDisc", 'speTriggerDiscriminator'),
+               ("mpeDisc", 'mpeTriggerDiscriminator'), ("bias0", 'atwd0TriggerBias'),
+               ("bias1", 'atwd1TriggerBias')]
+
+def usage():
+    """ Print program usage """
+    print("Usage: %s [-h] [-n N] run_config.xml" % (sys.argv[0]))
+    print("    -h       print this help message")
+    print("    -n N     list at most N DOMs for each rule (default all; 0 for")
+    print("             counts only)")
+    print("Exits with status 1 if any DOM breaks a rule.")
+
+def toInt(value):
+    """An integer setting, or None if it is missing or not an integer"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def getColumns(rc, geometry):
+    """The settings of every DOM in a run configuration, as columns"""
+    columns = dict([(name, []) for name in
+                    ["mbid", "hub", "category", "pulserMode", "pulserRate",
+                     "baselines", "missing"] + [c for (c, s) in INT_COLUMNS]])
+    for hub in sorted(rc.domCfgs, key=int):
+        domCfg = rc.domCfgs[hub]
+        for mbid in domCfg.getDOMs():
+            settings = domCfg.getDOMSettings(mbid)
+            columns["mbid"].append(mbid)
+            columns["hub"].append(hub)
+            columns["category"].append((geometry.getCategory(mbid) or (INICE,))[0])
+            columns["pulserMode"].append(settings.get('pulserMode'))
+            columns["pulserRate"].append(settings.get('pulserRate'))
+            # None for DOMs without stored baselines
+            columns["baselines"].append(domCfg.hasDOMBaselines(mbid) and
+                                        domCfg.getDOMBaselines(mbid) or None)
+            missing = []
+            for (column, setting) in INT_COLUMNS:
+                value = toInt(settings.get(setting))
+                columns[column].append(value)
+                if value is None:
+                    missing.append(setting)
+            columns["missing"].append(missing)
+    return columns
+
+#-----------------------------------------------------
+# Rules: each returns, for every DOM, a description of the problem
+# or None
+
+def checkMissing(c):
+    return [missing and "missing or not an integer: %s" % ", ".join(missing) or None
+            for missing in c["missing"]]
+
+def checkHV(c):
+    limits = [(cat == SCINT) and MAX_HV_SCINT or MAX_HV for cat in c["category"]]
+    return ["HV setting %d not in [0, %d]" % (hv, limit)
+            if (hv is not None) and ((hv < 0) or (hv > limit)) else None
+            for (hv, limit) in zip(c["hv"], limits)]
+
+def checkDiscRange(c):
+    return ["discriminators (%d, %d) not in [0, %d]" % (spe, mpe, MAX_DAC_10BIT)
+            if (spe is not None) and (mpe is not None) and
+            not ((0 <= spe <= MAX_DAC_10BIT) and (0 <= mpe <= MAX_DAC_10BIT)) else None
+            for (spe, mpe) in zip(c["speDisc"], c["mpeDisc"])]
+
+def checkDiscOrder(c):
+    # IceTop discriminators are set from a table, not relative to each other
+    return ["MPE discriminator %d not above SPE discriminator %d" % (mpe, spe)
+            if (cat != ICETOP) and (spe is not None) and (mpe is not None) and
+            (mpe <= spe) else None
+            for (spe, mpe, cat) in zip(c["speDisc"], c["mpeDisc"], c["category"])]
+
+def checkBias(c):
+    return ["ATWD trigger biases (%d, %d) not in [0, %d]" % (b0, b1, MAX_DAC_12BIT)
+            if (b0 is not None) and (b1 is not None) and
+            not ((0 <= b0 <= MAX_DAC_12BIT) and (0 <= b1 <= MAX_DAC_12BIT)) else None
+            for (b0, b1) in zip(c["bias0"], c["bias1"])]
+
+def checkBeacon(c):
+    rates = [toInt(r) for r in c["pulserRate"]]
+    return ["beacon pulser rate %s not in [1, %d]" % (r, MAX_BEACON_RATE)
+            if (mode == 'beacon') and ((rate is None) or (rate < 1) or
+                                       (rate > MAX_BEACON_RATE)) else None
+            for (mode, r, rate) in zip(c["pulserMode"], c["pulserRate"], rates)]
+
+def checkBaselines(c):
+    far = [bl and [b for b in bl[0] + bl[1] if abs(b - BASELINE_NOMINAL) > BASELINE_TOLERANCE]
+           for bl in c["baselines"]]
+    return ["ATWD baselines %s" % bl if f else None
+            for (bl, f) in zip(c["baselines"], far)]
+
+RULES = [
+    ("missing settings",                   checkMissing),
+    ("HV out of range",                    checkHV),
+    ("discriminator out of range",         checkDiscRange),
+    ("MPE not above SPE discriminator",    checkDiscOrder),
+    ("ATWD trigger bias out of range",     checkBias),
+    ("invalid beacon pulser rate",         checkBeacon),
+    ("ATWD baseline not within %d of %d" % (BASELINE_TOLERANCE, BASELINE_NOMINAL),
+     checkBaselines),
+    ]
+
+def validate(columns):
+    """Check every rule, returning a list of (rule, [(DOM index,
+    problem), ...]) for the rules that are broken"""
+    results = []
+    for (name, check) in RULES:
+        problems = [(i, p) for (i, p) in enumerate(check(columns)) if p is not None]
+        if problems:
+            results.append((name, problems))
+    return results
+
+def main():
+    """
+    Check the DOM settings in a pDAQ run configuration against the
+    rule table.
+    """
+    #---------------------------------------------------
+    # Parse command-line options
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hn:", ["help", "number="])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage()
+        sys.exit(2)
+
+    maxListed = None
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-n", "--number"):
+            maxListed = int(a)
+        else:
+            assert False, "unhandled option"
+
+    if len(args) != 1:
+        usage()
+        sys.exit(2)
+
+    cfgName = args[0]
+    try:
+        rc = RunConfig(cfgName, readOnly=True, snapshot=True,
+                       settings=SETTINGS + [DOMConfig.BASELINEPARENT])
+    except IOError:
+        print("ERROR: couldn't read configuration file %s, exiting." % cfgName)
+        sys.exit(-1)
+
+    nicks = nicknames()
+    columns = getColumns(rc, Geometry(nicks))
+    results = validate(columns)
+
+    badDOMs = set()
+    for (name, problems) in results:
+        print("%6d  %s" % (len(problems), name))
+        for (i, problem) in problems[:maxListed]:
+            mbid = columns["mbid"][i]
+            pos = nicks.getDOMPosition(mbid)
+            print("        %-12s %-6s %-20s hub %-3s %s" % \
+                  (mbid, pos and "%02d-%02d" % (pos[0], pos[1]) or "-",
+                   nicks.getDOMName(mbid), columns["hub"][i], problem))
+        badDOMs.update([i for (i, problem) in problems])
+
+    nDOMs = len(columns["mbid"])
+    print("%s: %d of %d DOMs break %d of %d rules" % \
+          (cfgName, len(badDOMs), nDOMs, len(results), len(RULES)))
+    if badDOMs:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()